@@ -71,6 +71,10 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    # per-request timings, served at /metrics
+    "maritimeapp.middleware.MetricsMiddleware",
+    # opt-in request profiling, removed at startup unless PROFILER_ENABLED
+    "maritimeapp.middleware.ProfilerMiddleware",
     # reponse headers
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -187,6 +191,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "mandatabase.wsgi.application"
+# list_sites, site_measurements and download_data are async views; serve them
+# over ASGI, e.g. `gunicorn mandatabase.asgi:application -k
+# uvicorn.workers.UvicornWorker`. Connection pooling for the web workers is
+# done by pgbouncer, see the database settings below.
+ASGI_APPLICATION = "mandatabase.asgi.application"
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -199,10 +208,119 @@ DATABASES = {
         "PASSWORD": db_password,
         "HOST": db_host,
         "PORT": db_port,
-        "CONN_MAX_AGE": 0,
+        # Connections are per thread and not pooled. Under ASGI the async views
+        # run their queries on executor threads, so keep this at 0 there: each
+        # thread would otherwise hold its own connection, with nothing capping
+        # or sharing them. Only under WSGI may DJANGO_DB_CONN_MAX_AGE keep
+        # connections open between requests (health-checked before reuse).
+        "CONN_MAX_AGE": int(os.getenv("DJANGO_DB_CONN_MAX_AGE", "0")),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Pooling: the psycopg2 backend has no pool of its own (Django's OPTIONS["pool"]
+# needs psycopg 3), so run pgbouncer in transaction mode next to PostgreSQL,
+# point DJANGO_DB_HOST and the config.ini PORT at it and set
+# DJANGO_DB_PGBOUNCER=1. Server-side cursors (QuerySet.iterator) cannot span
+# its pooled transactions, so they are turned off. Without them .iterator()
+# fetches each whole result into the worker: CSV downloads and shards then
+# always use the COPY engine, whatever DOWNLOAD_EXPORT_ENGINE says, but Arrow
+# and Parquet exports hold one file's rows in memory at a time.
+if os.getenv("DJANGO_DB_PGBOUNCER"):
+    DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+
+# Size of the psycopg2 pool shared by the ingest commands (maritimeapp.db);
+# psql_add --parallel holds one connection per measurement table.
+INGEST_POOL_SIZE = 8
+
+
+# Cache used for API responses (list_sites). Entries are keyed on the
+# DataVersion stamp, so an import invalidates them. Defaults to a per-process
+# locmem cache; in production point these at a shared backend, e.g.
+# DJANGO_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache and
+# DJANGO_CACHE_LOCATION=redis://127.0.0.1:6379/1
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("DJANGO_CACHE_LOCATION", "maritimeapp"),
+        "TIMEOUT": 60 * 60 * 24,
+    }
+}
+
+# Engine used by download_data to produce CSV rows: "copy" streams PostgreSQL
+# COPY output straight into the archive, "orm" encodes rows through the ORM.
+DOWNLOAD_EXPORT_ENGINE = "copy"
+
+# Finished download archives are cached here, keyed on the normalised request
+# and the DataVersion stamp; the least recently used ones are evicted once the
+# directory grows past DOWNLOAD_CACHE_MAX_BYTES. Set the directory to None to
+# disable the cache.
+DOWNLOAD_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "download_cache"
+)
+DOWNLOAD_CACHE_MAX_BYTES = 5 * 1024**3
+# Hand cache hits to the front-end server instead of streaming them from Django,
+# e.g. "X-Accel-Redirect" with a prefix pointing at an internal nginx location
+# for DOWNLOAD_CACHE_DIR (see also EXPORT_JOB_SENDFILE_PREFIX).
+DOWNLOAD_CACHE_SENDFILE_HEADER = None
+DOWNLOAD_CACHE_SENDFILE_PREFIX = ""
+
+# Queued exports (POST /export/), built by `manage.py export_worker`. Archives
+# are deleted EXPORT_JOB_TTL seconds after they finish; a running job whose
+# worker has not reported for EXPORT_JOB_STALE_SECONDS is queued again. Workers
+# report every EXPORT_JOB_HEARTBEAT_SECONDS, whatever the export is doing.
+EXPORT_JOB_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "export_jobs"
+)
+EXPORT_JOB_TTL = 24 * 3600
+EXPORT_JOB_STALE_SECONDS = 600
+EXPORT_JOB_HEARTBEAT_SECONDS = 30
+# With DOWNLOAD_CACHE_SENDFILE_HEADER set, finished exports are handed to the
+# front-end server too, at this internal location of EXPORT_JOB_DIR
+EXPORT_JOB_SENDFILE_PREFIX = ""
+EXPORT_WORKERS = 2
+
+# Per-cruise export shards, rebuilt at the end of psql_add and stream_load (or
+# by hand with `manage.py build_shards`)
+EXPORT_SHARD_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "export_shards"
+)
+# Shards of the previous data version are always kept; older versions are
+# removed once their successor is EXPORT_SHARD_GRACE seconds old, so that
+# downloads still streaming them can finish.
+EXPORT_SHARD_GRACE = 6 * 3600
+
+# Record the peak traced memory of each request in /metrics. tracemalloc
+# slows allocations down, so leave this off unless investigating memory.
+METRICS_TRACE_MEMORY = os.getenv("METRICS_TRACE_MEMORY", "") == "1"
+# /metrics is served to requests with `Authorization: Bearer <METRICS_TOKEN>`
+# and, once an operator lists them, to these client addresses (REMOTE_ADDR).
+# The address list is only safe when nothing proxies the app: behind nginx or
+# any local proxy every request comes from the proxy's address, so leave it
+# empty there and use the token. Empty by default, so only the token works.
+METRICS_ALLOWED_IPS = [
+    ip.strip() for ip in os.getenv("METRICS_ALLOWED_IPS", "").split(",") if ip.strip()
+]
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Profiling of single requests that carry a token from `manage.py
+# profile_token` (see maritimeapp.profiling). Traces are written to
+# PROFILER_DIR, which keeps the newest PROFILER_MAX_FILES of them;
+# PROFILER_ENGINE is "sample", "cprofile" or "pyinstrument".
+PROFILER_ENABLED = os.getenv("DJANGO_PROFILER", "") == "1"
+PROFILER_ENGINE = os.getenv("DJANGO_PROFILER_ENGINE", "sample")
+PROFILER_INTERVAL = 0.001
+PROFILER_TOKEN_MAX_AGE = 3600
+PROFILER_MAX_FILES = 100
+PROFILER_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "profiles"
+)
+
+# Browser/CDN lifetime (seconds) of /tiles/ responses. Expired tiles are
+# revalidated against their ETag, which only changes after an import.
+TILE_CACHE_MAX_AGE = 3600
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -17,7 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from maritimeapp.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/maritimeapp/', include('maritimeapp.urls'))
+    path('api/maritimeapp/', include('maritimeapp.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
@@ -0,0 +1,10 @@
+"""
+Benchmark suite for the API views and the ingest commands.
+
+* generate: synthetic AERONET MAN files (any number of cruises and points)
+* loader: loads them with import_dd/psql_add or stream_load, timed
+* scenarios: cold and warm requests against every view
+* harness: latency, rows/s, peak RSS and query counts, written as JSON
+
+Run it with `manage.py benchmark` against a scratch PostGIS database.
+"""
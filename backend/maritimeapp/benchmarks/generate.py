@@ -0,0 +1,324 @@
+"""
+Synthetic MAN dataset in the layout of All_MAN_Data_V3.tar.gz.
+
+Every cruise gets the fourteen files import_dd expects: all_points at levels
+1.0/1.5/2.0 and series and daily at levels 1.5/2.0, each as AOD (`.levNN`)
+and SDA (`.ONEILL_NN`). The column labels are those understood by
+maritimeapp.ingest, in the order AERONET writes them. Values follow a ship
+track with a plausible AOD spectrum, cloud screening removes observations
+between levels, series and daily files average the screened points, and the
+usual -999 fill values appear where a channel is missing.
+
+Like ingest, this module imports nothing from Django.
+"""
+
+import math
+import os
+import random
+import statistics
+import tarfile
+from datetime import date, datetime, timedelta
+
+from ..ingest import AOD_COLUMNS, SDA_COLUMNS
+
+MISSING = "-999.000000"
+FIRST_DAY = date(2004, 10, 16)
+POLICY_TEXT = "Synthetic MAN benchmark data. Not for scientific use.\n"
+
+# (frequency token, level) pairs written per cruise, as found in the tarball
+PRODUCTS = [
+    ("all_points", "10"),
+    ("all_points", "15"),
+    ("all_points", "20"),
+    ("series", "15"),
+    ("series", "20"),
+    ("daily", "15"),
+    ("daily", "20"),
+]
+
+LEVEL_NAMES = {
+    "10": "Level 1.0 Unscreened",
+    "15": "Level 1.5 Cloud Screened",
+    "20": "Level 2.0 Quality Assured",
+}
+
+# Share of the level 1.0 observations surviving each level's screening
+SCREENING = {"10": 1.0, "15": 0.8, "20": 0.65}
+
+# Observations averaged into one series entry
+SERIES_LENGTH = 5
+
+WAVELENGTHS = {
+    "340": 340,
+    "380": 380,
+    "440": 440,
+    "500": 500,
+    "675": 675,
+    "870": 870,
+    "1020": 1020,
+    "1640": 1640,
+}
+
+
+def _aod_labels(averaged):
+    return [
+        label
+        for label in AOD_COLUMNS
+        if averaged or not (label.startswith("STD_") or label.startswith("Number_"))
+    ]
+
+
+def _sda_labels(averaged):
+    if averaged:
+        return [
+            label
+            for label in SDA_COLUMNS
+            if label not in ("Solar_Zenith_Angle", "Air_Mass")
+        ]
+    return [
+        label
+        for label in SDA_COLUMNS
+        if not (label.startswith("STDEV-") or label.startswith("Number_"))
+    ]
+
+
+def file_labels(datatype, freq):
+    """Column labels of one file, with the position columns after the third."""
+    averaged = freq != "all_points"
+    labels = _aod_labels(averaged) if datatype == "AOD" else _sda_labels(averaged)
+    return labels[:3] + ["Latitude", "Longitude"] + labels[3:]
+
+
+def file_name(cruise, datatype, freq, level):
+    suffix = f"lev{level}" if datatype == "AOD" else f"ONEILL_{level}"
+    return f"{cruise}_{freq}.{suffix}"
+
+
+def _spectral(aod500, alpha, wavelength):
+    return aod500 * (wavelength / 500.0) ** -alpha
+
+
+def cruise_observations(number, points, rng):
+    """The level 1.0 observations of one cruise, along a random ship track."""
+    lng = rng.uniform(-180.0, 180.0)
+    lat = rng.uniform(-60.0, 60.0)
+    heading = rng.uniform(0.0, 2 * math.pi)
+    day = FIRST_DAY + timedelta(days=rng.randrange(0, 7000))
+    per_day = rng.randint(10, 40)
+    background = rng.uniform(0.05, 0.3)
+    has_1640 = rng.random() < 0.5
+
+    observations = []
+    seconds = 6 * 3600
+    for index in range(points):
+        if index and index % per_day == 0:
+            day += timedelta(days=1 + (rng.random() < 0.2) * rng.randint(1, 5))
+            seconds = 6 * 3600
+        seconds += rng.randint(60, 12 * 3600 // per_day)
+        heading += rng.gauss(0.0, 0.2)
+        lng = (lng + 0.02 * math.cos(heading) + 180.0) % 360.0 - 180.0
+        lat = max(-80.0, min(80.0, lat + 0.02 * math.sin(heading)))
+        hour = min(seconds, 86399) / 3600.0
+        zenith = min(85.0, 20.0 + abs(hour - 12.0) * 10.0 + abs(lat) / 3.0)
+        observations.append(
+            {
+                "index": index,
+                "day": day,
+                "seconds": min(seconds, 86399),
+                "lat": lat,
+                "lng": lng,
+                "aod500": max(0.005, rng.lognormvariate(math.log(background), 0.4)),
+                "alpha": rng.uniform(0.1, 1.8),
+                "fmf": rng.uniform(0.1, 0.95),
+                "water_vapor": rng.uniform(0.5, 5.0),
+                "zenith": zenith,
+                "cloud": rng.random(),
+                "has_1640": has_1640,
+                "aeronet_number": number,
+                "microtops_number": 10000 + number,
+            }
+        )
+    return observations
+
+
+def _mean_observation(group):
+    """Average a group of observations into one series or daily entry."""
+    mean = dict(group[0])
+    for name in ("lat", "lng", "aod500", "alpha", "fmf", "water_vapor", "zenith"):
+        mean[name] = statistics.fmean(obs[name] for obs in group)
+    mean["seconds"] = int(statistics.fmean(obs["seconds"] for obs in group))
+    mean["spread"] = statistics.pstdev(obs["aod500"] for obs in group)
+    mean["count"] = len(group)
+    return mean
+
+
+def product_observations(observations, freq, level):
+    screened = [obs for obs in observations if obs["cloud"] < SCREENING[level]]
+    if freq == "all_points":
+        return screened
+    groups = {}
+    for obs in screened:
+        if freq == "daily":
+            key = obs["day"]
+        else:
+            key = (obs["day"], obs["index"] // SERIES_LENGTH)
+        groups.setdefault(key, []).append(obs)
+    return [_mean_observation(group) for group in groups.values()]
+
+
+def _number(value):
+    return f"{value:.6f}"
+
+
+def _date(day):
+    return day.strftime("%d:%m:%Y")
+
+
+def _value(label, obs, processed):
+    """The text of one column for one observation."""
+    spread = obs.get("spread", 0.0)
+    if label == "Date(dd:mm:yyyy)":
+        return _date(obs["day"])
+    if label == "Time(hh:mm:ss)":
+        seconds = obs["seconds"]
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    if label == "Last_Processing_Date(dd:mm:yyyy)":
+        return _date(processed)
+    if label == "Latitude":
+        return _number(obs["lat"])
+    if label == "Longitude":
+        return _number(obs["lng"])
+    if label == "AERONET_Number":
+        return str(obs["aeronet_number"])
+    if label == "Microtops_Number":
+        return str(obs["microtops_number"])
+    if label == "Number_of_Observations":
+        return str(obs.get("count", 1))
+    if label == "Julian_Day":
+        day = obs["day"]
+        return _number(day.timetuple().tm_yday + obs["seconds"] / 86400.0)
+    if label in ("Air Mass", "Air_Mass"):
+        return _number(1.0 / math.cos(math.radians(obs["zenith"])))
+    if label == "Solar_Zenith_Angle":
+        return _number(obs["zenith"])
+
+    channel = next((name for name in WAVELENGTHS if label.endswith(f"{name}nm")), None)
+    if label.startswith(("AOD_", "STD_")) and channel is not None:
+        if channel == "1640" and not obs["has_1640"]:
+            return MISSING
+        aod = _spectral(obs["aod500"], obs["alpha"], WAVELENGTHS[channel])
+        if label.startswith("STD_"):
+            aod *= spread / obs["aod500"]
+        return _number(aod)
+    if label.endswith("nm_Input_AOD"):
+        channel = label.split("-")[-1].split("nm")[0]
+        aod = _spectral(obs["aod500"], obs["alpha"], WAVELENGTHS[channel])
+        return _number(aod if not label.startswith("STDEV") else spread)
+    if label.startswith("STDEV-"):
+        return _number(spread * 0.5)
+    if label.startswith("Water Vapor"):
+        return _number(obs["water_vapor"])
+    if label.startswith("STD_Water"):
+        return _number(spread * 2.0)
+    if "Angstrom_Exponent" in label and "STD" in label:
+        return _number(spread)
+    if "Angstrom_Exponent" in label or "(alpha)" in label:
+        return _number(obs["alpha"])
+    if label.startswith("Total_AOD"):
+        return _number(obs["aod500"])
+    if label.startswith("Fine_Mode_AOD"):
+        return _number(obs["aod500"] * obs["fmf"])
+    if label.startswith("Coarse_Mode_AOD"):
+        return _number(obs["aod500"] * (1.0 - obs["fmf"]))
+    if label.startswith("FineModeFraction"):
+        return _number(obs["fmf"])
+    if label.startswith("CoarseModeFraction"):
+        return _number(1.0 - obs["fmf"])
+    if label.startswith("AE_Fine_Mode"):
+        return _number(obs["alpha"] + 0.8)
+    if label.startswith("dAE/dln"):
+        return _number(-0.2 * obs["alpha"])
+    # Fit errors and RMSEs
+    return _number(0.01 + spread * 0.1)
+
+
+def preamble(cruise, number, datatype, freq, level):
+    product = "AOD" if datatype == "AOD" else "SDA Retrieval"
+    return [
+        f"Maritime Aerosol Network (MAN) Version 3: {product} {freq}\n",
+        f"{cruise},Synthetic benchmark cruise {number}\n",
+        f"Version 3: {LEVEL_NAMES[level]}\n",
+        f"PI=Benchmark PI {number},Email=pi{number}@example.org\n",
+    ]
+
+
+def write_file(path, lines, labels, observations, processed):
+    with open(path, "w", encoding="latin-1") as f:
+        f.writelines(lines)
+        f.write(",".join(labels) + "\n")
+        for obs in observations:
+            f.write(",".join(_value(label, obs, processed) for label in labels))
+            f.write("\n")
+
+
+def generate_cruise(directory, number, points, rng):
+    """Write the fourteen files of one cruise, returning (cruise, rows)."""
+    cruise = f"Benchmark_{number:04d}"
+    cruise_dir = os.path.join(directory, cruise)
+    os.makedirs(cruise_dir, exist_ok=True)
+    observations = cruise_observations(number, points, rng)
+    last_day = observations[-1]["day"] if observations else FIRST_DAY
+    processed = last_day + timedelta(days=30)
+
+    rows = 0
+    for freq, level in PRODUCTS:
+        entries = product_observations(observations, freq, level)
+        for datatype in ("AOD", "SDA"):
+            write_file(
+                os.path.join(cruise_dir, file_name(cruise, datatype, freq, level)),
+                preamble(cruise, number, datatype, freq, level),
+                file_labels(datatype, freq),
+                entries,
+                processed,
+            )
+            rows += len(entries)
+    return cruise, rows
+
+
+def generate_dataset(directory, cruises, points, seed=0, log=print):
+    """
+    Write `cruises` cruises of `points` level 1.0 observations each under
+    `directory` (one sub-directory per cruise, as in the MAN tarball).
+    Returns a summary dict.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "data_usage_policy.txt"), "w") as f:
+        f.write(POLICY_TEXT)
+
+    started = datetime.now()
+    rows = 0
+    names = []
+    for number in range(cruises):
+        cruise, cruise_rows = generate_cruise(directory, number, points, rng)
+        names.append(cruise)
+        rows += cruise_rows
+    log(
+        f"Generated {cruises} cruises ({rows} rows, "
+        f"{cruises * len(PRODUCTS) * 2} files) in {directory}"
+    )
+    return {
+        "cruises": names,
+        "points": points,
+        "seed": seed,
+        "rows": rows,
+        "files": cruises * len(PRODUCTS) * 2,
+        "seconds": (datetime.now() - started).total_seconds(),
+    }
+
+
+def write_tarball(directory, path):
+    """Pack a generated dataset as a .tar.gz that stream_load --tarball reads."""
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(directory, arcname="All_MAN_Data_V3")
+    return path
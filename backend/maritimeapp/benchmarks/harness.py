@@ -0,0 +1,216 @@
+"""
+Timing harness: latency, rows/s, peak RSS and query count per scenario.
+
+`measure` runs a callable `repeat` times. With `cold=True` the first run is
+reported separately as the cold (empty cache) latency and the others as the
+warm latency distribution. Results are plain dicts so that the JSON file
+written by `write_results` can be diffed between releases with `compare`.
+"""
+
+import json
+import os
+import platform
+import resource
+import statistics
+import threading
+import time
+
+from django import get_version
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class QueryCounter:
+    """
+    Count the SQL statements executed while the block is active, on the
+    current thread's connection and on every connection opened meanwhile (the
+    download producer threads open their own).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, wrapper):
+        if self not in wrapper.execute_wrappers:
+            wrapper.execute_wrappers.append(self)
+            self._wrapped.append(wrapper)
+
+    def _connection_created(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def __enter__(self):
+        self._attach(connection)
+        connection_created.connect(self._connection_created)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._connection_created)
+        for wrapper in self._wrapped:
+            if self in wrapper.execute_wrappers:
+                wrapper.execute_wrappers.remove(self)
+        self._wrapped = []
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # Process high-water mark (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRss:
+    """Sample the RSS on a background thread, keeping the peak of the block."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_once(run):
+    """Run `run` once, returning (seconds, outcome, queries, peak RSS bytes)."""
+    with PeakRss() as rss, QueryCounter() as queries:
+        start = time.perf_counter()
+        outcome = run()
+        seconds = time.perf_counter() - start
+    return seconds, outcome, queries.count, rss.peak
+
+
+def measure(name, run, repeat=5, cold=True, reset=None):
+    """
+    Time `run`, which returns the number of rows it produced (or a
+    (rows, bytes) pair). `reset` is called before the cold run, outside the
+    timed region, to empty the caches the scenario would otherwise hit.
+    """
+    if reset is not None:
+        reset()
+
+    samples = []
+    for _ in range(max(repeat, 1) + (1 if cold else 0)):
+        seconds, outcome, queries, peak = run_once(run)
+        rows, size = outcome if isinstance(outcome, tuple) else (outcome, None)
+        samples.append(
+            {
+                "seconds": seconds,
+                "rows": rows,
+                "bytes": size,
+                "queries": queries,
+                "peak_rss": peak,
+            }
+        )
+
+    result = {"name": name, "repeat": max(repeat, 1)}
+    if cold:
+        first = samples.pop(0)
+        result["cold_ms"] = round(first["seconds"] * 1000, 3)
+        result["cold_queries"] = first["queries"]
+
+    latencies = [sample["seconds"] for sample in samples]
+    median = statistics.median(latencies)
+    last = samples[-1]
+    result.update(
+        {
+            "latency_ms": {
+                "min": round(min(latencies) * 1000, 3),
+                "median": round(median * 1000, 3),
+                "p95": round(_percentile(latencies, 0.95) * 1000, 3),
+                "max": round(max(latencies) * 1000, 3),
+            },
+            "rows": last["rows"],
+            "rows_per_second": (
+                round(last["rows"] / median, 1)
+                if last["rows"] is not None and median > 0
+                else None
+            ),
+            "bytes": last["bytes"],
+            "queries": last["queries"],
+            "peak_rss_mb": round(
+                max(sample["peak_rss"] for sample in samples) / 1024**2, 1
+            ),
+        }
+    )
+    return result
+
+
+def environment():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT version(), postgis_lib_version()")
+        postgres, postgis = cursor.fetchone()
+    return {
+        "python": platform.python_version(),
+        "django": get_version(),
+        "postgres": postgres,
+        "postgis": postgis,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path, results, meta):
+    """Write the results as stable, sorted JSON so that runs diff cleanly."""
+    payload = {
+        "meta": meta,
+        "results": {result["name"]: result for result in results},
+    }
+    with open(path, "w") as f:
+        json.dump(payload, f, indent=2, sort_keys=True, default=str)
+        f.write("\n")
+    return payload
+
+
+def compare(previous, current, threshold=0.1):
+    """
+    Lines comparing the median latency of two result files, flagging changes
+    larger than `threshold` (a fraction).
+    """
+    lines = []
+    before = previous.get("results", {})
+    for name, result in sorted(current["results"].items()):
+        new = result["latency_ms"]["median"]
+        old = before.get(name, {}).get("latency_ms", {}).get("median")
+        if not old:
+            lines.append(f"{name:<40}{new:>12.1f} ms  (new)")
+            continue
+        change = (new - old) / old
+        flag = ""
+        if change > threshold:
+            flag = "  slower"
+        elif change < -threshold:
+            flag = "  faster"
+        lines.append(f"{name:<40}{old:>12.1f} ->{new:>10.1f} ms {change:+8.1%}{flag}")
+    return lines
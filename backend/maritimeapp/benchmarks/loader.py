@@ -0,0 +1,117 @@
+"""
+Load a generated dataset into the configured (local PostGIS) database with
+the real ingest commands, timing each of them.
+
+import_dd and psql_add work relative to the current directory (./src,
+./src_csvs), so the commands run from the benchmark work directory. The
+tables are emptied first; never point this at a database you want to keep.
+"""
+
+import os
+import shutil
+from contextlib import contextmanager
+
+from django.core.management import call_command
+from django.db import connection
+
+from ..models import (DataVersion, DownloadAODAP, DownloadAODDaily,
+                      DownloadAODSeries, DownloadSDAAP, DownloadSDADaily,
+                      DownloadSDASeries, ExportJob, Site, SiteSpan, SiteTrack,
+                      SourceFile, TableHeader)
+from .generate import write_tarball
+from .harness import measure
+
+MEASUREMENT_MODELS = [
+    DownloadAODAP,
+    DownloadAODDaily,
+    DownloadAODSeries,
+    DownloadSDAAP,
+    DownloadSDADaily,
+    DownloadSDASeries,
+]
+
+RESET_MODELS = MEASUREMENT_MODELS + [
+    Site,
+    SiteSpan,
+    SiteTrack,
+    SourceFile,
+    TableHeader,
+    ExportJob,
+]
+
+TARBALL = "All_MAN_Data_V3.tar.gz"
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def measurement_rows():
+    return sum(model.objects.count() for model in MEASUREMENT_MODELS)
+
+
+def has_data():
+    return Site.objects.exists() or DownloadAODDaily.objects.exists()
+
+
+def reset_tables():
+    """Empty every table the ingest commands and the benchmark write to."""
+    tables = ", ".join(
+        connection.ops.quote_name(model._meta.db_table) for model in RESET_MODELS
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"TRUNCATE {tables} RESTART IDENTITY")
+    DataVersion.bump()
+
+
+def converted_rows():
+    """Data rows of the CSVs import_dd wrote to ./src_csvs."""
+    rows = 0
+    for name in os.listdir("src_csvs"):
+        if name.endswith(".csv") and name != "sites.csv":
+            with open(os.path.join("src_csvs", name), "rb") as f:
+                rows += max(sum(1 for _ in f) - 1, 0)
+    return rows
+
+
+def _command(name, *args, rows=measurement_rows):
+    def run():
+        with open(os.devnull, "w") as devnull:
+            call_command(name, *args, stdout=devnull)
+        return rows()
+
+    return run
+
+
+def load_dataset(workdir, loader="psql_add", log=print):
+    """
+    Reset the tables and ingest `workdir/src` with `loader` ("psql_add", i.e.
+    import_dd followed by psql_add --parallel, or "stream_load" from a
+    tarball), then build the export shards. Returns one result per command.
+    """
+    results = []
+    with working_directory(workdir):
+        reset_tables()
+        if loader == "stream_load":
+            write_tarball("src", TARBALL)
+            steps = [
+                ("ingest.stream_load", _command("stream_load", "--tarball", TARBALL))
+            ]
+        else:
+            shutil.rmtree("src_csvs", ignore_errors=True)
+            steps = [
+                ("ingest.import_dd", _command("import_dd", rows=converted_rows)),
+                ("ingest.psql_add", _command("psql_add", "--parallel")),
+            ]
+        steps.append(("ingest.build_shards", _command("build_shards")))
+
+        for name, run in steps:
+            log(f"Running {name}")
+            results.append(measure(name, run, repeat=1, cold=False))
+    return results
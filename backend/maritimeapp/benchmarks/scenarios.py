@@ -0,0 +1,254 @@
+"""
+Timed requests against every API view, made through Django's AsyncClient so
+that the async views run as they do under ASGI (streamed downloads included).
+
+Each scenario is measured cold (caches emptied first) and then warm. Rows are
+counted from the response where it carries them; for zip downloads they are
+counted in the database beforehand, outside the timed region.
+"""
+
+import io
+import json
+import os
+import shutil
+from functools import partial
+
+import pyarrow as pa
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.db.models import Max, Min
+from django.test import AsyncClient
+
+from ..download_cache import cache_dir
+from ..downloads import build_export_plan, parse_download_request
+from ..export_jobs import claim_job, run_job
+from ..measurements import ARROW_CONTENT_TYPE
+from ..models import Site, SiteSpan
+from .harness import measure
+
+API = "/api/maritimeapp"
+READING = "aod_500nm"
+SAMPLE_SITES = 10
+# Roughly the tropical Atlantic and Indian Ocean
+BBOX = {"min_lat": -30, "min_lng": -60, "max_lat": 30, "max_lng": 90}
+
+
+class ScenarioError(Exception):
+    pass
+
+
+async def _fetch(client, method, path, body=None):
+    """Make one request, draining streamed bodies; returns (response, content)."""
+    if method == "POST":
+        response = await client.post(
+            path, data=json.dumps(body), content_type="application/json"
+        )
+    else:
+        response = await client.get(path, body or {})
+
+    if response.status_code >= 400:
+        raise ScenarioError(f"{method} {path}: HTTP {response.status_code}")
+    if not response.streaming:
+        return response, response.content
+
+    size = 0
+    if response.is_async:
+        async for chunk in response.streaming_content:
+            size += len(chunk)
+    else:
+        for chunk in response.streaming_content:
+            size += len(chunk)
+    response.close()
+    return response, size
+
+
+def fetch(client, method, path, body=None):
+    return async_to_sync(_fetch)(client, method, path, body)
+
+
+def count_rows(response, content):
+    """Rows in a JSON or Arrow response; None for other bodies."""
+    content_type = response.get("Content-Type", "")
+    if content_type.startswith(ARROW_CONTENT_TYPE):
+        return pa.ipc.open_stream(io.BytesIO(content)).read_all().num_rows
+    if not content_type.startswith("application/json"):
+        return None
+    payload = json.loads(content)
+    if isinstance(payload, list):
+        return len(payload)
+    for name in ("value", "opts", "stats"):
+        if name in payload:
+            return len(payload[name])
+    return None
+
+
+def request_run(client, method, path, body=None, rows=None):
+    """A `measure` callable making one request; `rows` overrides the count."""
+
+    def run():
+        response, content = fetch(client, method, path, body)
+        if isinstance(content, int):
+            return rows, content
+        counted = rows if rows is not None else count_rows(response, content)
+        return counted, len(content)
+
+    return run
+
+
+def download_rows(body):
+    """Rows a download archive will contain, counted in the database."""
+    return sum(
+        entry.queryset.count()
+        for entry in build_export_plan(parse_download_request(body))
+    )
+
+
+def export_run(client, body, rows):
+    """Submit an export, build it in-process as export_worker would, fetch it."""
+
+    def run():
+        _, content = fetch(client, "POST", f"{API}/export/", body)
+        job_id = json.loads(content)["job"]
+        job = claim_job()
+        if job is None or not run_job(job):
+            raise ScenarioError(f"export {job_id} failed")
+        fetch(client, "GET", f"{API}/export/{job_id}/")
+        _, size = fetch(client, "GET", f"{API}/export/{job_id}/file/")
+        return rows, size
+
+    return run
+
+
+def reset_caches():
+    """Empty the view cache and the download archive cache."""
+    cache.clear()
+    directory = cache_dir()
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def date_window():
+    """The middle third of the loaded date range, as ISO strings."""
+    span = SiteSpan.objects.aggregate(start=Min("start_date"), end=Max("end_date"))
+    if span["start"] is None:
+        return None, None
+    third = (span["end"] - span["start"]) / 3
+    return (span["start"] + third).isoformat(), (span["end"] - third).isoformat()
+
+
+def scenarios(client):
+    """(name, run) pairs covering every API view."""
+    sites = list(Site.objects.order_by("name").values_list("name", flat=True))
+    sample = sites[:SAMPLE_SITES]
+    start_date, end_date = date_window()
+    dates = {"start_date": start_date, "end_date": end_date}
+    post = partial(request_run, client, "POST")
+    get = partial(request_run, client, "GET")
+
+    downloads = {
+        "csv.shards": {
+            "sites": sites,
+            "retrievals": ["AOD", "SDA"],
+            "frequency": ["Daily", "Series"],
+            "quality": ["Level 1.5", "Level 2.0"],
+        },
+        "csv.dates": {
+            "sites": sites,
+            "retrievals": ["AOD", "SDA"],
+            "frequency": ["Daily", "Series"],
+            "quality": ["Level 1.5", "Level 2.0"],
+            **dates,
+        },
+        "csv.bbox": {
+            "sites": sites,
+            "retrievals": ["AOD"],
+            "frequency": ["Daily"],
+            "quality": ["Level 1.5"],
+            **BBOX,
+        },
+        "csv.all_points": {
+            "sites": sites,
+            "retrievals": ["AOD"],
+            "frequency": ["Point"],
+            "quality": ["Level 1.0"],
+        },
+        "parquet": {
+            "sites": sites,
+            "retrievals": ["AOD"],
+            "frequency": ["Daily", "Point"],
+            "quality": ["Level 1.5"],
+            "format": "parquet",
+        },
+        "arrow": {
+            "sites": sites,
+            "retrievals": ["AOD"],
+            "frequency": ["Daily", "Point"],
+            "quality": ["Level 1.5"],
+            "format": "arrow",
+        },
+    }
+
+    runs = [
+        ("set_csrf", get(f"{API}/set-csrf/")),
+        ("display_info", get(f"{API}/display_info/")),
+        ("list_sites", get(f"{API}/measurements/sites/")),
+        ("list_sites.bbox", get(f"{API}/measurements/sites/", {**BBOX, **dates})),
+        (
+            "site_measurements.rows",
+            post(f"{API}/measurements/", {"reading": READING, "sites": sample}),
+        ),
+        (
+            "site_measurements.columnar",
+            post(
+                f"{API}/measurements/",
+                {"reading": READING, "sites": sample, "format": "columnar"},
+            ),
+        ),
+        (
+            "site_measurements.arrow",
+            post(
+                f"{API}/measurements/",
+                {"reading": READING, "sites": sample, "format": "arrow"},
+            ),
+        ),
+        (
+            "site_measurements.downsampled",
+            post(
+                f"{API}/measurements/",
+                {"reading": READING, "sites": sites, "max_points": 1000},
+            ),
+        ),
+        (
+            "site_stats.monthly",
+            post(
+                f"{API}/stats/",
+                {"reading": READING, "sites": sites, "period": "month"},
+            ),
+        ),
+        ("measurement_tile.z0", get(f"{API}/tiles/{READING}/0/0/0.mvt")),
+        ("measurement_tile.z3", get(f"{API}/tiles/{READING}/3/2/3.mvt")),
+    ]
+    for name, body in downloads.items():
+        runs.append(
+            (
+                f"download_data.{name}",
+                post(f"{API}/download/", body, rows=download_rows(body)),
+            )
+        )
+    body = downloads["csv.dates"]
+    runs.append(("export_job", export_run(client, body, download_rows(body))))
+    return runs
+
+
+def run_scenarios(repeat=5, only=None, log=print):
+    client = AsyncClient()
+    results = []
+    for name, run in scenarios(client):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        log(f"Running {name}")
+        # Exports are written to disk and never served from a cache
+        cold = name != "export_job"
+        results.append(measure(name, run, repeat=repeat, cold=cold, reset=reset_caches))
+    return results
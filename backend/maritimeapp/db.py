@@ -0,0 +1,98 @@
+"""
+Shared raw psycopg2 connections for the ingest commands.
+
+The commands COPY many files; instead of opening a connection per file they
+borrow from one process-wide ThreadedConnectionPool (sized by
+INGEST_POOL_SIZE, enough for psql_add --parallel's one connection per table).
+Connections are health-checked when borrowed and rolled back when returned,
+so a failed file never leaks an open transaction to the next one.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from django.conf import settings
+from psycopg2.pool import ThreadedConnectionPool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_params(alias="default"):
+    database = settings.DATABASES[alias]
+    return {
+        "dbname": database["NAME"],
+        "user": database["USER"],
+        "password": database["PASSWORD"],
+        "host": database["HOST"],
+        "port": database["PORT"],
+    }
+
+
+def connection_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(
+                1, getattr(settings, "INGEST_POOL_SIZE", 8), **db_params()
+            )
+        return _pool
+
+
+def _healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def borrow_connection():
+    """
+    Take a healthy connection from the pool (see return_connection).
+
+    Connections failing the check are closed and the next one is tried. Once
+    the idle ones are used up the pool opens new ones, so after a server
+    restart every stale connection is drained before giving up.
+    """
+    pool = connection_pool()
+    for _ in range(pool.maxconn + 1):
+        conn = pool.getconn()
+        if _healthy(conn):
+            return conn
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("No healthy connection to the database")
+
+
+def return_connection(conn):
+    """Hand a connection back, rolling back anything left uncommitted."""
+    broken = conn.closed
+    if not broken:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    connection_pool().putconn(conn, close=bool(broken))
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection for the duration of a `with` block."""
+    conn = borrow_connection()
+    try:
+        yield conn
+    finally:
+        return_connection(conn)
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
@@ -0,0 +1,109 @@
+"""
+Tables derived from the measurement data, rebuilt after each import.
+
+These are computed with set-based SQL over the Download* tables so a refresh
+costs a handful of statements regardless of how many cruises were loaded.
+"""
+
+from django.db import connection, transaction
+
+from .ingest import TABLES
+
+# Product whose span is shown on the map and stored in Site.span_date
+SITE_SPAN_PRODUCT = ("AOD", "Daily", 15)
+
+# Grid (degrees) the daily positions are snapped to before being collected
+# into SiteTrack.track; ~100 m, well below what a map viewport can resolve
+TRACK_GRID_DEGREES = 0.001
+
+
+def refresh_site_spans():
+    """
+    Recompute SiteSpan for every cruise, product and level in one statement,
+    then copy the map product's span onto Site.span_date.
+
+    This is the only place span_date is written: saving a Site no longer
+    recomputes it, so it stays stale until the next import refreshes it here.
+    """
+    selects = [
+        f"""
+        SELECT cruise, '{datatype}', '{freq}', level,
+               MIN("date_DD_MM_YYYY"), MAX("date_DD_MM_YYYY")
+        FROM {table_name}
+        GROUP BY cruise, level
+        """
+        for (datatype, freq), table_name in TABLES.items()
+    ]
+    datatype, freq, level = SITE_SPAN_PRODUCT
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM maritimeapp_sitespan")
+        cursor.execute(
+            "INSERT INTO maritimeapp_sitespan "
+            "(cruise, datatype, freq, level, start_date, end_date) "
+            + " UNION ALL ".join(selects)
+        )
+        cursor.execute(
+            """
+            UPDATE maritimeapp_site AS site
+            SET span_date = ARRAY[span.start_date, span.end_date]
+            FROM maritimeapp_sitespan AS span
+            WHERE span.cruise = site.name
+            AND span.datatype = %s AND span.freq = %s AND span.level = %s
+            """,
+            [datatype, freq, level],
+        )
+        return cursor.rowcount
+
+
+def refresh_site_tracks():
+    """
+    Rebuild SiteTrack: per cruise and level, the envelope of all measurements
+    plus the snapped daily AOD positions as a MultiPoint.
+    """
+    points = " UNION ALL ".join(
+        f"SELECT cruise, level, coordinates FROM {table_name}"
+        for table_name in TABLES.values()
+    )
+    daily_table = TABLES[("AOD", "Daily")]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM maritimeapp_sitetrack")
+        cursor.execute(
+            f"""
+            INSERT INTO maritimeapp_sitetrack
+                (cruise, level, envelope, track, point_count)
+            SELECT extent.cruise, extent.level, extent.envelope,
+                   daily.track, COALESCE(daily.point_count, 0)
+            FROM (
+                SELECT cruise, level,
+                       ST_SetSRID(
+                           ST_Expand(ST_Extent(coordinates), 1e-9)::geometry, 4326
+                       ) AS envelope
+                FROM ({points}) AS measurements
+                GROUP BY cruise, level
+            ) AS extent
+            LEFT JOIN (
+                SELECT cruise, level,
+                       ST_Multi(ST_Collect(position)) AS track,
+                       COUNT(*) AS point_count
+                FROM (
+                    SELECT DISTINCT cruise, level,
+                           ST_SnapToGrid(coordinates, %s) AS position
+                    FROM {daily_table}
+                ) AS positions
+                GROUP BY cruise, level
+            ) AS daily
+            ON daily.cruise = extent.cruise AND daily.level = extent.level
+            """,
+            [TRACK_GRID_DEGREES],
+        )
+        return cursor.rowcount
+
+
+def refresh_derived_tables():
+    """Rebuild every derived table, returning {name: rows touched} for reporting."""
+    return {
+        "site spans": refresh_site_spans(),
+        "site tracks": refresh_site_tracks(),
+    }
@@ -0,0 +1,201 @@
+"""
+Content-addressed cache for download archives.
+
+Archives are stored as `<key>.zip` in DOWNLOAD_CACHE_DIR, where the key is a
+hash of the normalised download parameters, the export engine and the current
+DataVersion stamp. A miss streams the archive to the client while teeing it
+into the cache; a hit is served straight from disk (or handed to the front-end
+server through DOWNLOAD_CACHE_SENDFILE_HEADER). The directory is kept under
+DOWNLOAD_CACHE_MAX_BYTES by evicting the least recently used archives.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from .models import DataVersion
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+_range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def cache_dir():
+    return getattr(settings, "DOWNLOAD_CACHE_DIR", None)
+
+
+def normalise_params(params):
+    """Return a canonical, order-independent form of the download parameters."""
+    bounds = params["bounds"]
+    if bounds is not None:
+        bounds = {name: float(value) for name, value in sorted(bounds.items())}
+    return {
+        "sites": sorted(set(params["sites"])),
+        "retrievals": sorted(set(params["retrievals"])),
+        "frequency": sorted(set(params["frequency"])),
+        "quality": sorted(set(params["quality"])),
+        "start_date": params["start_date"],
+        "end_date": params["end_date"],
+        "bounds": bounds,
+        "format": params.get("format", "csv"),
+    }
+
+
+def cache_key(params, engine, data_version=None, extra=None):
+    if data_version is None:
+        data_version = DataVersion.cached()
+    payload = {
+        "params": normalise_params(params),
+        "engine": engine,
+        "data_version": data_version,
+        "extra": extra,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def cached_path(key):
+    directory = cache_dir()
+    if not directory:
+        return None
+    path = os.path.join(directory, f"{key}.zip")
+    if not os.path.isfile(path):
+        return None
+    # mtime doubles as the LRU clock
+    os.utime(path)
+    return path
+
+
+def evict(directory=None, max_bytes=None):
+    """Delete least recently used archives until the cache fits its budget."""
+    directory = directory or cache_dir()
+    if max_bytes is None:
+        max_bytes = getattr(settings, "DOWNLOAD_CACHE_MAX_BYTES", 0)
+    if not directory or not max_bytes or not os.path.isdir(directory):
+        return
+
+    archives = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(".zip"):
+            stat = entry.stat()
+            archives.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in archives)
+    for _, size, path in sorted(archives):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def tee_to_cache(key, chunks):
+    """
+    Yield `chunks` unchanged while writing them to the cache.
+
+    The archive only becomes visible under its key once it has been streamed
+    completely, so an aborted download never leaves a truncated entry behind.
+    """
+    directory = cache_dir()
+    if not directory:
+        yield from chunks
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    final_path = os.path.join(directory, f"{key}.zip")
+    part_path = os.path.join(
+        directory, f".{key}.{os.getpid()}.{threading.get_ident()}.part"
+    )
+    complete = False
+    try:
+        with open(part_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(part_path, final_path)
+        complete = True
+        evict(directory)
+    finally:
+        if not complete and os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def _iter_file_range(f, start, length):
+    with f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def serve_cached(request, path, filename, sendfile_prefix=""):
+    """
+    Serve a cached archive, honouring single `Range: bytes=` requests.
+
+    The archive is opened before the response is built and served from that
+    handle, so eviction cannot cut a response short. Raises FileNotFoundError
+    when the archive has been evicted since `cached_path` returned it.
+
+    With DOWNLOAD_CACHE_SENDFILE_HEADER set the file is handed to the
+    front-end server instead, at `sendfile_prefix` + its name (or its path
+    without a prefix): the internal location of the directory it lives in.
+    """
+    disposition = f'attachment; filename="{filename}"'
+
+    sendfile_header = getattr(settings, "DOWNLOAD_CACHE_SENDFILE_HEADER", None)
+    if sendfile_header:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        # e.g. X-Accel-Redirect (nginx) or X-Sendfile (Apache/lighttpd)
+        location = (
+            os.path.join(sendfile_prefix, os.path.basename(path))
+            if sendfile_prefix
+            else path
+        )
+        response = HttpResponse(content_type="application/zip")
+        response[sendfile_header] = location
+        response["Content-Disposition"] = disposition
+        return response
+
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    match = _range_re.match(request.headers.get("Range", "").strip())
+    if match and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+            end = size - 1
+        if start > end or start >= size:
+            f.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            _iter_file_range(f, start, length),
+            status=206,
+            content_type="application/zip",
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(length)
+    else:
+        response = FileResponse(f, content_type="application/zip")
+
+    response["Accept-Ranges"] = "bytes"
+    response["Content-Disposition"] = disposition
+    return response
@@ -0,0 +1,575 @@
+"""
+Archive building for the download view.
+
+A download request is normalised into a parameter dict, turned into an export
+plan (one entry per retrieval/frequency/level that has matching rows) and then
+streamed as a zip. Each CSV member is encoded in chunks straight into an
+in-process zip stream, so nothing is written to disk and memory per request is
+bounded by the row chunk size rather than by the size of the archive.
+"""
+
+import asyncio
+import contextvars
+import csv
+import io
+import os
+import queue
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.gis.geos import Point, Polygon
+from django.db import connections
+from django.db.models import Q
+
+from .models import (DownloadAODAP, DownloadAODDaily, DownloadAODSeries,
+                     DownloadSDAAP, DownloadSDADaily, DownloadSDASeries,
+                     SiteTrack, TableHeader)
+from .metrics import record_query, record_rows
+
+# Model field name -> AERONET column label used in the exported CSV header
+AOD_HEADERS = {
+    "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
+    "time_HH_MM_SS": "Time(hh:mm:ss)",
+    "air_mass": "Air Mass",
+    "aod_340nm": "AOD_340nm",
+    "aod_380nm": "AOD_380nm",
+    "aod_440nm": "AOD_440nm",
+    "aod_500nm": "AOD_500nm",
+    "aod_675nm": "AOD_675nm",
+    "aod_870nm": "AOD_870nm",
+    "aod_1020nm": "AOD_1020nm",
+    "aod_1640nm": "AOD_1640nm",
+    "water_vapor_CM": "Water Vapor(cm)",
+    "angstrom_exponent_440_870": "440-870nm_Angstrom_Exponent",
+    "std_340nm": "STD_340nm",
+    "std_380nm": "STD_380nm",
+    "std_440nm": "STD_440nm",
+    "std_500nm": "STD_500nm",
+    "std_675nm": "STD_675nm",
+    "std_870nm": "STD_870nm",
+    "std_1020nm": "STD_1020nm",
+    "std_1640nm": "STD_1640nm",
+    "std_water_vapor_CM": "STD_Water_Vapor(cm)",
+    "std_angstrom_exponent_440_870": "STD_440-870nm_Angstrom_Exponent",
+    "number_of_observations": "Number_of_Observations",
+    "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
+    "aeronet_number": "AERONET_Number",
+    "microtops_number": "Microtops_Number",
+}
+
+SDA_HEADERS = {
+    "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
+    "time_HH_MM_SS": "Time(hh:mm:ss)",
+    "julian_day": "Julian_Day",
+    "air_mass": "Air_Mass",
+    "total_aod_500nm": "Total_AOD_500nm(tau_a)",
+    "fine_mode_aod_500nm": "Fine_Mode_AOD_500nm(tau_f)",
+    "coarse_mode_aod_500nm": "Coarse_Mode_AOD_500nm(tau_c)",
+    "fine_mode_fraction_500nm": "FineModeFraction_500nm(eta)",
+    "coarse_mode_fraction_500nm": "CoarseModeFraction_500nm(1_eta)",
+    "regression_dtau_a": "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
+    "rmse_fine_mode_aod_500nm": "RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
+    "rmse_coarse_mode_aod_500nm": "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
+    "rmse_fmf_and_cmf_fractions_500nm": "RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
+    "angstrom_exponent_total_500nm": "Angstrom_Exponent(AE)_Total_500nm(alpha)",
+    "dae_dln_wavelength_total_500nm": "dAE/dln(wavelength)_Total_500nm(alphap)",
+    "ae_fine_mode_500nm": "AE_Fine_Mode_500nm(alpha_f)",
+    "dae_dln_wavelength_fine_mode_500nm": "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
+    "aod_870nm": "870nm_Input_AOD",
+    "aod_675nm": "675nm_Input_AOD",
+    "aod_500nm": "500nm_Input_AOD",
+    "aod_440nm": "440nm_Input_AOD",
+    "aod_380nm": "380nm_Input_AOD",
+    "stdev_total_aod_500nm": "STDEV-Total_AOD_500nm(tau_a)",
+    "stdev_fine_mode_aod_500nm": "STDEV-Fine_Mode_AOD_500nm(tau_f)",
+    "stdev_coarse_mode_aod_500nm": "STDEV-Coarse_Mode_AOD_500nm(tau_c)",
+    "stdev_fine_mode_fraction_500nm": "STDEV-FineModeFraction_500nm(eta)",
+    "stdev_coarse_mode_fraction_500nm": "STDEV-CoarseModeFraction_500nm(1_eta)",
+    "stdev_regression_dtau_a": "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
+    "stdev_rmse_fine_mode_aod_500nm": "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
+    "stdev_rmse_coarse_mode_aod_500nm": "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
+    "stdev_rmse_fmf_and_cmf_fractions_500nm": "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
+    "stdev_angstrom_exponent_total_500nm": "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)",
+    "stdev_dae_dln_wavelength_total_500nm": "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)",
+    "stdev_ae_fine_mode_500nm": "STDEV-AE_Fine_Mode_500nm(alpha_f)",
+    "stdev_dae_dln_wavelength_fine_mode_500nm": "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
+    "stdev_aod_870nm": "STDEV-870nm_Input_AOD",
+    "stdev_aod_675nm": "STDEV-675nm_Input_AOD",
+    "stdev_aod_500nm": "STDEV-500nm_Input_AOD",
+    "solar_zenith_angle": "Solar_Zenith_Angle",
+    "stdev_aod_440nm": "STDEV-440nm_Input_AOD",
+    "stdev_aod_380nm": "STDEV-380nm_Input_AOD",
+    "number_of_observations": "Number_of_Observations",
+    "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
+    "aeronet_number": "AERONET_Number",
+    "microtops_number": "Microtops_Number",
+}
+
+# (retrieval, frequency) -> (model, base name of the exported file)
+DATASETS = {
+    ("SDA", "Point"): (DownloadSDAAP, "MAN_DATASET_SDA_POINT"),
+    ("SDA", "Series"): (DownloadSDASeries, "MAN_DATASET_SDA_SERIES"),
+    ("SDA", "Daily"): (DownloadSDADaily, "MAN_DATASET_SDA_DAILY"),
+    ("AOD", "Daily"): (DownloadAODDaily, "MAN_DATASET_AOD_DAILY"),
+    ("AOD", "Series"): (DownloadAODSeries, "MAN_DATASET_AOD_SERIES"),
+    ("AOD", "Point"): (DownloadAODAP, "MAN_DATASET_AOD_POINT"),
+}
+
+QUALITY_MAP = {"Level 1.0": 10, "Level 1.5": 15, "Level 2.0": 20}
+
+SRC_DIR = r"./src"
+POLICY_FILES = ["data_usage_policy.pdf", "data_usage_policy.txt"]
+
+# Rows fetched from the server-side cursor and encoded per zip write
+ROW_CHUNK_SIZE = 20000
+
+# COPY output is re-chunked to this many bytes; at most COPY_QUEUE_SIZE chunks
+# are buffered between the database and the response
+COPY_CHUNK_BYTES = 256 * 1024
+COPY_QUEUE_SIZE = 8
+
+# Values of the `format` request field -> extension of the archive members
+CSV_FORMAT = "csv"
+PARQUET_FORMAT = "parquet"
+ARROW_FORMAT = "arrow"
+FORMAT_EXTENSIONS = {
+    CSV_FORMAT: ".csv",
+    PARQUET_FORMAT: ".parquet",
+    ARROW_FORMAT: ".arrow",
+}
+# Members that are compressed already are stored rather than deflated
+STORED_EXTENSIONS = (".parquet",)
+
+ExportEntry = namedtuple(
+    "ExportEntry",
+    ["arcname", "retrieval", "freq", "level", "preamble", "columns", "queryset"],
+)
+
+
+def parse_download_request(data):
+    """Normalise the JSON body of a download request into a parameter dict."""
+    start_date = data.get("start_date", "") or None
+    end_date = data.get("end_date", "") or None
+
+    # The full available range is the same as no date filter at all
+    if start_date == datetime(2004, 10, 16).strftime("%Y-%m-%d"):
+        start_date = None
+    if end_date == datetime.now().date().strftime("%Y-%m-%d"):
+        end_date = None
+
+    bounds = {
+        "min_lat": data.get("min_lat", None),
+        "min_lng": data.get("min_lng", None),
+        "max_lat": data.get("max_lat", None),
+        "max_lng": data.get("max_lng", None),
+    }
+    if not all(value is not None for value in bounds.values()):
+        bounds = None
+
+    return {
+        "sites": data.get("sites", []),
+        "start_date": start_date,
+        "end_date": end_date,
+        "retrievals": data.get("retrievals", []),
+        "frequency": data.get("frequency", []),
+        "quality": data.get("quality", []),
+        "bounds": bounds,
+        "format": data.get("format") or CSV_FORMAT,
+    }
+
+
+def filter_queryset(model, params, level_value):
+    sites = params["sites"]
+    bounds = params["bounds"]
+    bbox_polygon = None
+    if bounds is not None:
+        min_point = Point(bounds["min_lng"], bounds["min_lat"])
+        max_point = Point(bounds["max_lng"], bounds["max_lat"])
+        bbox_polygon = Polygon.from_bbox(
+            (min_point.x, min_point.y, max_point.x, max_point.y)
+        )
+        # Drop cruises whose envelope misses the bbox before the point filter.
+        # A cruise without a SiteTrack row yet (derived tables not refreshed)
+        # is kept and left to the exact filter below.
+        missed = set(
+            SiteTrack.objects.filter(cruise__in=sites, level=level_value)
+            .exclude(envelope__intersects=bbox_polygon)
+            .values_list("cruise", flat=True)
+        )
+        sites = [cruise for cruise in sites if cruise not in missed]
+
+    query = model.objects.filter(cruise__in=sites, level=level_value)
+
+    date_filter = Q()
+    if params["start_date"]:
+        date_filter &= Q(date_DD_MM_YYYY__gte=params["start_date"])
+    if params["end_date"]:
+        date_filter &= Q(date_DD_MM_YYYY__lte=params["end_date"])
+    if date_filter:
+        query = query.filter(date_filter)
+
+    if bbox_polygon is not None:
+        query = query.filter(coordinates__within=bbox_polygon)
+    return query
+
+
+def export_columns(model, retrieval):
+    """
+    Return (header labels, value columns) for a download model.
+
+    The stored `coordinates` geometry is not exported; its WKT copy is written
+    in its place under the `coordinates` label.
+    """
+    fieldnames = [field.name for field in model._meta.fields]
+    fieldnames.pop(0)
+
+    header_map = SDA_HEADERS if "SDA" in retrieval else AOD_HEADERS
+    labels = [header_map.get(name, name) for name in fieldnames]
+    labels.remove("coordinates_wkt")
+    columns = [name for name in fieldnames if name != "coordinates"]
+    return labels, columns
+
+
+def export_preamble(header, freq, labels):
+    """The AERONET header lines written above the CSV column labels."""
+    return (
+        f"{header.base_header_l1}"
+        f"{freq},** interpolated 500nm channel **\n"
+        f"{header.base_header_l2}"
+        f"{','.join(labels)}\n"
+    )
+
+
+def build_export_plan(params):
+    extension = FORMAT_EXTENSIONS[params.get("format", CSV_FORMAT)]
+    entries = []
+    for retrieval in params["retrievals"]:
+        for freq in params["frequency"]:
+            dataset = DATASETS.get((retrieval, freq))
+            if dataset is None:
+                continue
+            model, basename = dataset
+            labels, columns = export_columns(model, retrieval)
+
+            for level in params["quality"]:
+                level_value = QUALITY_MAP.get(level)
+                if level_value is None:
+                    continue
+
+                cur_header = TableHeader.objects.filter(
+                    level=level_value, freq=freq, datatype=retrieval
+                ).first()
+                if cur_header is None:
+                    continue
+
+                query = filter_queryset(model, params, level_value)
+                if not query.exists():
+                    continue
+
+                preamble = export_preamble(cur_header, freq, labels)
+                entries.append(
+                    ExportEntry(
+                        arcname=f"{basename}{level_value}{extension}",
+                        retrieval=retrieval,
+                        freq=freq,
+                        level=level_value,
+                        preamble=preamble,
+                        columns=columns,
+                        queryset=query,
+                    )
+                )
+    return entries
+
+
+def iter_csv_chunks(entry, chunk_size=ROW_CHUNK_SIZE):
+    """Yield the encoded CSV for an export entry, `chunk_size` rows at a time."""
+    yield entry.preamble.encode("utf-8")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    rows = entry.queryset.values_list(*entry.columns).iterator(chunk_size=chunk_size)
+    count = 0
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+    record_rows(count)
+
+
+def copy_statement(entry):
+    """Build `COPY (SELECT <columns> ...) TO STDOUT WITH CSV` for an export entry."""
+    queryset = entry.queryset.values_list(*entry.columns)
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    select = connection.ops.compose_sql(sql, params)
+    return f"COPY ({select}) TO STDOUT WITH CSV"
+
+
+class _CopyWriter:
+    """File-like target for psycopg2 copy_expert feeding a bounded queue."""
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= COPY_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            _put_chunk(self.chunks, bytes(self.buffer), self.cancelled)
+            self.buffer.clear()
+
+
+def _put_chunk(chunks, chunk, cancelled):
+    while True:
+        if cancelled.is_set():
+            # Raising inside copy_expert stops it reading the COPY; the
+            # connection is closed afterwards (see _iter_copy_psycopg2)
+            raise OSError("export cancelled")
+        try:
+            chunks.put(chunk, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
+def _iter_copy_psycopg2(cursor, statement):
+    # copy_expert blocks until the whole result has been written, so it runs
+    # in a producer thread and the response pulls chunks off a bounded queue.
+    chunks = queue.Queue(maxsize=COPY_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = object()
+    errors = []
+
+    def produce():
+        writer = _CopyWriter(chunks, cancelled)
+        start = time.perf_counter()
+        try:
+            cursor.copy_expert(statement, writer, size=COPY_CHUNK_BYTES)
+            writer.flush()
+            record_query(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                _put_chunk(chunks, done, cancelled)
+            except OSError:
+                pass
+
+    # The thread runs in the request's context so its statements are measured
+    producer = threading.Thread(
+        target=contextvars.copy_context().run, args=(produce,), daemon=True
+    )
+    producer.start()
+    finished = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                finished = True
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+        producer.join()
+        if not finished:
+            # The COPY was abandoned midway and the connection is still in
+            # COPY state: close it rather than let CONN_MAX_AGE hand it to
+            # the next request
+            cursor.db.close()
+    if errors:
+        raise errors[0]
+
+
+def iter_copy_chunks(entry):
+    """
+    Yield the encoded CSV for an export entry using PostgreSQL COPY.
+
+    The rows never become Python objects: the server formats them and the raw
+    CSV bytes are passed through to the zip stream, so memory stays constant
+    regardless of the row count. Values use PostgreSQL's text output (e.g.
+    `-999` rather than `-999.0`).
+    """
+    yield entry.preamble.encode("utf-8")
+
+    statement = copy_statement(entry)
+    rows = 0
+    with connections[entry.queryset.db].cursor() as cursor:
+        if hasattr(cursor.cursor, "copy"):
+            # psycopg 3 streams COPY blocks natively
+            start = time.perf_counter()
+            with cursor.cursor.copy(statement) as copy:
+                for block in copy:
+                    block = bytes(block)
+                    rows += block.count(b"\n")
+                    yield block
+            record_query(time.perf_counter() - start)
+        else:
+            for chunk in _iter_copy_psycopg2(cursor, statement):
+                rows += chunk.count(b"\n")
+                yield chunk
+    record_rows(rows)
+
+
+EXPORT_ENGINES = {
+    "orm": iter_csv_chunks,
+    "copy": iter_copy_chunks,
+}
+
+
+def get_export_engine(name=None):
+    """
+    Return the chunk source for `name`, defaulting to DOWNLOAD_EXPORT_ENGINE.
+
+    Without server-side cursors (DJANGO_DB_PGBOUNCER) the "orm" engine's
+    `.iterator(chunk_size=...)` would fetch each whole result client-side, so
+    COPY is used instead.
+    """
+    if name is None:
+        name = getattr(settings, "DOWNLOAD_EXPORT_ENGINE", "copy")
+    connection = connections["default"]
+    if connection.vendor != "postgresql":
+        return iter_csv_chunks
+    if connection.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+        return iter_copy_chunks
+    return EXPORT_ENGINES.get(name, iter_csv_chunks)
+
+
+class ZipStream:
+    """
+    Write-only, non-seekable sink for zipfile.
+
+    zipfile falls back to data descriptors when it cannot seek, which lets the
+    archive be emitted front to back while its members are still being encoded.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def stream_archive(entries, root, chunk_source=iter_csv_chunks):
+    """Yield a zip archive of `entries` (plus the data policy) under `root/`."""
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for entry in entries:
+            info = zipfile.ZipInfo(f"{root}/{entry.arcname}", time.localtime()[:6])
+            info.compress_type = (
+                zipfile.ZIP_STORED
+                if entry.arcname.endswith(STORED_EXTENSIONS)
+                else zipfile.ZIP_DEFLATED
+            )
+            with archive.open(info, mode="w", force_zip64=True) as member:
+                for chunk in chunk_source(entry):
+                    member.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            # Closing the member flushes the compressor and its data descriptor
+            yield sink.drain()
+
+        for policy_file in POLICY_FILES:
+            src_policy_file = os.path.join(SRC_DIR, policy_file)
+            if os.path.isfile(src_policy_file):
+                archive.write(src_policy_file, f"{root}/{policy_file}")
+                yield sink.drain()
+            else:
+                print(f"Source policy file {src_policy_file} does not exist")
+    yield sink.drain()
+
+
+def _acquire(slots, cancelled):
+    while not slots.acquire(timeout=0.5):
+        if cancelled.is_set():
+            raise OSError("export cancelled")
+    if cancelled.is_set():
+        raise OSError("export cancelled")
+
+
+async def aiter_chunks(chunks, maxsize=COPY_QUEUE_SIZE):
+    """
+    Yield the chunks of a blocking iterator to an async response.
+
+    The iterator runs start to finish on one thread of its own, so it keeps a
+    single database connection (closed when it ends). That thread is the only
+    one the download holds: chunks are handed to the event loop with
+    call_soon_threadsafe and awaited on an asyncio queue, so waiting for them
+    takes no executor thread. At most `maxsize` chunks are in flight; past that
+    the producer blocks until the client catches up. Closing the generator
+    (client disconnect) cancels the producer.
+    """
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue()
+    slots = threading.Semaphore(maxsize)
+    cancelled = threading.Event()
+    done = object()
+    errors = []
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(pending.put_nowait, item)
+        except RuntimeError:
+            # The loop has closed, so nobody is left to read the chunk
+            raise OSError("export cancelled")
+
+    def produce():
+        try:
+            for chunk in chunks:
+                _acquire(slots, cancelled)
+                put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            connections.close_all()
+            try:
+                put(done)
+            except OSError:
+                pass
+
+    producer = threading.Thread(
+        target=contextvars.copy_context().run, args=(produce,), daemon=True
+    )
+    producer.start()
+    try:
+        while True:
+            chunk = await pending.get()
+            if chunk is done:
+                break
+            slots.release()
+            yield chunk
+    finally:
+        cancelled.set()
+    if errors:
+        raise errors[0]
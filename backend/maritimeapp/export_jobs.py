@@ -0,0 +1,224 @@
+"""
+Background builds of download archives.
+
+POST /export/ stores the parsed download request as an ExportJob and returns
+its id at once; export_worker processes claim queued jobs, write the archive
+to EXPORT_JOB_DIR with the same export pipeline as download_data and record
+progress as they go. Clients poll /export/<id>/ and fetch /export/<id>/file/
+once the job is done. Archives expire EXPORT_JOB_TTL seconds after they were
+built.
+"""
+
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.timezone import now
+
+from .downloads import CSV_FORMAT, build_export_plan, stream_archive
+from .export_formats import format_chunk_source
+from .models import ExportJob
+from .shards import shard_plan, stream_shard_archive
+
+# Minimum seconds between progress writes while an archive is being streamed
+PROGRESS_INTERVAL = 2.0
+
+
+class JobLost(Exception):
+    """The job was requeued and claimed again while this worker built it."""
+
+
+def job_dir():
+    return getattr(
+        settings,
+        "EXPORT_JOB_DIR",
+        os.path.join(settings.BASE_DIR, "export_jobs"),
+    )
+
+
+def job_ttl():
+    return timedelta(seconds=getattr(settings, "EXPORT_JOB_TTL", 24 * 3600))
+
+
+def submit_job(params, archive_name):
+    return ExportJob.objects.create(params=params, archive_name=archive_name)
+
+
+def job_status(job):
+    status = {
+        "job": str(job.job_id),
+        "status": job.status,
+        "progress": round(job.progress(), 4),
+        "members_done": job.members_done,
+        "members_total": job.members_total,
+        "bytes_written": job.bytes_written,
+        "created": job.created.isoformat(),
+    }
+    if job.status == ExportJob.FAILED:
+        status["error"] = job.error
+    if job.expires is not None:
+        status["expires"] = job.expires.isoformat()
+    return status
+
+
+def claim_job():
+    """Mark the oldest queued job as running and return it, or None."""
+    with transaction.atomic():
+        job = (
+            ExportJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ExportJob.QUEUED)
+            .order_by("created")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = ExportJob.RUNNING
+        job.started = job.heartbeat = now()
+        job.attempt += 1
+        job.save(update_fields=["status", "started", "heartbeat", "attempt"])
+    return job
+
+
+def requeue_stale(stale_after):
+    """Put back jobs whose worker stopped sending heartbeats."""
+    return ExportJob.objects.filter(
+        status=ExportJob.RUNNING, heartbeat__lt=now() - stale_after
+    ).update(status=ExportJob.QUEUED, members_done=0, bytes_written=0)
+
+
+def purge_expired():
+    """Delete expired archives; the job rows remain as EXPIRED."""
+    expired = ExportJob.objects.filter(status=ExportJob.DONE, expires__lt=now())
+    count = 0
+    for job in expired:
+        if job.path and os.path.exists(job.path):
+            os.remove(job.path)
+        job.status = ExportJob.EXPIRED
+        job.path = ""
+        job.save(update_fields=["status", "path"])
+        count += 1
+    return count
+
+
+def heartbeat_interval():
+    return getattr(settings, "EXPORT_JOB_HEARTBEAT_SECONDS", 30)
+
+
+class Heartbeat:
+    """
+    Refresh the heartbeat of a job every `interval` seconds on a thread of its
+    own, so a slow query or a COPY that has not produced its first chunk does
+    not make the job look stalled. `lost` is set if the job stops being ours.
+    """
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                if not owned(self.job).update(heartbeat=now()):
+                    self.lost.set()
+                    return
+        finally:
+            connections.close_all()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def owned(job):
+    """The job row, as long as this claim of it is still the current one."""
+    return ExportJob.objects.filter(
+        pk=job.pk, attempt=job.attempt, status=ExportJob.RUNNING
+    )
+
+
+def run_job(job):
+    """Build the archive of a claimed job, recording progress and the result."""
+    directory = job_dir()
+    os.makedirs(directory, exist_ok=True)
+    final_path = os.path.join(directory, f"{job.job_id}.zip")
+    # A requeued job may still be written by its previous worker
+    part_path = f"{final_path}.{job.attempt}.part"
+
+    progress = {"members": 0, "bytes": 0, "saved": 0.0}
+
+    def save_progress(force=False):
+        current = now()
+        if force or current.timestamp() - progress["saved"] >= PROGRESS_INTERVAL:
+            updated = owned(job).update(
+                members_done=progress["members"],
+                bytes_written=progress["bytes"],
+                heartbeat=current,
+            )
+            if not updated:
+                raise JobLost(job.job_id)
+            progress["saved"] = current.timestamp()
+
+    engine = format_chunk_source(job.params.get("format", CSV_FORMAT))
+
+    def member_done(member=None):
+        progress["members"] += 1
+        save_progress(force=True)
+
+    def counted(entry):
+        yield from engine(entry)
+        member_done()
+
+    try:
+        with Heartbeat(job, heartbeat_interval()) as heartbeat:
+            root = os.path.splitext(job.archive_name)[0]
+            members = shard_plan(job.params)
+            if members is not None:
+                total = len(members)
+                chunks = stream_shard_archive(members, root, member_done=member_done)
+            else:
+                entries = build_export_plan(job.params)
+                total = len(entries)
+                chunks = stream_archive(entries, root, chunk_source=counted)
+            owned(job).update(members_total=total)
+            with open(part_path, "wb") as f:
+                for chunk in chunks:
+                    if heartbeat.lost.is_set():
+                        raise JobLost(job.job_id)
+                    f.write(chunk)
+                    progress["bytes"] += len(chunk)
+                    save_progress()
+
+        finished = now()
+        with transaction.atomic():
+            # The row lock keeps requeue_stale out until the archive is in place
+            if owned(job).select_for_update().first() is None:
+                raise JobLost(job.job_id)
+            os.replace(part_path, final_path)
+            owned(job).update(
+                status=ExportJob.DONE,
+                path=final_path,
+                members_done=progress["members"],
+                bytes_written=progress["bytes"],
+                finished=finished,
+                heartbeat=finished,
+                expires=finished + job_ttl(),
+            )
+    except JobLost:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+    except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        owned(job).update(status=ExportJob.FAILED, error=str(e), finished=now())
+        return False
+    return True
@@ -0,0 +1,427 @@
+"""
+Conversion of AERONET MAN files into COPY-ready CSVs.
+
+Each source file (`*.lev10/15/20`, `*.ONEILL_10/15/20`) has a five line
+preamble (cruise, PI, column header) followed by comma separated rows. The
+rows are parsed with a vectorised CSV reader and the coordinates are emitted as
+WKT formatted as GEOS writes it, so no per-row geometry objects are built.
+
+This module deliberately imports nothing from Django so that it can be used
+from process pool workers regardless of the multiprocessing start method.
+"""
+
+import csv
+import hashlib
+import io
+import math
+import os
+import re
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from .ingest_telemetry import timed
+
+# AERONET column label -> model field name
+AOD_COLUMNS = {
+    "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
+    "Time(hh:mm:ss)": "time_HH_MM_SS",
+    "Air Mass": "air_mass",
+    "AOD_340nm": "aod_340nm",
+    "AOD_380nm": "aod_380nm",
+    "AOD_440nm": "aod_440nm",
+    "AOD_500nm": "aod_500nm",
+    "AOD_675nm": "aod_675nm",
+    "AOD_870nm": "aod_870nm",
+    "AOD_1020nm": "aod_1020nm",
+    "AOD_1640nm": "aod_1640nm",
+    "Water Vapor(cm)": "water_vapor_CM",
+    "440-870nm_Angstrom_Exponent": "angstrom_exponent_440_870",
+    "STD_340nm": "std_340nm",
+    "STD_380nm": "std_380nm",
+    "STD_440nm": "std_440nm",
+    "STD_500nm": "std_500nm",
+    "STD_675nm": "std_675nm",
+    "STD_870nm": "std_870nm",
+    "STD_1020nm": "std_1020nm",
+    "STD_1640nm": "std_1640nm",
+    "STD_Water_Vapor(cm)": "std_water_vapor_CM",
+    "STD_440-870nm_Angstrom_Exponent": "std_angstrom_exponent_440_870",
+    "Number_of_Observations": "number_of_observations",
+    "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
+    "AERONET_Number": "aeronet_number",
+    "Microtops_Number": "microtops_number",
+}
+
+SDA_COLUMNS = {
+    "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
+    "Time(hh:mm:ss)": "time_HH_MM_SS",
+    "Julian_Day": "julian_day",
+    "Air_Mass": "air_mass",
+    "Total_AOD_500nm(tau_a)": "total_aod_500nm",
+    "Fine_Mode_AOD_500nm(tau_f)": "fine_mode_aod_500nm",
+    "Coarse_Mode_AOD_500nm(tau_c)": "coarse_mode_aod_500nm",
+    "FineModeFraction_500nm(eta)": "fine_mode_fraction_500nm",
+    "CoarseModeFraction_500nm(1_eta)": "coarse_mode_fraction_500nm",
+    "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "regression_dtau_a",
+    "RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "rmse_fine_mode_aod_500nm",
+    "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "rmse_coarse_mode_aod_500nm",
+    "RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "rmse_fmf_and_cmf_fractions_500nm",
+    "Angstrom_Exponent(AE)_Total_500nm(alpha)": "angstrom_exponent_total_500nm",
+    "dAE/dln(wavelength)_Total_500nm(alphap)": "dae_dln_wavelength_total_500nm",
+    "AE_Fine_Mode_500nm(alpha_f)": "ae_fine_mode_500nm",
+    "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "dae_dln_wavelength_fine_mode_500nm",
+    "870nm_Input_AOD": "aod_870nm",
+    "675nm_Input_AOD": "aod_675nm",
+    "500nm_Input_AOD": "aod_500nm",
+    "440nm_Input_AOD": "aod_440nm",
+    "380nm_Input_AOD": "aod_380nm",
+    "STDEV-Total_AOD_500nm(tau_a)": "stdev_total_aod_500nm",
+    "STDEV-Fine_Mode_AOD_500nm(tau_f)": "stdev_fine_mode_aod_500nm",
+    "STDEV-Coarse_Mode_AOD_500nm(tau_c)": "stdev_coarse_mode_aod_500nm",
+    "STDEV-FineModeFraction_500nm(eta)": "stdev_fine_mode_fraction_500nm",
+    "STDEV-CoarseModeFraction_500nm(1_eta)": "stdev_coarse_mode_fraction_500nm",
+    "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "stdev_regression_dtau_a",
+    "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "stdev_rmse_fine_mode_aod_500nm",
+    "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "stdev_rmse_coarse_mode_aod_500nm",
+    "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "stdev_rmse_fmf_and_cmf_fractions_500nm",
+    "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)": "stdev_angstrom_exponent_total_500nm",
+    "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)": "stdev_dae_dln_wavelength_total_500nm",
+    "STDEV-AE_Fine_Mode_500nm(alpha_f)": "stdev_ae_fine_mode_500nm",
+    "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "stdev_dae_dln_wavelength_fine_mode_500nm",
+    "STDEV-870nm_Input_AOD": "stdev_aod_870nm",
+    "STDEV-675nm_Input_AOD": "stdev_aod_675nm",
+    "STDEV-500nm_Input_AOD": "stdev_aod_500nm",
+    "Solar_Zenith_Angle": "solar_zenith_angle",
+    "STDEV-440nm_Input_AOD": "stdev_aod_440nm",
+    "STDEV-380nm_Input_AOD": "stdev_aod_380nm",
+    "Number_of_Observations": "number_of_observations",
+    "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
+    "AERONET_Number": "aeronet_number",
+    "Microtops_Number": "microtops_number",
+}
+
+SITE_COLUMNS = ["name", "aeronet_number", "description", "span_date"]
+
+PREAMBLE_LINES = 5
+
+_int_suffix = re.compile(r"\(int\)")
+
+
+def parse_preamble(lines):
+    """Return (cruise, pi, pi_email, header) from the first five lines of a file."""
+    pi_info = lines[3]
+    pi = pi_info.split("=")[1].split(",")[0].replace("\n", "").replace(",", ";")
+    pi_email = pi_info.split(",Email=")[1].replace("\n", "").replace(",", ";")
+    cruise = lines[1].split(",")[0].replace("\n", "")
+    header = [_int_suffix.sub("", col) for col in lines[4].strip().split(",")]
+    return cruise, pi, pi_email, header
+
+
+def describe_file(name):
+    """Return (datatype, level) for an AERONET file name, e.g. ("AOD", "15")."""
+    if ".lev" in name:
+        return "AOD", name.split(".lev")[1]
+    return "SDA", name.split(".ONEILL_")[1]
+
+
+def output_csv_path(file):
+    datatype, level = describe_file(file)
+    return "." + file.split(".")[1] + f"_{datatype}_" + level + ".csv"
+
+
+def _aeronet_dates(values):
+    return pd.to_datetime(values, format="%d:%m:%Y", errors="coerce").dt.strftime(
+        "%Y-%m-%d"
+    )
+
+
+def read_measurements(handle, header, datatype):
+    """
+    Parse the data rows of an AERONET file into a DataFrame of model columns.
+
+    `handle` must be positioned just after the preamble. Values are kept as
+    the source text apart from the dates, which are converted to ISO format,
+    and the coordinates, which are combined into a WKT point (see wkt_point).
+    """
+    mapping = SDA_COLUMNS if datatype == "SDA" else AOD_COLUMNS
+    df = pd.read_csv(
+        handle,
+        header=None,
+        names=header,
+        dtype=str,
+        keep_default_na=False,
+        skip_blank_lines=True,
+    )
+    df.columns = [mapping.get(col, col) for col in df.columns]
+
+    lng = _wkt_numbers(df["Longitude"])
+    lat = _wkt_numbers(df["Latitude"])
+    wkt = ("POINT (" + lng + " " + lat + ")").where(
+        lng.notna() & lat.notna(), EMPTY_POINT
+    )
+    df = df.drop(columns=["Longitude", "Latitude"])
+    df["coordinates"] = wkt
+    df["coordinates_wkt"] = wkt
+    df["date_DD_MM_YYYY"] = _aeronet_dates(df["date_DD_MM_YYYY"])
+    df["last_processing_date_DD_MM_YYYY"] = _aeronet_dates(
+        df["last_processing_date_DD_MM_YYYY"]
+    )
+    return df
+
+
+def convert_file(file):
+    """
+    Convert one AERONET file into its COPY-ready CSV.
+
+    Returns a result dict with the output path, row count, the Site row for
+    daily level 1.5 AOD files, the parse/convert timings and, on failure, an
+    error description. Errors are returned rather than raised so one bad file
+    does not stop a pool.
+    """
+    result = {"file": file, "output": None, "rows": 0, "site": None, "error": None}
+    result["timings"] = timings = {}
+    cruise = None
+    header = None
+    try:
+        datatype, level = describe_file(file)
+        result["datatype"] = datatype
+        result["level"] = level
+        with timed(timings, "parse") as parsed:
+            with open(file, "r", encoding="latin-1") as f:
+                preamble = [f.readline() for _ in range(PREAMBLE_LINES)]
+                cruise, pi, pi_email, header = parse_preamble(preamble)
+                df = read_measurements(f, header, datatype)
+            parsed["bytes"] = os.path.getsize(file)
+            parsed["rows"] = len(df)
+
+        outputcsv = output_csv_path(file)
+        with timed(timings, "convert") as converted:
+            df["cruise"] = cruise
+            df["level"] = level
+            df["pi"] = pi
+            df["pi_email"] = pi_email
+            df.to_csv(outputcsv, index=False)
+            converted["bytes"] = os.path.getsize(outputcsv)
+            converted["rows"] = len(df)
+
+        result["output"] = outputcsv
+        result["rows"] = len(df)
+        result["cruise"] = cruise
+        result["last_processing_date"] = (
+            df["last_processing_date_DD_MM_YYYY"].dropna().max() if len(df) else None
+        )
+
+        if "daily.lev15" in file and len(df):
+            result["site"] = [cruise, df["aeronet_number"].iloc[0], "?", {}]
+    except Exception as e:
+        result["error"] = {"cruise": cruise, "header": header, "error": str(e)}
+    return result
+
+
+def fingerprint_file(file):
+    """Return the size, mtime and SHA-256 of a source file."""
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    stat = os.stat(file)
+    return {
+        "file": file,
+        "name": os.path.basename(file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": digest.hexdigest(),
+    }
+
+
+def _pool_map(func, items, workers):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with Pool(processes=workers) as pool:
+        yield from pool.imap_unordered(func, items, chunksize=4)
+
+
+def convert_files(files, workers=None):
+    """Convert `files` over a process pool, yielding results as they finish."""
+    yield from _pool_map(convert_file, files, workers)
+
+
+def fingerprint_files(files, workers=None):
+    """Fingerprint `files` over a process pool, yielding results as they finish."""
+    yield from _pool_map(fingerprint_file, files, workers)
+
+
+# ---- streaming conversion (tar member -> COPY FROM STDIN) ----
+
+FREQUENCIES = {"all_points": "Point", "series": "Series", "daily": "Daily"}
+
+TABLES = {
+    ("AOD", "Point"): "maritimeapp_downloadaodap",
+    ("AOD", "Series"): "maritimeapp_downloadaodseries",
+    ("AOD", "Daily"): "maritimeapp_downloadaoddaily",
+    ("SDA", "Point"): "maritimeapp_downloadsdaap",
+    ("SDA", "Series"): "maritimeapp_downloadsdaseries",
+    ("SDA", "Daily"): "maritimeapp_downloadsdadaily",
+}
+
+EXTRA_COLUMNS = [
+    "coordinates",
+    "coordinates_wkt",
+    "cruise",
+    "level",
+    "pi",
+    "pi_email",
+]
+
+_measurement_file = re.compile(r"\.(lev|ONEILL_)\d+$")
+
+
+def is_measurement_file(name):
+    return bool(_measurement_file.search(name))
+
+
+def describe_frequency(name):
+    for token, freq in FREQUENCIES.items():
+        if token in name:
+            return freq
+    return None
+
+
+def copy_columns(header, datatype):
+    """Model columns, in COPY order, for the rows of `iter_copy_rows`."""
+    mapping = SDA_COLUMNS if datatype == "SDA" else AOD_COLUMNS
+    columns = [
+        mapping.get(col, col) for col in header if col not in ("Longitude", "Latitude")
+    ]
+    return columns + EXTRA_COLUMNS
+
+
+def _iso_date(value):
+    parts = value.strip().split(":")
+    if len(parts) != 3:
+        return ""
+    return f"{parts[2]}-{parts[1]}-{parts[0]}"
+
+
+EMPTY_POINT = "POINT EMPTY"
+
+# A decimal of at most 15 significant digits: its trimmed text is already the
+# shortest representation of the float it parses to.
+_short_decimal = re.compile(r"[-+]?\d{1,3}(?:\.\d{0,12})?")
+
+
+def _wkt_number(value):
+    return np.format_float_positional(value, trim="-")
+
+
+def _wkt_numbers(values):
+    """
+    `_wkt_number` over a column of source text, NaN where the text is not a
+    finite number. The fixed-point text AERONET writes is trimmed with string
+    operations; anything else goes through `_wkt_number` one value at a time.
+    """
+    text = values.str.strip()
+    short = text.str.fullmatch(_short_decimal)
+    trimmed = text.where(~text.str.contains(".", regex=False), text.str.rstrip("0"))
+    trimmed = (
+        trimmed.str.rstrip(".")
+        .str.lstrip("+")
+        .str.replace(r"^(-?)0+(?=\d)", r"\1", regex=True)
+    )
+    numbers = trimmed.where(short)
+    other = text[~short]
+    if len(other):
+        parsed = pd.to_numeric(other, errors="coerce")
+        parsed = parsed[np.isfinite(parsed)]
+        numbers[parsed.index] = parsed.map(_wkt_number)
+    return numbers
+
+
+def wkt_point(lng, lat):
+    """
+    WKT of a point from its source text, as GEOS writes it (shortest digits,
+    no trailing zeros, no exponent), e.g. "POINT (-70.1 41)" for -70.100000
+    and 41.000000, so every ingest path exports the same coordinates_wkt.
+    Blank or unparseable coordinates give an empty point, as `_iso_date`
+    gives a null date, rather than failing the whole COPY.
+    """
+    try:
+        lng, lat = float(lng), float(lat)
+    except ValueError:
+        return EMPTY_POINT
+    if not (math.isfinite(lng) and math.isfinite(lat)):
+        return EMPTY_POINT
+    return f"POINT ({_wkt_number(lng)} {_wkt_number(lat)})"
+
+
+def iter_copy_rows(lines, header, cruise, level, pi, pi_email):
+    """
+    Convert AERONET data lines into rows matching `copy_columns`, one at a time.
+
+    This is the streaming counterpart of `read_measurements`: only the current
+    line is held in memory, so arbitrarily large members can be loaded.
+    """
+    lng = header.index("Longitude")
+    lat = header.index("Latitude")
+    date_columns = [
+        header.index(col)
+        for col in ("Date(dd:mm:yyyy)", "Last_Processing_Date(dd:mm:yyyy)")
+        if col in header
+    ]
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        values = line.split(",")
+        for index in date_columns:
+            values[index] = _iso_date(values[index])
+        wkt = wkt_point(values[lng], values[lat])
+        row = [value for index, value in enumerate(values) if index not in (lng, lat)]
+        yield row + [wkt, wkt, cruise, level, pi, pi_email]
+
+
+def iter_csv_bytes(rows, chunk_bytes=64 * 1024):
+    """Encode rows as CSV, yielding roughly `chunk_bytes` at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_bytes:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class ChunkPipe:
+    """
+    Read-only file object over an iterator of byte chunks.
+
+    `cursor.copy_expert` pulls from it with `read(size)`, so at most one
+    chunk plus the requested size is buffered at any time.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytes_read += len(data)
+        return data
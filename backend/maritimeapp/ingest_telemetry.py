@@ -0,0 +1,199 @@
+"""
+Throughput telemetry for the ingest commands (import_dd, psql_add, populate,
+stream_load).
+
+An IngestRun accumulates, per stage (download, extract, parse, convert, copy,
+...), the seconds spent and the bytes and rows processed, and keeps one
+record per file with its own stage timings. While files are being processed
+a progress line is printed every PROGRESS_INTERVAL seconds; at the end the
+stage table and the slowest files are printed and the whole run, every file
+included, is written to `ingest_<command>_<timestamp>.json`.
+
+Stage seconds are summed over files. With a process pool (import_dd) or one
+thread per table (psql_add --parallel) they add up the time of all workers
+and can exceed the wall time of the run, which is reported as "elapsed".
+
+Like ingest.py this module imports nothing from Django, so worker processes
+can time themselves with `timed`.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+PROGRESS_INTERVAL = 5.0
+SLOWEST_FILES = 20
+
+
+def timing(seconds, size=0, rows=0):
+    return {"seconds": seconds, "bytes": size, "rows": rows}
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Time the block into `timings[stage]`; the block may fill in the "bytes"
+    and "rows" of the yielded dict.
+    """
+    entry = timing(0.0)
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry["seconds"] = time.perf_counter() - start
+        timings[stage] = entry
+
+
+def _file_rows(record):
+    return max((entry["rows"] for entry in record["stages"].values()), default=0)
+
+
+def _file_seconds(record):
+    return sum(entry["seconds"] for entry in record["stages"].values())
+
+
+def _rates(totals):
+    seconds = totals["seconds"]
+    return {
+        **totals,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(totals["rows"] / seconds, 1) if seconds else None,
+        "bytes_per_second": round(totals["bytes"] / seconds, 1) if seconds else None,
+    }
+
+
+class IngestRun:
+    """Stage totals and per-file timings of one ingest command run."""
+
+    def __init__(self, command, write=print):
+        self.command = command
+        self.write = write
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.files = []
+        self.errors = 0
+        self.expected = None
+        self.last_progress = self.started
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, size=0, rows=0, files=0):
+        with self.lock:
+            totals = self.stages.setdefault(
+                stage, {"seconds": 0.0, "bytes": 0, "rows": 0, "files": 0}
+            )
+            totals["seconds"] += seconds
+            totals["bytes"] += size
+            totals["rows"] += rows
+            totals["files"] += files
+
+    @contextmanager
+    def stage(self, name):
+        """Time a whole stage (e.g. the download) outside the per-file records."""
+        entry = timing(0.0)
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(name, seconds, entry["bytes"], entry["rows"])
+
+    def record_file(self, name, timings=None, error=None, **extra):
+        """
+        Record one processed file. `timings` maps stage names to dicts of
+        seconds, bytes and rows, which are also added to the stage totals.
+        """
+        timings = timings or {}
+        for stage, entry in timings.items():
+            self.add(stage, entry["seconds"], entry["bytes"], entry["rows"], files=1)
+
+        record = {"file": name, "stages": timings, "error": error, **extra}
+        with self.lock:
+            self.files.append(record)
+            if error is not None:
+                self.errors += 1
+            now = time.perf_counter()
+            due = now - self.last_progress >= PROGRESS_INTERVAL
+            if due:
+                self.last_progress = now
+        if due:
+            self.progress()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def progress(self):
+        with self.lock:
+            done = len(self.files)
+            rows = sum(_file_rows(record) for record in self.files)
+        elapsed = self.elapsed() or 1e-9
+        line = f"{self.command}: {done}"
+        if self.expected:
+            line += f"/{self.expected}"
+        line += f" files, {rows} rows in {elapsed:.0f}s ({rows / elapsed:.0f} rows/s)"
+        if self.expected and done < self.expected:
+            remaining = elapsed / done * (self.expected - done)
+            line += f", about {remaining:.0f}s left"
+        self.write(line)
+
+    def summary(self):
+        return {
+            "command": self.command,
+            "started": self.started_at.isoformat(timespec="seconds"),
+            "elapsed_seconds": round(self.elapsed(), 3),
+            "files": len(self.files),
+            "errors": self.errors,
+            "stages": {name: _rates(totals) for name, totals in self.stages.items()},
+            "file_timings": self.files,
+        }
+
+    def report(self, slowest=SLOWEST_FILES):
+        """Print the stage table and the `slowest` files."""
+        self.write(
+            f"{'stage':<12}{'files':>7}{'rows':>12}{'MB':>10}{'seconds':>10}"
+            f"{'rows/s':>12}{'MB/s':>8}"
+        )
+        for name, totals in self.stages.items():
+            seconds = totals["seconds"] or 1e-9
+            megabytes = totals["bytes"] / 1024**2
+            self.write(
+                f"{name:<12}{totals['files']:>7}{totals['rows']:>12}"
+                f"{megabytes:>10.1f}{totals['seconds']:>10.1f}"
+                f"{totals['rows'] / seconds:>12.0f}{megabytes / seconds:>8.1f}"
+            )
+
+        ranked = sorted(self.files, key=_file_seconds, reverse=True)[:slowest]
+        if ranked:
+            stages = [name for name, totals in self.stages.items() if totals["files"]]
+            self.write(f"Slowest {len(ranked)} of {len(self.files)} files:")
+            columns = "".join(f"{stage:>10}" for stage in stages)
+            self.write(f"{'file':<48}{columns}{'rows':>10}")
+            for record in ranked:
+                cells = "".join(
+                    f"{record['stages'][stage]['seconds']:>10.2f}"
+                    if stage in record["stages"]
+                    else f"{'-':>10}"
+                    for stage in stages
+                )
+                self.write(
+                    f"{record['file'][-48:]:<48}{cells}{_file_rows(record):>10}"
+                )
+        self.write(
+            f"{len(self.files)} files, {self.errors} errors in {self.elapsed():.1f}s"
+        )
+
+    def write_summary(self, path=None):
+        path = path or f"ingest_{self.command}_{self.started_at:%Y%m%d%H%M%S}.json"
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, default=str)
+            f.write("\n")
+        return path
+
+    def finish(self, path=None):
+        """Print the report and write the JSON summary; returns its path."""
+        self.report()
+        path = self.write_summary(path)
+        self.write(f"Ingest summary written to {path}")
+        return path
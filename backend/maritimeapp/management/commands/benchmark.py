@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from maritimeapp.benchmarks.generate import generate_dataset
+from maritimeapp.benchmarks.harness import compare, environment, write_results
+from maritimeapp.benchmarks.loader import (has_data, load_dataset,
+                                           working_directory)
+from maritimeapp.benchmarks.scenarios import run_scenarios
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic MAN dataset, load it with the ingest commands and "
+        "time every API view, writing the results as JSON. The measurement "
+        "tables are emptied first: run it against a scratch database only."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workdir",
+            default=os.path.join(settings.BASE_DIR, "benchmark_data"),
+            help="Directory for the generated files, caches and shards",
+        )
+        parser.add_argument("--cruises", type=int, default=50)
+        parser.add_argument(
+            "--points",
+            type=int,
+            default=2000,
+            help="Level 1.0 observations per cruise",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--loader", choices=["psql_add", "stream_load"], default="psql_add"
+        )
+        parser.add_argument(
+            "--skip-generate",
+            action="store_true",
+            help="Reuse the files already in --workdir/src",
+        )
+        parser.add_argument(
+            "--skip-load",
+            action="store_true",
+            help="Benchmark the views against the data already loaded",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Allow emptying tables that already hold data",
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Warm runs")
+        parser.add_argument(
+            "--only",
+            nargs="*",
+            default=None,
+            help="Only run the view scenarios whose name starts with these",
+        )
+        parser.add_argument(
+            "--output", default=None, help="Results file (default: in --workdir)"
+        )
+        parser.add_argument(
+            "--compare", default=None, help="Earlier results file to compare with"
+        )
+
+    def revision(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def handle(self, *args, **options):
+        workdir = os.path.abspath(options["workdir"])
+        os.makedirs(workdir, exist_ok=True)
+        source = os.path.join(workdir, "src")
+        log = self.stdout.write
+
+        dataset = {"cruises": options["cruises"], "points": options["points"]}
+        if not options["skip_generate"] and not options["skip_load"]:
+            summary = generate_dataset(
+                source, options["cruises"], options["points"], options["seed"], log
+            )
+            dataset = {key: summary[key] for key in ("points", "seed", "rows", "files")}
+            dataset["cruises"] = len(summary["cruises"])
+
+        overrides = {
+            "ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"],
+            "DOWNLOAD_CACHE_DIR": os.path.join(workdir, "download_cache"),
+            "EXPORT_JOB_DIR": os.path.join(workdir, "export_jobs"),
+            "EXPORT_SHARD_DIR": os.path.join(workdir, "export_shards"),
+        }
+        results = []
+        with override_settings(**overrides):
+            if not options["skip_load"]:
+                if has_data() and not options["reset"]:
+                    raise CommandError(
+                        "The database already holds data; pass --reset to empty "
+                        "it or --skip-load to benchmark it as it is."
+                    )
+                results += load_dataset(workdir, options["loader"], log)
+            # Archives pick up the data policy from ./src, as in production
+            with working_directory(workdir):
+                results += run_scenarios(options["repeat"], options["only"], log)
+            meta = {
+                "dataset": dataset,
+                "loader": None if options["skip_load"] else options["loader"],
+                "repeat": options["repeat"],
+                "revision": self.revision(),
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "environment": environment(),
+            }
+
+        output = options["output"] or os.path.join(
+            workdir, f"results_{datetime.now():%Y%m%d%H%M%S}.json"
+        )
+        payload = write_results(output, results, meta)
+
+        log(
+            f"{'scenario':<40}{'cold ms':>10}{'median ms':>11}{'rows/s':>12}"
+            f"{'queries':>9}{'RSS MB':>8}"
+        )
+        for result in results:
+            cold = result.get("cold_ms")
+            rate = result["rows_per_second"]
+            log(
+                f"{result['name']:<40}"
+                f"{cold if cold is not None else '-':>10}"
+                f"{result['latency_ms']['median']:>11.1f}"
+                f"{rate if rate is not None else '-':>12}"
+                f"{result['queries']:>9}{result['peak_rss_mb']:>8.1f}"
+            )
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)
+            for line in compare(previous, payload):
+                log(line)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {output}"))
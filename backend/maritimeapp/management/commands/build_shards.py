@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from maritimeapp.models import DataVersion
+from maritimeapp.shards import build_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the per-cruise CSV and Parquet export shards for the current "
+        "data version; downloads without a bbox are then assembled from them. "
+        "psql_add and stream_load run this at the end of an import."
+    )
+
+    def handle(self, *args, **options):
+        version = DataVersion.current()
+        count = build_shards(version, log=self.stdout.write)
+        self.stdout.write(
+            self.style.SUCCESS(f"Built {count} shards for data version {version}")
+        )
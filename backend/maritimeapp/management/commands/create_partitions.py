@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from maritimeapp.partitions import (LEVELS, PARTITIONED_TABLES, YEARS_AHEAD,
+                                    convert_table, ensure_partitions,
+                                    truncate_level)
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain the level/year partitions of the all_points tables: create "
+        "upcoming yearly partitions (run from cron), convert plain tables with "
+        "--convert, or empty one level ahead of a reingest with --truncate-level."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Convert the all_points tables to partitioned tables in place",
+        )
+        parser.add_argument(
+            "--years-ahead",
+            type=int,
+            default=YEARS_AHEAD,
+            help="Create partitions up to this many years past the current year",
+        )
+        parser.add_argument(
+            "--truncate-level",
+            type=int,
+            choices=LEVELS,
+            default=None,
+            help="TRUNCATE this level's partitions of both all_points tables",
+        )
+
+    def handle(self, *args, **options):
+        if options["convert"]:
+            for table_name in PARTITIONED_TABLES:
+                rows = convert_table(table_name, options["years_ahead"])
+                if rows is None:
+                    self.stdout.write(f"{table_name} is already partitioned")
+                else:
+                    self.stdout.write(f"Partitioned {table_name} ({rows} rows)")
+
+        if options["truncate_level"] is not None:
+            for table_name in PARTITIONED_TABLES:
+                truncate_level(table_name, options["truncate_level"])
+                self.stdout.write(
+                    f"Truncated level {options['truncate_level']} of {table_name}"
+                )
+
+        created = ensure_partitions(options["years_ahead"])
+        for name in created:
+            self.stdout.write(f"Created partition {name}")
+        self.stdout.write(
+            self.style.SUCCESS(f"Partitions up to date ({len(created)} created)")
+        )
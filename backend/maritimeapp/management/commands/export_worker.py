@@ -0,0 +1,91 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from maritimeapp.export_jobs import (claim_job, purge_expired, requeue_stale,
+                                     run_job)
+
+
+class Command(BaseCommand):
+    help = (
+        "Build queued download archives (see maritimeapp.export_jobs). Each "
+        "worker thread builds one archive at a time, so --workers caps the "
+        "export concurrency of this process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "EXPORT_WORKERS", 2),
+            help="Archives built concurrently by this process",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=2.0,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the queue and exit instead of polling forever",
+        )
+
+    def work(self, poll, once, stop):
+        try:
+            while not stop.is_set():
+                job = claim_job()
+                if job is None:
+                    if once:
+                        return
+                    stop.wait(poll)
+                    continue
+                self.stdout.write(f"Building export {job.job_id}")
+                if run_job(job):
+                    self.stdout.write(f"Finished export {job.job_id}")
+                else:
+                    self.stdout.write(f"Export {job.job_id} failed")
+        finally:
+            connections.close_all()
+
+    def housekeeping(self):
+        stale_after = timedelta(
+            seconds=getattr(settings, "EXPORT_JOB_STALE_SECONDS", 600)
+        )
+        requeued = requeue_stale(stale_after)
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stalled exports")
+        purged = purge_expired()
+        if purged:
+            self.stdout.write(f"Removed {purged} expired exports")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        self.housekeeping()
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(options["poll"], options["once"], stop),
+                daemon=True,
+            )
+            for _ in range(max(options["workers"], 1))
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1 if options["once"] else 60)
+                if not options["once"]:
+                    self.housekeeping()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping after the current exports...")
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.stdout.write(self.style.SUCCESS("Export worker stopped"))
@@ -17,6 +17,8 @@ from django.contrib.gis.geos import Point
 from django.core.management.base import BaseCommand
 from django.db import connections, transaction
 
+from maritimeapp.ingest import SITE_COLUMNS, convert_files, fingerprint_files
+from maritimeapp.ingest_telemetry import IngestRun
 from maritimeapp.models import *
 
 download_folder_path = os.path.join(".", "src")
@@ -45,28 +47,58 @@ def correct_date(value):
 class Command(BaseCommand):
     help = "Migrate man data tar to database."
 
-    site_cols = ["name", "aeronet_number", "description", "span_date"]
+    site_cols = SITE_COLUMNS
     site_df = pd.DataFrame(columns=site_cols)
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of processes used to convert files (default: CPU count)",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only convert files whose content changed since the last import",
+        )
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Download and extract the MAN archive even if ./src already exists",
+        )
+        parser.add_argument(
+            "--summary",
+            default=None,
+            help="Path of the JSON run summary (default: ./ingest_import_dd_<ts>.json)",
+        )
+
     @classmethod
-    def setup(self):
-        if os.path.exists(download_folder_path):
+    def setup(self, refresh=False, telemetry=None):
+        telemetry = telemetry or IngestRun("import_dd")
+        if os.path.exists(download_folder_path) and not refresh:
             print("Folder exists -> moving to creating threaded processes.")
         else:
             print("Folder does not exist -> creating folder and downloading man data.")
-            os.makedirs(download_folder_path)
+            os.makedirs(download_folder_path, exist_ok=True)
 
             # Download the MAN file from the static url
             url = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
-            response = requests.get(url)
+            with telemetry.stage("download") as downloaded:
+                response = requests.get(url)
+                downloaded["bytes"] = len(response.content)
 
             if not response.ok:
                 print("Server Offline. Attempt again Later.")
                 return
 
             tar_contents = response.content
-            with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
-                tar.extractall(path=download_folder_path)
+            with telemetry.stage("extract") as extracted:
+                with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
+                    tar.extractall(path=download_folder_path)
+                    extracted["bytes"] = sum(
+                        member.size for member in tar.getmembers() if member.isfile()
+                    )
             print(
                 f"MAN Data extracted to {download_folder_path} moving to extract and build."
             )
@@ -74,209 +106,81 @@ class Command(BaseCommand):
         to_be_csv_files = glob.glob(
             os.path.join(download_folder_path, "**", "*/*"), recursive=True
         )
-        subprocess.run(["mkdir", "-p", csv_dir])
-        subprocess.run(["cp", "-fr"] + to_be_csv_files + [csv_dir], check=True)
+        with telemetry.stage("extract"):
+            subprocess.run(["mkdir", "-p", csv_dir])
+            subprocess.run(["cp", "-fr"] + to_be_csv_files + [csv_dir], check=True)
         print(f"Folders copied to csv_directory moving to processing.")
 
-    def csv(self):
-
-        files_csv = glob.glob("./src_csvs/*")
-        aod_dict = {
-            "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
-            "Time(hh:mm:ss)": "time_HH_MM_SS",
-            "Air Mass": "air_mass",
-            "AOD_340nm": "aod_340nm",
-            "AOD_380nm": "aod_380nm",
-            "AOD_440nm": "aod_440nm",
-            "AOD_500nm": "aod_500nm",
-            "AOD_675nm": "aod_675nm",
-            "AOD_870nm": "aod_870nm",
-            "AOD_1020nm": "aod_1020nm",
-            "AOD_1640nm": "aod_1640nm",
-            "Water Vapor(cm)": "water_vapor_CM",
-            "440-870nm_Angstrom_Exponent": "angstrom_exponent_440_870",
-            "STD_340nm": "std_340nm",
-            "STD_380nm": "std_380nm",
-            "STD_440nm": "std_440nm",
-            "STD_500nm": "std_500nm",
-            "STD_675nm": "std_675nm",
-            "STD_870nm": "std_870nm",
-            "STD_1020nm": "std_1020nm",
-            "STD_1640nm": "std_1640nm",
-            "STD_Water_Vapor(cm)": "std_water_vapor_CM",
-            "STD_440-870nm_Angstrom_Exponent": "std_angstrom_exponent_440_870",
-            "Number_of_Observations": "number_of_observations",
-            "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
-            "AERONET_Number": "aeronet_number",
-            "Microtops_Number": "microtops_number",
-        }
-
-        sda_dict = {
-            "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
-            "Time(hh:mm:ss)": "time_HH_MM_SS",
-            "Julian_Day": "julian_day",
-            "Air_Mass": "air_mass",
-            "Total_AOD_500nm(tau_a)": "total_aod_500nm",
-            "Fine_Mode_AOD_500nm(tau_f)": "fine_mode_aod_500nm",
-            "Coarse_Mode_AOD_500nm(tau_c)": "coarse_mode_aod_500nm",
-            "FineModeFraction_500nm(eta)": "fine_mode_fraction_500nm",
-            "CoarseModeFraction_500nm(1_eta)": "coarse_mode_fraction_500nm",
-            "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "regression_dtau_a",
-            "RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "rmse_fine_mode_aod_500nm",
-            "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "rmse_coarse_mode_aod_500nm",
-            "RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "rmse_fmf_and_cmf_fractions_500nm",
-            "Angstrom_Exponent(AE)_Total_500nm(alpha)": "angstrom_exponent_total_500nm",
-            "dAE/dln(wavelength)_Total_500nm(alphap)": "dae_dln_wavelength_total_500nm",
-            "AE_Fine_Mode_500nm(alpha_f)": "ae_fine_mode_500nm",
-            "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "dae_dln_wavelength_fine_mode_500nm",
-            "870nm_Input_AOD": "aod_870nm",
-            "675nm_Input_AOD": "aod_675nm",
-            "500nm_Input_AOD": "aod_500nm",
-            "440nm_Input_AOD": "aod_440nm",
-            "380nm_Input_AOD": "aod_380nm",
-            "STDEV-Total_AOD_500nm(tau_a)": "stdev_total_aod_500nm",
-            "STDEV-Fine_Mode_AOD_500nm(tau_f)": "stdev_fine_mode_aod_500nm",
-            "STDEV-Coarse_Mode_AOD_500nm(tau_c)": "stdev_coarse_mode_aod_500nm",
-            "STDEV-FineModeFraction_500nm(eta)": "stdev_fine_mode_fraction_500nm",
-            "STDEV-CoarseModeFraction_500nm(1_eta)": "stdev_coarse_mode_fraction_500nm",
-            "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "stdev_regression_dtau_a",
-            "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "stdev_rmse_fine_mode_aod_500nm",
-            "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "stdev_rmse_coarse_mode_aod_500nm",
-            "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "stdev_rmse_fmf_and_cmf_fractions_500nm",
-            "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)": "stdev_angstrom_exponent_total_500nm",
-            "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)": "stdev_dae_dln_wavelength_total_500nm",
-            "STDEV-AE_Fine_Mode_500nm(alpha_f)": "stdev_ae_fine_mode_500nm",
-            "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "stdev_dae_dln_wavelength_fine_mode_500nm",
-            "STDEV-870nm_Input_AOD": "stdev_aod_870nm",
-            "STDEV-675nm_Input_AOD": "stdev_aod_675nm",
-            "STDEV-500nm_Input_AOD": "stdev_aod_500nm",
-            "Solar_Zenith_Angle": "solar_zenith_angle",
-            "STDEV-440nm_Input_AOD": "stdev_aod_440nm",
-            "STDEV-380nm_Input_AOD": "stdev_aod_380nm",
-            "Number_of_Observations": "number_of_observations",
-            "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
-            "AERONET_Number": "aeronet_number",
-            "Microtops_Number": "microtops_number",
-        }
-
-        def prepare_extract_data(file):
-            df = None
-            level = None
-            pi_info = None
-            pi = None
-            pi_email = None
-            cruise = None
-            lines = None
-            outputcsv = None
-            header = None
-
-            try:
-                with open(file, "r", encoding="latin-1") as f:
-                    lines = f.readlines()
-
-                pi_info = lines[3]
-                pi = (
-                    pi_info.split("=")[1]
-                    .split(",")[0]
-                    .replace("\n", "")
-                    .replace(",", ";")
-                )
-                pi_email = (
-                    pi_info.split(",Email=")[1].replace("\n", "").replace(",", ";")
-                )
-                cruise = lines[1].split(",")[0].replace("\n", "")
+    def changed_files(self, files, workers=None):
+        """Return the files whose fingerprint differs from the manifest."""
+        known = dict(SourceFile.objects.values_list("name", "sha256"))
+        fingerprints = {}
+        for fingerprint in fingerprint_files(files, workers=workers):
+            if known.get(fingerprint["name"]) != fingerprint["sha256"]:
+                fingerprints[fingerprint["file"]] = fingerprint
+        print(f"{len(fingerprints)} of {len(files)} source files changed.")
+        return fingerprints
+
+    def record_source_file(self, fingerprint, result):
+        SourceFile.objects.update_or_create(
+            name=fingerprint["name"],
+            defaults={
+                "cruise": result["cruise"],
+                "datatype": result["datatype"],
+                "level": int(result["level"]),
+                "size": fingerprint["size"],
+                "mtime": fingerprint["mtime"],
+                "sha256": fingerprint["sha256"],
+                "last_processing_date": result["last_processing_date"],
+                "output_csv": result["output"],
+                "loaded": False,
+            },
+        )
 
-                if ".lev" in file:
-                    level = file.split(".lev")[1]
-                    outputcsv = "." + file.split(".")[1] + "_AOD_" + level + ".csv"
-                else:
-                    level = file.split(".ONEILL_")[1]
-                    outputcsv = "." + file.split(".")[1] + "_SDA_" + level + ".csv"
-                header = lines[4].strip().split(",")
-                reg = re.compile(".*\(int\)")
-                bad_cols = list(filter(reg.match, header))
-                if bad_cols:
-                    for col in bad_cols:
-                        header[header.index(col)] = col.replace("(int)", "")
-
-                if "ONEILL_" in file:
-                    translated_cols = [
-                        sda_dict.get(header, header) for header in header
-                    ]
-                else:
-                    translated_cols = [
-                        aod_dict.get(header, header) for header in header
-                    ]
-                data = [line.strip().split(",") for line in lines[5:]]
-                df = pd.DataFrame(data, columns=header)
-
-                df.columns = translated_cols
-                df["coordinates"] = df.apply(
-                    lambda row: Point(float(row["Longitude"]), float(row["Latitude"])),
-                    axis=1,
-                )
-                df["coordinates_wkt"] = df.apply(
-                    lambda row: Point(float(row["Longitude"]), float(row["Latitude"])),
-                    axis=1,
-                )
-                df = df.drop(columns=["Longitude", "Latitude"])
-                df["date_DD_MM_YYYY"] = df["date_DD_MM_YYYY"].str.replace(
-                    ":", "-", regex=False
-                )
-                df["date_DD_MM_YYYY"] = pd.to_datetime(
-                    df["date_DD_MM_YYYY"], format="%d-%m-%Y", errors="coerce"
-                )
-                df["last_processing_date_DD_MM_YYYY"] = df[
-                    "last_processing_date_DD_MM_YYYY"
-                ].str.replace(":", "-", regex=False)
-                df["last_processing_date_DD_MM_YYYY"] = pd.to_datetime(
-                    df["last_processing_date_DD_MM_YYYY"],
-                    format="%d-%m-%Y",
-                    errors="coerce",
-                )
-                df["cruise"] = cruise
-                df["level"] = level
-                df["pi"] = pi
-                df["pi_email"] = pi_email
-                df.to_csv(outputcsv, index=False)
-
-                if "daily.lev15" in file:
-                    self.site_df = pd.concat(
-                        [
-                            pd.DataFrame(
-                                [
-                                    [
-                                        df.loc[0]["cruise"],
-                                        df.loc[0]["aeronet_number"],
-                                        "?",
-                                        {},
-                                    ]
-                                ],
-                                columns=self.site_cols,
-                            ),
-                            self.site_df,
-                        ],
-                        ignore_index=True,
-                    )
-            except Exception as e:
+    def csv(self, workers=None, incremental=False, telemetry=None):
+        telemetry = telemetry or IngestRun("import_dd")
+        files_csv = [
+            file
+            for file in glob.glob("./src_csvs/*")
+            if os.path.isfile(file) and ".csv" not in file
+        ]
+
+        fingerprints = None
+        if incremental:
+            with telemetry.stage("fingerprint") as fingerprinted:
+                fingerprinted["bytes"] = sum(map(os.path.getsize, files_csv))
+                fingerprints = self.changed_files(files_csv, workers=workers)
+            files_csv = list(fingerprints)
+
+        telemetry.expected = len(files_csv)
+        site_rows = []
+        for result in convert_files(files_csv, workers=workers):
+            telemetry.record_file(
+                result["file"],
+                result["timings"],
+                error=result["error"] and result["error"]["error"],
+            )
+            if result["error"] is not None:
+                error = result["error"]
                 with open(log_filename, "a") as log_file:
                     print("\n\n\n Err")
-                    print(e)
-                    log_file.write(f"failed to create csv {cruise} - File: {file})\n")
-                    log_file.write(f"Header: {header}\n")
-                    # log_file.write(f"new: {df.columns}\n")
-                    log_file.write(f"Error: {e}\n\n")
-
-        for file in files_csv:
-            if os.path.isfile(file) and ".csv" not in file:
-                # print(file)
-                prepare_extract_data(file)
-
-        # Process -
-        # Make folder output_fp = os.path.join(".", "src_csvs")
-        # Output to os.path.join(output_fp, "{AOD/SDA}_name.split((type)[0]).csv")
-        # Save Data That needs to be appended or sent to table
-        # Grab PI from header/PI Email from header using readline to preprocess this.
+                    print(error["error"])
+                    log_file.write(
+                        f"failed to create csv {error['cruise']} "
+                        f"- File: {result['file']})\n"
+                    )
+                    log_file.write(f"Header: {error['header']}\n")
+                    log_file.write(f"Error: {error['error']}\n\n")
+                continue
+            if result["site"] is not None:
+                site_rows.append(result["site"])
+            if fingerprints is not None:
+                self.record_source_file(fingerprints[result["file"]], result)
+
+        self.site_df = pd.concat(
+            [pd.DataFrame(site_rows, columns=self.site_cols), self.site_df],
+            ignore_index=True,
+        )
 
     def setup_header_table(self):
         files = []
@@ -350,9 +254,15 @@ class Command(BaseCommand):
             addHeadToDB(file)
 
     def handle(self, *args, **kwargs):
-        self.setup()
+        telemetry = IngestRun("import_dd", self.stdout.write)
+        self.setup(refresh=kwargs.get("refresh", False), telemetry=telemetry)
         self.setup_header_table()
         # print("n")
-        self.csv()
+        self.csv(
+            workers=kwargs.get("workers"),
+            incremental=kwargs.get("incremental", False),
+            telemetry=telemetry,
+        )
         self.site_df.to_csv("./src_csvs/sites.csv", index=False)
+        telemetry.finish(kwargs.get("summary"))
         # self.push_to_db()
@@ -10,6 +10,7 @@ import requests
 from django.contrib.gis.geos import Point
 from django.core.management.base import BaseCommand
 from django.db.models import Max, Min
+from maritimeapp.ingest_telemetry import IngestRun, timed
 from maritimeapp.models import *
 from rest_framework.exceptions import ValidationError
 
@@ -204,34 +205,50 @@ class Command(BaseCommand):
             print("Site Name change error occurred", e)
 
         chunk_size = 1000
-        reader = pd.read_csv(
-            lev_file,
-            nrows=chunk_size,
-            skiprows=5,
-            header=None,
-            chunksize=chunk_size,
-            encoding="latin-1",
-        )
+        timings = {}
+        with timed(timings, "parse") as parsed:
+            reader = pd.read_csv(
+                lev_file,
+                nrows=chunk_size,
+                skiprows=5,
+                header=None,
+                chunksize=chunk_size,
+                encoding="latin-1",
+            )
+            chunks = list(reader)
+            parsed["bytes"] = os.path.getsize(lev_file)
+            parsed["rows"] = sum(len(chunk) for chunk in chunks)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-            futures = [
-                executor.submit(self.process_chunk, chunk, file_type, site, file_name)
-                for chunk in reader
-            ]
-            concurrent.futures.wait(futures)
+        with timed(timings, "convert") as converted:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=NUM_WORKERS
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self.process_chunk, chunk, file_type, site, file_name
+                    )
+                    for chunk in chunks
+                ]
+                concurrent.futures.wait(futures)
+            converted["rows"] = parsed["rows"]
+
+        with timed(timings, "insert") as inserted:
             for future in concurrent.futures.as_completed(futures):
                 try:
                     if future.result() is None:
                         print(future.keys)
                     else:
                         SiteMeasurementsDaily15.objects.bulk_create(future.result())
+                        inserted["rows"] += len(future.result())
                         print(len(self.data))
 
                 except Exception as exc:
                     print(f"Exception occurred: {exc}")
+        self.telemetry.record_file(lev_file, timings)
 
     def handle(self, *args, **options):
         print("Attempting Session")
+        self.telemetry = IngestRun("populate")
         file_endings = [
             "all_points.lev10",
             "all_points.lev15",
@@ -251,7 +268,9 @@ class Command(BaseCommand):
 
         # Download the MAN file from the static URL
         url = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
-        response = requests.get(url)
+        with self.telemetry.stage("download") as downloaded:
+            response = requests.get(url)
+            downloaded["bytes"] = len(response.content)
 
         if not response.ok:
             print("Server Offline. Attempt again Later.")
@@ -259,8 +278,12 @@ class Command(BaseCommand):
 
         tar_contents = response.content
 
-        with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
-            tar.extractall(path=r"./src")
+        with self.telemetry.stage("extract") as extracted:
+            with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
+                tar.extractall(path=r"./src")
+                extracted["bytes"] = sum(
+                    member.size for member in tar.getmembers() if member.isfile()
+                )
         print("MAN Data Downloaded ...")
 
         # Read the folder contents
@@ -302,8 +325,11 @@ class Command(BaseCommand):
                     #         )
                     #     )
 
+            self.telemetry.expected = len(futures)
             for future in concurrent.futures.as_completed(futures):
                 try:
                     pass
                 except Exception as exc:
                     print(f"Exception occurred: {exc}")
+
+        self.telemetry.finish()
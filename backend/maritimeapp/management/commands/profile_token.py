@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from maritimeapp.profiling import make_token, profiler_enabled
+
+
+class Command(BaseCommand):
+    help = (
+        "Print a signed token that makes a request profiled when sent as the "
+        "X-Profile header or the `profile` query parameter (see "
+        "maritimeapp.profiling)."
+    )
+
+    def handle(self, *args, **options):
+        if not profiler_enabled():
+            self.stderr.write("PROFILER_ENABLED is off; the token will be ignored.")
+        max_age = getattr(settings, "PROFILER_TOKEN_MAX_AGE", 3600)
+        self.stdout.write(make_token())
+        self.stderr.write(f"Valid for {max_age} seconds.")
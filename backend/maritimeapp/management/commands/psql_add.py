@@ -1,121 +1,427 @@
 import csv
+import glob
+import json
 import os
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from contextlib import contextmanager
 
 import psycopg2
-from django.conf import settings
 from django.core.management.base import BaseCommand
 from psycopg2 import sql
 
-DB_PARAMS = {
-    "dbname": settings.DATABASES["default"]["NAME"],
-    "user": settings.DATABASES["default"]["USER"],
-    "password": settings.DATABASES["default"]["PASSWORD"],
-    "host": settings.DATABASES["default"]["HOST"],
-    "port": settings.DATABASES["default"]["PORT"],
-}
+from maritimeapp.db import borrow_connection, close_pool, return_connection
+from maritimeapp.derived import refresh_derived_tables
+from maritimeapp.ingest_telemetry import IngestRun, timing
+from maritimeapp.models import DataVersion, SourceFile
+from maritimeapp.shards import build_shards
 
 CSV_FOLDER = "./src_csvs/"
 
+_on_only = re.compile(r"\bON ONLY\b")
+_create_index = re.compile(r"^CREATE (UNIQUE )?INDEX ")
+
+
+def table_for_csv(filename):
+    table_name = filename.replace(".csv", "")
+    if "series_SDA" in filename:
+        table_name = "maritimeapp_downloadsdaseries"
+    if "all_points_SDA" in filename:
+        table_name = "maritimeapp_downloadsdaap"
+    if "daily_SDA" in filename:
+        table_name = "maritimeapp_downloadsdadaily"
+    if "series_AOD" in filename:
+        table_name = "maritimeapp_downloadaodseries"
+    if "all_points_AOD" in filename:
+        table_name = "maritimeapp_downloadaodap"
+    if "daily_AOD" in filename:
+        table_name = "maritimeapp_downloadaoddaily"
+    return table_name
+
+
+def rebuild_definition(indexdef):
+    """
+    The statement recreating an index from its `pg_indexes.indexdef`. On a
+    partitioned table the definition reads `ON ONLY <parent>`, which would
+    build an invalid index on the parent alone; without ONLY it cascades to
+    every partition, as dropping it did. IF NOT EXISTS lets an interrupted
+    rebuild be replayed.
+    """
+    indexdef = _create_index.sub(r"CREATE \1INDEX IF NOT EXISTS ", indexdef, count=1)
+    return _on_only.sub("ON", indexdef, count=1)
+
+
+def dropped_indexes_path(table_name):
+    """Where the definitions of a table's dropped indexes are kept until rebuilt."""
+    return os.path.join(CSV_FOLDER, f".dropped_indexes_{table_name}.json")
+
 
 class Command(BaseCommand):
     help = "Bulk import CSV files into PostgreSQL"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only reload cruises whose source files changed (see import_dd)",
+        )
+        parser.add_argument(
+            "--parallel",
+            action="store_true",
+            help="Load all target tables concurrently, one connection per table",
+        )
+        parser.add_argument(
+            "--rebuild-indexes",
+            action="store_true",
+            help="With --parallel, drop secondary indexes during the load and "
+            "rebuild them afterwards",
+        )
+        parser.add_argument(
+            "--summary",
+            default=None,
+            help="Path of the JSON run summary (default: ./ingest_psql_add_<ts>.json)",
+        )
+        parser.add_argument(
+            "--no-shards",
+            action="store_true",
+            help="Skip rebuilding the export shards (run build_shards later)",
+        )
+
     def handle(self, *args, **kwargs):
-        self.bulk_load_csvs_from_folder()
-        # self.list_table_names()
+        self.telemetry = IngestRun("psql_add", self.stdout.write)
+        self.write_shards = not kwargs.get("no_shards")
+        try:
+            self.restore_dropped_indexes()
+            if kwargs.get("incremental"):
+                self.incremental_load()
+                return
+            if kwargs.get("parallel"):
+                self.parallel_load(
+                    rebuild_indexes=kwargs.get("rebuild_indexes", False)
+                )
+                return
+            self.bulk_load_csvs_from_folder()
+            # self.list_table_names()
+        finally:
+            close_pool()
+            self.telemetry.finish(kwargs.get("summary"))
 
+    @contextmanager
     def get_db_connection(self):
+        """Borrow a pooled connection; yields None if the database is unreachable."""
         try:
-            conn = psycopg2.connect(**DB_PARAMS)
-            return conn
-        except Exception as e:
+            conn = borrow_connection()
+        except psycopg2.Error as e:
             self.stdout.write(f"Error connecting to PostgreSQL: {e}")
-            return None
-
-    def load_csv_to_postgres(self, csv_file, table_name):
-        self.stdout.write(f"Loading {csv_file} into {table_name}...")
-        with open(csv_file, "r", encoding="utf-8") as f:
-            csv_reader = csv.reader(f)
-            headers = next(csv_reader)
-            conn = self.get_db_connection()
-            if not conn:
-                self.stdout.write(
-                    f"Could not connect to the database. Skipping {csv_file}"
-                )
-                return
+            conn = None
+        try:
+            yield conn
+        finally:
+            if conn is not None:
+                return_connection(conn)
 
-            cursor = conn.cursor()
+    def finish_import(self):
+        """
+        Refresh the derived tables, retire everything cached and write the
+        export shards of the new data version.
+        """
+        for name, rows in refresh_derived_tables().items():
+            self.stdout.write(f"Refreshed {name}: {rows} rows")
+        version = DataVersion.bump()
+        self.stdout.write(f"Data version is now {version}")
+        if self.write_shards:
+            build_shards(version, log=self.stdout.write)
 
+    def copy_csv(self, cursor, csv_file, table_name):
+        """COPY one CSV into `table_name`, recording its timing."""
+        start = time.perf_counter()
+        with open(csv_file, "r", encoding="utf-8") as f:
+            headers = next(csv.reader(f))
+            f.seek(0)
             insert_query = sql.SQL(
                 "COPY {} ({}) FROM STDIN WITH CSV HEADER DELIMITER ','"
             ).format(
                 sql.Identifier(table_name),
                 sql.SQL(",").join(map(sql.Identifier, headers)),
             )
+            cursor.copy_expert(insert_query, f)
+        copied = timing(
+            time.perf_counter() - start,
+            os.path.getsize(csv_file),
+            max(cursor.rowcount, 0),
+        )
+        self.telemetry.record_file(csv_file, {"copy": copied}, table=table_name)
 
-            try:
-                with open(csv_file, "r", encoding="utf-8") as f:
-                    cursor.copy_expert(insert_query, f)
-                conn.commit()
-                self.stdout.write(f"Successfully loaded {csv_file} into {table_name}")
-            except Exception as e:
-                self.stdout.write(f"Error loading {csv_file} into {table_name}: {e}")
-                conn.rollback()
-            finally:
-                cursor.close()
-                conn.close()
+    def load_csv_to_postgres(self, csv_file, table_name):
+        self.stdout.write(f"Loading {csv_file} into {table_name}...")
+        with self.get_db_connection() as conn:
+            if not conn:
+                self.stdout.write(
+                    f"Could not connect to the database. Skipping {csv_file}"
+                )
+                return
 
-    def get_db_connection(self):
-        try:
-            conn = psycopg2.connect(**DB_PARAMS)
-            return conn
-        except Exception as e:
-            print(f"Error connecting to PostgreSQL: {e}")
-            return None
+            with conn.cursor() as cursor:
+                try:
+                    self.copy_csv(cursor, csv_file, table_name)
+                    conn.commit()
+                    self.stdout.write(
+                        f"Successfully loaded {csv_file} into {table_name}"
+                    )
+                except Exception as e:
+                    self.stdout.write(
+                        f"Error loading {csv_file} into {table_name}: {e}"
+                    )
+                    self.telemetry.record_file(csv_file, error=str(e), table=table_name)
+                    conn.rollback()
 
     def list_table_names(self):
-        conn = self.get_db_connection()
-        if not conn:
-            print("Could not connect to the database.")
-            return []
-
-        cursor = conn.cursor()
-
-        query = """
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema = 'public'
-            AND table_type = 'BASE TABLE';
-        """
+        with self.get_db_connection() as conn:
+            if not conn:
+                print("Could not connect to the database.")
+                return []
 
-        cursor.execute(query)
-        tables = cursor.fetchall()
+            cursor = conn.cursor()
+
+            query = """
+                SELECT table_name
+                FROM information_schema.tables
+                WHERE table_schema = 'public'
+                AND table_type = 'BASE TABLE';
+            """
+
+            cursor.execute(query)
+            tables = cursor.fetchall()
 
-        table_names = [table[0] for table in tables]
+            table_names = [table[0] for table in tables]
 
-        print(table_names)
-        cursor.close()
-        conn.close()
+            print(table_names)
+            cursor.close()
 
         return table_names
 
     def bulk_load_csvs_from_folder(self):
+        # sites.csv is in the folder and is loaded once more at the end
+        self.telemetry.expected = 1 + sum(
+            filename.endswith(".csv") for filename in os.listdir(CSV_FOLDER)
+        )
         for filename in os.listdir(CSV_FOLDER):
             if filename.endswith(".csv"):
                 csv_file = os.path.join(CSV_FOLDER, filename)
-                table_name = filename.replace(".csv", "")
-                if "series_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdaseries"
-                if "all_points_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdaap"
-                if "daily_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdadaily"
-                if "series_AOD" in filename:
-                    table_name = "maritimeapp_downloadaodseries"
-                if "all_points_AOD" in filename:
-                    table_name = "maritimeapp_downloadaodap"
-                if "daily_AOD" in filename:
-                    table_name = "maritimeapp_downloadaoddaily"
-
+                table_name = table_for_csv(filename)
                 self.load_csv_to_postgres(csv_file, table_name)
         self.load_csv_to_postgres("./src_csvs/sites.csv", "maritimeapp_site")
+        self.finish_import()
+
+    def drop_indexes(self, cursor, table_name):
+        """
+        Drop the table's non-constraint indexes, returning their definitions.
+        On a partitioned table this drops the indexes of every partition too.
+        The definitions are written to `dropped_indexes_path` first, so a load
+        that dies before rebuilding them can be repaired by the next run.
+        """
+        cursor.execute(
+            """
+            SELECT i.indexname, i.indexdef
+            FROM pg_indexes i
+            WHERE i.tablename = %s
+            AND i.indexname NOT IN (
+                SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass
+            )
+            """,
+            [table_name, table_name],
+        )
+        indexes = cursor.fetchall()
+        if indexes:
+            self.record_dropped_indexes(
+                table_name, [definition for _, definition in indexes]
+            )
+        for index_name, _ in indexes:
+            cursor.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(index_name)))
+        return [definition for _, definition in indexes]
+
+    def record_dropped_indexes(self, table_name, definitions):
+        path = dropped_indexes_path(table_name)
+        # Keep the definitions of an earlier, unrepaired drop as well
+        if os.path.isfile(path):
+            with open(path) as f:
+                recorded = json.load(f)
+            definitions = recorded + [d for d in definitions if d not in recorded]
+        with open(path + ".tmp", "w") as f:
+            json.dump(definitions, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def rebuild_indexes(self, conn, cursor, table_name, definitions):
+        """Recreate the dropped indexes and forget their recorded definitions."""
+        self.stdout.write(f"Rebuilding {len(definitions)} indexes on {table_name}")
+        for definition in definitions:
+            cursor.execute(rebuild_definition(definition))
+        conn.commit()
+        os.remove(dropped_indexes_path(table_name))
+
+    def restore_dropped_indexes(self):
+        """Rebuild the indexes an interrupted --rebuild-indexes load left dropped."""
+        pattern = dropped_indexes_path("*")
+        prefix, suffix = pattern.split("*")
+        for path in sorted(glob.glob(pattern)):
+            table_name = path[len(prefix) : -len(suffix)]
+            with open(path) as f:
+                definitions = json.load(f)
+            with self.get_db_connection() as conn:
+                if not conn:
+                    return
+                with conn.cursor() as cursor:
+                    self.rebuild_indexes(conn, cursor, table_name, definitions)
+
+    def load_table(self, table_name, csv_files, rebuild_indexes=False):
+        """COPY every file of one table over a single connection."""
+        stats = {"table": table_name, "files": 0, "rows": 0, "bytes": 0, "errors": 0}
+        start = time.perf_counter()
+        with self.get_db_connection() as conn:
+            if not conn:
+                stats["errors"] = len(csv_files)
+                stats["seconds"] = 0.0
+                return stats
+
+            index_definitions = []
+            with conn.cursor() as cursor:
+                if rebuild_indexes:
+                    index_definitions = self.drop_indexes(cursor, table_name)
+                    conn.commit()
+
+                try:
+                    for csv_file in csv_files:
+                        try:
+                            self.copy_csv(cursor, csv_file, table_name)
+                            conn.commit()
+                            stats["files"] += 1
+                            stats["rows"] += max(cursor.rowcount, 0)
+                            stats["bytes"] += os.path.getsize(csv_file)
+                        except Exception as e:
+                            conn.rollback()
+                            stats["errors"] += 1
+                            self.stdout.write(
+                                f"Error loading {csv_file} into {table_name}: {e}"
+                            )
+                            self.telemetry.record_file(
+                                csv_file, error=str(e), table=table_name
+                            )
+                finally:
+                    if index_definitions:
+                        conn.rollback()
+                        self.rebuild_indexes(
+                            conn, cursor, table_name, index_definitions
+                        )
+
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def report_throughput(self, results):
+        self.stdout.write(
+            f"{'table':<32}{'files':>7}{'errors':>8}{'rows':>12}{'MB':>10}"
+            f"{'seconds':>10}{'rows/s':>12}{'MB/s':>8}"
+        )
+        for stats in sorted(results, key=lambda stats: stats["table"]):
+            seconds = stats["seconds"] or 1e-9
+            megabytes = stats["bytes"] / 1024**2
+            self.stdout.write(
+                f"{stats['table']:<32}{stats['files']:>7}{stats['errors']:>8}"
+                f"{stats['rows']:>12}{megabytes:>10.1f}{stats['seconds']:>10.1f}"
+                f"{stats['rows'] / seconds:>12.0f}{megabytes / seconds:>8.1f}"
+            )
+
+    def parallel_load(self, rebuild_indexes=False):
+        files_by_table = defaultdict(list)
+        for filename in sorted(os.listdir(CSV_FOLDER)):
+            if filename.endswith(".csv") and filename != "sites.csv":
+                csv_file = os.path.join(CSV_FOLDER, filename)
+                files_by_table[table_for_csv(filename)].append(csv_file)
+        self.telemetry.expected = sum(map(len, files_by_table.values())) + 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(len(files_by_table), 1)) as executor:
+            futures = [
+                executor.submit(self.load_table, table_name, csv_files, rebuild_indexes)
+                for table_name, csv_files in files_by_table.items()
+            ]
+            results = [future.result() for future in futures]
+
+        self.load_csv_to_postgres("./src_csvs/sites.csv", "maritimeapp_site")
+        self.report_throughput(results)
+        self.stdout.write(f"Parallel load took {time.perf_counter() - start:.1f}s")
+
+        self.finish_import()
+
+    def upsert_sites(self, cursor, csv_file):
+        # sites.csv only holds the cruises converted in this run; existing
+        # sites keep their description and span.
+        cursor.execute(
+            "CREATE TEMP TABLE incoming_sites "
+            "(LIKE maritimeapp_site INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        self.copy_csv(cursor, csv_file, "incoming_sites")
+        cursor.execute(
+            """
+            INSERT INTO maritimeapp_site (name, aeronet_number, description, span_date)
+            SELECT name, aeronet_number, description, span_date FROM incoming_sites
+            ON CONFLICT (name) DO UPDATE SET aeronet_number = EXCLUDED.aeronet_number
+            """
+        )
+
+    def incremental_load(self):
+        """
+        Replace the rows of every cruise/level whose source file changed.
+
+        The deletes, COPYs and manifest update run in a single transaction, so
+        readers either see the previous data or the fully reloaded cruises.
+        """
+        pending = list(SourceFile.objects.filter(loaded=False).exclude(output_csv=""))
+        if not pending:
+            self.stdout.write("No changed source files to load.")
+            return
+        self.telemetry.expected = len(pending)
+
+        with self.get_db_connection() as conn:
+            if not conn:
+                self.stdout.write("Could not connect to the database.")
+                return
+
+            try:
+                with conn:
+                    with conn.cursor() as cursor:
+                        for source in pending:
+                            table_name = table_for_csv(
+                                os.path.basename(source.output_csv)
+                            )
+                            cursor.execute(
+                                sql.SQL(
+                                    "DELETE FROM {} WHERE cruise = %s AND level = %s"
+                                ).format(sql.Identifier(table_name)),
+                                [source.cruise, source.level],
+                            )
+                            self.stdout.write(
+                                f"Replacing {cursor.rowcount} rows of {source.cruise} "
+                                f"in {table_name}"
+                            )
+                            self.copy_csv(cursor, source.output_csv, table_name)
+
+                        sites_csv = os.path.join(CSV_FOLDER, "sites.csv")
+                        if os.path.isfile(sites_csv):
+                            self.upsert_sites(cursor, sites_csv)
+
+                        cursor.execute(
+                            "UPDATE maritimeapp_sourcefile SET loaded = TRUE "
+                            "WHERE id = ANY(%s)",
+                            [[source.id for source in pending]],
+                        )
+                self.stdout.write(f"Reloaded {len(pending)} changed source files.")
+            except Exception as e:
+                self.stdout.write(f"Incremental load failed, nothing was changed: {e}")
+                return
+
+        self.finish_import()
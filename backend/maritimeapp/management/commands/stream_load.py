@@ -0,0 +1,174 @@
+import io
+import tarfile
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+from psycopg2 import sql
+
+from maritimeapp.db import close_pool, pooled_connection
+from maritimeapp.derived import refresh_derived_tables
+from maritimeapp.ingest import (TABLES, ChunkPipe, copy_columns,
+                                describe_file, describe_frequency,
+                                is_measurement_file, iter_copy_rows,
+                                iter_csv_bytes, parse_preamble)
+from maritimeapp.ingest_telemetry import IngestRun, timing
+from maritimeapp.models import DataVersion
+from maritimeapp.shards import build_shards
+
+MAN_URL = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream the MAN tarball straight into the database: tar members are "
+        "parsed as they are read and fed to COPY FROM STDIN, with no extracted "
+        "tree or intermediate CSV files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tarball",
+            default=None,
+            help="Load from a local All_MAN_Data_V3.tar.gz instead of downloading it",
+        )
+        parser.add_argument("--url", default=MAN_URL, help="Tarball URL")
+        parser.add_argument(
+            "--truncate",
+            action="store_true",
+            help="Empty the measurement tables first (in the same transaction)",
+        )
+        parser.add_argument(
+            "--summary",
+            default=None,
+            help="Path of the JSON run summary "
+            "(default: ./ingest_stream_load_<ts>.json)",
+        )
+        parser.add_argument(
+            "--no-shards",
+            action="store_true",
+            help="Skip rebuilding the export shards (run build_shards later)",
+        )
+
+    def open_source(self, tarball, url):
+        if tarball:
+            return open(tarball, "rb")
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+
+    def record_header(self, cursor, name, preamble):
+        datatype, level = describe_file(name)
+        cursor.execute(
+            """
+            INSERT INTO maritimeapp_tableheader
+                (freq, datatype, level, base_header_l1, base_header_l2)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (datatype, level, freq) DO NOTHING
+            """,
+            [describe_frequency(name), datatype, level, preamble[0], preamble[2]],
+        )
+
+    def load_member(self, cursor, name, handle):
+        """COPY one tar member into its table; returns (table, rows, bytes)."""
+        datatype, level = describe_file(name)
+        table_name = TABLES[(datatype, describe_frequency(name))]
+
+        lines = io.TextIOWrapper(handle, encoding="latin-1")
+        preamble = [lines.readline() for _ in range(5)]
+        cruise, pi, pi_email, header = parse_preamble(preamble)
+        self.record_header(cursor, name, preamble)
+
+        columns = copy_columns(header, datatype)
+        aeronet_index = columns.index("aeronet_number")
+        counter = {"rows": 0, "aeronet_number": None}
+
+        def counted(rows):
+            for row in rows:
+                if counter["rows"] == 0:
+                    counter["aeronet_number"] = row[aeronet_index]
+                counter["rows"] += 1
+                yield row
+
+        rows = counted(iter_copy_rows(lines, header, cruise, level, pi, pi_email))
+        pipe = ChunkPipe(iter_csv_bytes(rows))
+        statement = sql.SQL("COPY {} ({}) FROM STDIN WITH CSV").format(
+            sql.Identifier(table_name),
+            sql.SQL(",").join(map(sql.Identifier, columns)),
+        )
+        cursor.copy_expert(statement, pipe)
+
+        if "daily.lev15" in name and counter["rows"]:
+            self.sites[cruise] = counter["aeronet_number"]
+        return table_name, counter["rows"], pipe.bytes_read
+
+    def upsert_sites(self, cursor):
+        for name, aeronet_number in self.sites.items():
+            cursor.execute(
+                """
+                INSERT INTO maritimeapp_site
+                    (name, aeronet_number, description, span_date)
+                VALUES (%s, %s, '?', '{}')
+                ON CONFLICT (name)
+                    DO UPDATE SET aeronet_number = EXCLUDED.aeronet_number
+                """,
+                [name, aeronet_number],
+            )
+
+    def handle(self, *args, **options):
+        self.sites = {}
+        # Download, extraction, parsing and COPY overlap here, so each member
+        # is timed as a single "stream" stage.
+        telemetry = IngestRun("stream_load", self.stdout.write)
+        source = self.open_source(options["tarball"], options["url"])
+        loaded = 0
+        try:
+            with pooled_connection() as conn, conn, conn.cursor() as cursor:
+                if options["truncate"]:
+                    cursor.execute(
+                        sql.SQL("TRUNCATE {}").format(
+                            sql.SQL(",").join(map(sql.Identifier, TABLES.values()))
+                        )
+                    )
+
+                with tarfile.open(fileobj=source, mode="r|gz") as tar:
+                    for member in tar:
+                        if not member.isfile() or not is_measurement_file(member.name):
+                            continue
+                        # A bad member is rolled back on its own and skipped
+                        cursor.execute("SAVEPOINT member")
+                        start = time.perf_counter()
+                        try:
+                            table_name, rows, size = self.load_member(
+                                cursor, member.name, tar.extractfile(member)
+                            )
+                            cursor.execute("RELEASE SAVEPOINT member")
+                            loaded += 1
+                            streamed = timing(time.perf_counter() - start, size, rows)
+                            telemetry.record_file(
+                                member.name, {"stream": streamed}, table=table_name
+                            )
+                            self.stdout.write(
+                                f"{member.name}: {rows} rows ({size} bytes) "
+                                f"-> {table_name}"
+                            )
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT member")
+                            self.stdout.write(f"Error loading {member.name}: {e}")
+                            telemetry.record_file(member.name, error=str(e))
+
+                self.upsert_sites(cursor)
+        finally:
+            source.close()
+            close_pool()
+
+        for name, rows in refresh_derived_tables().items():
+            self.stdout.write(f"Refreshed {name}: {rows} rows")
+        version = DataVersion.bump()
+        if not options["no_shards"]:
+            build_shards(version, log=self.stdout.write)
+        self.stdout.write(
+            self.style.SUCCESS(f"Loaded {loaded} files, data version is now {version}")
+        )
+        telemetry.finish(options["summary"])
@@ -1,17 +1,20 @@
 from django.core.management.base import BaseCommand
 
-from maritimeapp.models import Site
+from maritimeapp.derived import refresh_derived_tables
+from maritimeapp.models import DataVersion
 
 
 class Command(BaseCommand):
-    help = "Updates span_date field for all Site records"
+    help = (
+        "Updates span_date field for all Site records and the other derived "
+        "tables, then bumps the data version so cached responses are retired "
+        "(run build_shards afterwards for shard-backed downloads)"
+    )
 
     def handle(self, *args, **kwargs):
-        sites = Site.objects.all()
-        for site in sites:
-            site.update_span_date()
+        for name, rows in refresh_derived_tables().items():
             self.stdout.write(
-                self.style.SUCCESS(
-                    f"Successfully updated span_date for site: {site.name}"
-                )
+                self.style.SUCCESS(f"Successfully refreshed {name}: {rows}")
             )
+        version = DataVersion.bump()
+        self.stdout.write(f"Data version is now {version}")
@@ -0,0 +1,308 @@
+"""
+Query and encoding helpers for the site_measurements view.
+
+Besides the original one-object-per-row JSON, measurements can be returned in
+a columnar layout: parallel arrays of site, date, time, lng, lat and value,
+either as compact JSON or as an Arrow IPC stream. Columnar responses read the
+coordinates with ST_X/ST_Y in SQL, so no GEOS Point objects are created.
+
+With `resolution` (grid cell size in degrees) or `max_points`, the points of
+each cruise are binned on a spatial grid in SQL and one row per occupied cell
+is returned: the mean position, the date and time of the first measurement and
+the mean/min/max/count of the reading (missing -999 values excluded). The grid
+for `max_points` is estimated from the extent and row count of the data and
+refined at most once. When the bins still exceed `max_points` (e.g. more
+cruises than that), they are sampled at an even stride and the response is
+flagged as truncated.
+"""
+
+import io
+import json
+import math
+
+import pyarrow as pa
+from django.contrib.gis.db.models import Extent
+from django.contrib.gis.geos import Polygon
+from django.db import models
+from django.db.models import (Avg, Count, DateTimeField, ExpressionWrapper, F,
+                              FloatField, Func, Max, Min, Q)
+from django.db.models.functions import Floor
+from django.http import HttpResponse, JsonResponse
+from django.utils.dateparse import parse_date
+
+from .models import DownloadAODDaily, Site
+
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+# Values of the `format` request field
+ROW_FORMAT = "rows"
+COLUMNAR_FORMAT = "columnar"
+ARROW_FORMAT = "arrow"
+
+MISSING_VALUE = -999.0
+# Grid cells tried when fitting `max_points`: one spanning the globe, and one
+# small enough to keep every measurement position in its own cell
+MAX_RESOLUTION = 360.0
+MIN_RESOLUTION = 1e-6
+
+
+def reading_fields(model=DownloadAODDaily):
+    return [
+        field.name
+        for field in model._meta.get_fields()
+        if isinstance(field, models.FloatField)
+    ]
+
+
+def _request_date(value):
+    """Parse an ISO date of a request, raising ValueError if it is not one."""
+    try:
+        # Raises ValueError itself for well formed but impossible dates
+        parsed = parse_date(value)
+    except (TypeError, ValueError):
+        parsed = None
+    if parsed is None:
+        raise ValueError(f"Invalid date: {value}")
+    return parsed
+
+
+def filter_measurements(data, model=DownloadAODDaily, level=15):
+    """
+    Apply the site, bbox and date filters of a measurements request. Raises
+    ValueError, with a message fit for the response, for an invalid bbox or
+    date rather than leaving that filter out.
+    """
+    min_lat = data.get("min_lat")
+    min_lng = data.get("min_lng")
+    max_lat = data.get("max_lat")
+    max_lng = data.get("max_lng")
+    start_date_str = data.get("start_date")
+    end_date_str = data.get("end_date")
+    site_names = data.get("sites", []) or []
+
+    sites = Site.objects.filter(name__in=site_names)
+    queryset = model.objects.filter(cruise__in=sites, level=level)
+    if min_lat and min_lng and max_lat and max_lng:
+        try:
+            bbox = (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid bounding box")
+        polygon = Polygon.from_bbox(bbox)
+        queryset = queryset.filter(coordinates__within=polygon).distinct()
+
+    if start_date_str:
+        queryset = queryset.filter(date_DD_MM_YYYY__gte=_request_date(start_date_str))
+    if end_date_str:
+        queryset = queryset.filter(date_DD_MM_YYYY__lte=_request_date(end_date_str))
+    return queryset
+
+
+def _st_x():
+    return Func(F("coordinates"), function="ST_X", output_field=FloatField())
+
+
+def _st_y():
+    return Func(F("coordinates"), function="ST_Y", output_field=FloatField())
+
+
+def measurement_rows(queryset, reading):
+    """Return the (site, date, time, lng, lat, aeronet_number, value) rows."""
+    return queryset.annotate(lng=_st_x(), lat=_st_y()).values_list(
+        "cruise",
+        "date_DD_MM_YYYY",
+        "time_HH_MM_SS",
+        "lng",
+        "lat",
+        "aeronet_number",
+        reading,
+    )
+
+
+def measurement_columns(queryset, reading):
+    """Return the measurements as a dict of parallel lists."""
+    rows = measurement_rows(queryset, reading)
+    names = ["site", "date", "time", "lng", "lat", "aeronet_number", "value"]
+    transposed = list(zip(*rows)) or [()] * len(names)
+    return {name: list(values) for name, values in zip(names, transposed)}
+
+
+def measurement_bins(queryset, reading, resolution):
+    """
+    Return the measurements binned per cruise on a `resolution` degree grid,
+    as a dict of parallel lists (the measurement_columns keys plus end_date,
+    min, max and count).
+    """
+    valid = ~Q(**{reading: MISSING_VALUE})
+    rows = (
+        queryset.annotate(
+            bin_x=Floor(_st_x() / resolution), bin_y=Floor(_st_y() / resolution)
+        )
+        .values("cruise", "bin_x", "bin_y")
+        .annotate(
+            # date + time is a timestamp: its minimum is the first
+            # measurement by (date, time), whose date and time both go out
+            first_at=Min(
+                ExpressionWrapper(
+                    F("date_DD_MM_YYYY") + F("time_HH_MM_SS"),
+                    output_field=DateTimeField(),
+                )
+            ),
+            mean_lng=Avg(_st_x()),
+            mean_lat=Avg(_st_y()),
+            aeronet=Max("aeronet_number"),
+            mean_value=Avg(reading, filter=valid),
+            end_date=Max("date_DD_MM_YYYY"),
+            min_value=Min(reading, filter=valid),
+            max_value=Max(reading, filter=valid),
+            count=Count("id", filter=valid),
+        )
+        .order_by("cruise", "first_at")
+        .values_list(
+            "cruise",
+            "first_at",
+            "mean_lng",
+            "mean_lat",
+            "aeronet",
+            "mean_value",
+            "end_date",
+            "min_value",
+            "max_value",
+            "count",
+        )
+    )
+    names = [
+        "site",
+        "date",
+        "time",
+        "lng",
+        "lat",
+        "aeronet_number",
+        "value",
+        "end_date",
+        "min",
+        "max",
+        "count",
+    ]
+    rows = [
+        (cruise, first_at.date(), first_at.time(), *rest)
+        for cruise, first_at, *rest in rows
+    ]
+    transposed = list(zip(*rows)) or [()] * len(names)
+    return {name: list(values) for name, values in zip(names, transposed)}
+
+
+def _sampled(columns, max_points):
+    # A stride thins every cruise rather than dropping the last ones whole
+    step = math.ceil(len(columns["site"]) / max_points)
+    return {name: values[::step] for name, values in columns.items()}
+
+
+def downsampled_columns(queryset, reading, max_points=None, resolution=None):
+    """
+    Bin the measurements on a grid of `resolution` degrees, or on a grid sized
+    to give at most `max_points` bins.
+
+    Without a resolution the first grid is derived from the extent and row
+    count of the data: a grid fine enough to keep every point when they fit,
+    otherwise `max_points` cells spread over the extent. One refinement pass
+    then rescales it from the number of bins it gave, assuming the occupied
+    cells grow with the inverse square of the cell size when refining (a
+    cloud of points) and shrink with its inverse when coarsening (a track).
+
+    Returns (columns, truncated). When the bins still exceed `max_points`
+    (e.g. more cruises than `max_points`), they are sampled at an even stride
+    across all cruises and `truncated` is True.
+    """
+    if resolution is None:
+        summary = queryset.aggregate(extent=Extent("coordinates"), rows=Count("id"))
+        if summary["extent"] is None:
+            return measurement_bins(queryset, reading, MAX_RESOLUTION), False
+        if summary["rows"] <= max_points:
+            # Every point fits: cells small enough to keep them apart
+            return measurement_bins(queryset, reading, MIN_RESOLUTION), False
+        min_x, min_y, max_x, max_y = summary["extent"]
+        span = max(max_x - min_x, max_y - min_y)
+        resolution = max(span / math.sqrt(max_points), MIN_RESOLUTION)
+
+    columns = measurement_bins(queryset, reading, resolution)
+    count = len(columns["site"])
+    if max_points is None or (max_points / 2 <= count <= max_points):
+        return columns, False
+
+    if count > max_points:
+        refined = min(resolution * count / max_points, MAX_RESOLUTION)
+    else:
+        scale = math.sqrt(max(count, 1) / max_points)
+        refined = max(resolution * scale, MIN_RESOLUTION)
+    if refined != resolution:
+        refined_columns = measurement_bins(queryset, reading, refined)
+        if len(refined_columns["site"]) <= max_points or count > max_points:
+            columns, count = refined_columns, len(refined_columns["site"])
+    if count > max_points:
+        return _sampled(columns, max_points), True
+    return columns, False
+
+
+def binned_rows(columns):
+    """One object per bin, in the shape of the unbinned rows."""
+    measurements = []
+    for values in zip(*columns.values()):
+        measurement = dict(zip(columns, values))
+        measurement["coordinates"] = {
+            "lng": measurement.pop("lng"),
+            "lat": measurement.pop("lat"),
+        }
+        measurements.append(measurement)
+    return measurements
+
+
+def columnar_json_response(columns, truncated=None):
+    """
+    Compact JSON: site names are dictionary-encoded into `sites` + indices.
+    Binned responses also say whether the bins were `truncated`.
+    """
+    site_index = {}
+    site_codes = [
+        site_index.setdefault(site, len(site_index)) for site in columns["site"]
+    ]
+    payload = {
+        "sites": list(site_index),
+        "site": site_codes,
+        "date": [value.isoformat() for value in columns["date"]],
+        "time": [value.isoformat() for value in columns["time"]],
+        "lng": columns["lng"],
+        "lat": columns["lat"],
+        "aeronet_number": columns["aeronet_number"],
+        "value": columns["value"],
+    }
+    if "end_date" in columns:
+        payload["end_date"] = [value.isoformat() for value in columns["end_date"]]
+        for name in ("min", "max", "count"):
+            payload[name] = columns[name]
+    if truncated is not None:
+        payload["truncated"] = truncated
+    return JsonResponse(payload, json_dumps_params={"separators": (",", ":")})
+
+
+def arrow_response(columns, truncated=None):
+    arrays = {
+        "site": pa.array(columns["site"], pa.string()).dictionary_encode(),
+        "date": pa.array(columns["date"], pa.date32()),
+        "time": pa.array(columns["time"], pa.time32("s")),
+        "lng": pa.array(columns["lng"], pa.float64()),
+        "lat": pa.array(columns["lat"], pa.float64()),
+        "aeronet_number": pa.array(columns["aeronet_number"], pa.int32()),
+        "value": pa.array(columns["value"], pa.float64()),
+    }
+    if "end_date" in columns:
+        arrays["end_date"] = pa.array(columns["end_date"], pa.date32())
+        arrays["min"] = pa.array(columns["min"], pa.float64())
+        arrays["max"] = pa.array(columns["max"], pa.float64())
+        arrays["count"] = pa.array(columns["count"], pa.int32())
+    table = pa.table(arrays)
+    if truncated is not None:
+        table = table.replace_schema_metadata({"truncated": json.dumps(truncated)})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return HttpResponse(sink.getvalue(), content_type=ARROW_CONTENT_TYPE)
@@ -0,0 +1,219 @@
+"""
+Per-request performance metrics, exposed in the Prometheus text format.
+
+MetricsMiddleware (see middleware.py) opens a RequestStats for every request
+and keeps it in a context variable, which follows the request into
+sync_to_async threads and the download producer thread. While it is set:
+
+* every SQL statement is counted and timed by an execute_wrapper installed on
+  each database connection as it is created;
+* views report the rows they return with `record_rows` and the shape of the
+  request (retrieval / frequency / level) with `set_shape`.
+
+When the response has been sent (for streamed downloads: when the last chunk
+has gone out) the totals are observed into histograms labelled by view and
+request shape, and /metrics renders them. Under several worker processes set
+PROMETHEUS_MULTIPROC_DIR so that all workers report into one registry.
+
+Peak memory relies on tracemalloc, which slows allocations down noticeably,
+so it is only recorded with METRICS_TRACE_MEMORY enabled. tracemalloc's peak
+is process wide: concurrent requests each see the combined peak.
+
+/metrics is only served to requests carrying `Authorization: Bearer
+<METRICS_TOKEN>` or, if an operator has listed any, to the addresses in
+METRICS_ALLOWED_IPS. The list is empty by default: behind a local proxy every
+request arrives from the proxy's address, so it only suits direct deployments.
+"""
+
+import contextvars
+import hmac
+import os
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+
+LABELS = ["view", "method", "retrieval", "frequency", "level"]
+
+RETRIEVALS = {"AOD", "SDA"}
+FREQUENCIES = {"Point", "Series", "Daily"}
+LEVELS = {"10", "15", "20"}
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120, 600)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROW_BUCKETS = (0, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+BYTE_BUCKETS = tuple(4**power for power in range(5, 17))
+
+REQUESTS = Counter(
+    "maritime_requests",
+    "Requests handled, by view, method and status code",
+    ["view", "method", "status"],
+)
+DURATION = Histogram(
+    "maritime_request_duration_seconds",
+    "Wall time from the request to the last response byte",
+    LABELS,
+    buckets=SECONDS_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    "maritime_request_db_queries",
+    "SQL statements executed per request",
+    LABELS,
+    buckets=COUNT_BUCKETS,
+)
+DB_DURATION = Histogram(
+    "maritime_request_db_duration_seconds",
+    "Time spent executing SQL statements per request",
+    LABELS,
+    buckets=SECONDS_BUCKETS,
+)
+ROWS = Histogram(
+    "maritime_request_rows",
+    "Measurement rows returned per request",
+    LABELS,
+    buckets=ROW_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    "maritime_response_bytes",
+    "Response body size",
+    LABELS,
+    buckets=BYTE_BUCKETS,
+)
+PEAK_MEMORY = Histogram(
+    "maritime_request_peak_memory_bytes",
+    "Peak traced Python memory during the request (METRICS_TRACE_MEMORY)",
+    LABELS,
+    buckets=BYTE_BUCKETS,
+)
+
+_current = contextvars.ContextVar("maritime_request_stats", default=None)
+
+
+class RequestStats:
+    """Counters of one request, shared by every thread working on it."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.shape = {"retrieval": "", "frequency": "", "level": ""}
+        self.lock = threading.Lock()
+
+    def add_query(self, seconds):
+        with self.lock:
+            self.queries += 1
+            self.db_seconds += seconds
+
+    def add_rows(self, rows):
+        with self.lock:
+            self.rows += rows
+
+
+def trace_memory():
+    return getattr(settings, "METRICS_TRACE_MEMORY", False)
+
+
+def start_request():
+    stats = RequestStats()
+    _current.set(stats)
+    if trace_memory():
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    return stats
+
+
+def record_rows(rows):
+    """Add `rows` to the rows returned by the current request, if any."""
+    stats = _current.get()
+    if stats is not None and rows:
+        stats.add_rows(rows)
+
+
+def record_query(seconds):
+    """Count a statement run outside the execute wrappers (e.g. a COPY)."""
+    stats = _current.get()
+    if stats is not None:
+        stats.add_query(seconds)
+
+
+def _label(values, known):
+    if isinstance(values, (str, int)):
+        values = [values]
+    return "+".join(sorted({str(value) for value in values} & known))
+
+
+def set_shape(retrievals=(), frequencies=(), levels=()):
+    """
+    Label the current request with the retrievals, frequencies and levels it
+    asked for. Unknown values are dropped to keep the label sets bounded.
+    """
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.shape = {
+        "retrieval": _label(retrievals, RETRIEVALS),
+        "frequency": _label(frequencies, FREQUENCIES),
+        "level": _label(levels, LEVELS),
+    }
+
+
+def finish_request(stats, view, method, status):
+    """Observe the totals of a finished request; the context is cleared."""
+    labels = {"view": view, "method": method, **stats.shape}
+    DURATION.labels(**labels).observe(time.perf_counter() - stats.started)
+    DB_QUERIES.labels(**labels).observe(stats.queries)
+    DB_DURATION.labels(**labels).observe(stats.db_seconds)
+    ROWS.labels(**labels).observe(stats.rows)
+    RESPONSE_BYTES.labels(**labels).observe(stats.bytes)
+    if trace_memory() and tracemalloc.is_tracing():
+        PEAK_MEMORY.labels(**labels).observe(tracemalloc.get_traced_memory()[1])
+    REQUESTS.labels(view=view, method=method, status=str(status)).inc()
+    _current.set(None)
+
+
+def _timed_execute(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(time.perf_counter() - start)
+
+
+def _install_wrapper(sender, connection, **kwargs):
+    if _timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_timed_execute)
+
+
+connection_created.connect(_install_wrapper)
+
+
+def can_read_metrics(request):
+    """True if `request` may read /metrics (see METRICS_ALLOWED_IPS/TOKEN)."""
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token:
+        scheme, _, supplied = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(
+            supplied.strip().encode(), token.encode()
+        ):
+            return True
+    allowed = getattr(settings, "METRICS_ALLOWED_IPS", [])
+    return request.META.get("REMOTE_ADDR") in allowed
+
+
+def render_metrics():
+    """Return (body, content type) of the Prometheus text exposition."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,9 +1,25 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+
 class CorsMiddleware:
+    # Async capable so that async views are not bounced through a thread
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.add_headers(self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.add_headers(await self.get_response(request))
+
+    def add_headers(self, response):
         response["Access-Control-Allow-Origin"] = "*"
         response["Access-Control-Allow-Methods"] = 'OPTIONS, GET, HEAD, POST'  # Allow POST and OPTIONS methods
         response["Access-Control-Allow-Headers"] = "*"
@@ -14,3 +30,139 @@ class CorsMiddleware:
     #     response["Access-Control-Allow-Methods"] = "POST, OPTIONS"  # Allow POST and OPTIONS methods
     #     response["Access-Control-Allow-Headers"] = "Content-Type"  # Set the appropriate allowed headers
     #     return response
+
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import finish_request, start_request
+from .profiling import (finish_profile, profile_name, profile_requested,
+                        profiler_enabled, start_profile)
+
+# Views left out of the metrics (the scrape itself)
+UNMEASURED_VIEWS = {"metrics"}
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.url_name or match.view_name
+
+
+def _iter_then(chunks, finish, on_chunk):
+    try:
+        for chunk in chunks:
+            on_chunk(chunk)
+            yield chunk
+    finally:
+        finish()
+
+
+async def _aiter_then(chunks, finish, on_chunk):
+    try:
+        async for chunk in chunks:
+            on_chunk(chunk)
+            yield chunk
+    finally:
+        finish()
+
+
+def after_response(response, finish, on_chunk=lambda chunk: None):
+    """
+    Call `finish` once `response` is complete: at once for a plain response,
+    after the last chunk (or a client disconnect) for a streamed one.
+    `on_chunk` sees every streamed chunk. File responses with a known length
+    are handed over untouched so that they can still be sent as files.
+    """
+    if not response.streaming or response.has_header("Content-Length"):
+        finish()
+    elif response.is_async:
+        response.streaming_content = _aiter_then(
+            response.streaming_content, finish, on_chunk
+        )
+    else:
+        response.streaming_content = _iter_then(
+            response.streaming_content, finish, on_chunk
+        )
+    return response
+
+
+class MetricsMiddleware:
+    """
+    Record wall time, SQL statements, rows and bytes of every request (see
+    maritimeapp.metrics). Streamed responses are measured until their last
+    chunk has been sent, so a download counts its whole export.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = start_request()
+        return self.measure(request, self.get_response(request), stats)
+
+    async def __acall__(self, request):
+        stats = start_request()
+        return self.measure(request, await self.get_response(request), stats)
+
+    def measure(self, request, response, stats):
+        view = view_name(request)
+        if view in UNMEASURED_VIEWS:
+            return response
+
+        if not response.streaming:
+            stats.bytes = len(response.content)
+        elif response.has_header("Content-Length"):
+            stats.bytes = int(response["Content-Length"])
+
+        def add_bytes(chunk):
+            stats.bytes += len(chunk)
+
+        def finish():
+            finish_request(stats, view, request.method, response.status_code)
+
+        return after_response(response, finish, add_bytes)
+
+
+class ProfilerMiddleware:
+    """
+    Profile requests carrying a signed profiling token (see
+    maritimeapp.profiling). Unless PROFILER_ENABLED is set the middleware
+    is dropped at startup.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not profiler_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not profile_requested(request):
+            return self.get_response(request)
+        profiler = start_profile()
+        return self.finish(request, self.get_response(request), profiler)
+
+    async def __acall__(self, request):
+        if not profile_requested(request):
+            return await self.get_response(request)
+        profiler = start_profile()
+        return self.finish(request, await self.get_response(request), profiler)
+
+    def finish(self, request, response, profiler):
+        name = profile_name(profiler, view_name(request))
+        response["X-Profile-File"] = name
+        return after_response(response, lambda: finish_profile(profiler, name))
@@ -1,8 +1,31 @@
+import uuid
+
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.geos import Point
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import BrinIndex
+from django.core.cache import cache
 from django.db import models
-from django.db.models import Max, Min
+from django.db.models import F
+from django.utils.timezone import now
+
+# Columns carried in the (level, cruise, date) indexes so the measurement and
+# map queries can be answered from the index alone
+AOD_INDEX_INCLUDE = [
+    "time_HH_MM_SS",
+    "aeronet_number",
+    "coordinates",
+    "aod_500nm",
+    "angstrom_exponent_440_870",
+]
+SDA_INDEX_INCLUDE = [
+    "time_HH_MM_SS",
+    "aeronet_number",
+    "coordinates",
+    "total_aod_500nm",
+    "fine_mode_aod_500nm",
+    "coarse_mode_aod_500nm",
+]
 
 
 class Site(models.Model):
@@ -17,18 +40,6 @@ class Site(models.Model):
         help_text="Array holding the span of dates [start_date, end_date]",
     )
 
-    def update_span_date(self):
-        dates = DownloadAODDaily.objects.filter(cruise=self.name, level=15).aggregate(
-            start_date=Min("date_DD_MM_YYYY"), end_date=Max("date_DD_MM_YYYY")
-        )
-        Site.objects.filter(pk=self.pk).update(
-            span_date=[dates["start_date"], dates["end_date"]]
-        )
-
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.update_span_date()
-
 
 """
 AP - HeaderCSV
@@ -54,7 +65,7 @@ Microtops_Number
 
 
 class DownloadAODAP(models.Model):
-    date_DD_MM_YYYY = models.DateField(db_index=True)
+    date_DD_MM_YYYY = models.DateField()
     time_HH_MM_SS = models.TimeField(db_index=False)
     air_mass = models.FloatField(default=-999.0)
     aod_340nm = models.FloatField(default=-999.0)
@@ -79,7 +90,14 @@ class DownloadAODAP(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=AOD_INDEX_INCLUDE,
+                name="aodap_level_cruise_date",
+            ),
+            # all_points files are appended a cruise at a time in time order,
+            # so BRIN block ranges stay narrow at a fraction of a btree's size
+            BrinIndex(fields=["date_DD_MM_YYYY"], name="aodap_date_brin"),
         ]
 
 
@@ -153,7 +171,11 @@ class DownloadAODDaily(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=AOD_INDEX_INCLUDE,
+                name="aoddaily_level_cruise_date",
+            ),
         ]
 
 
@@ -227,7 +249,11 @@ class DownloadAODSeries(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=AOD_INDEX_INCLUDE,
+                name="aodseries_level_cruise_date",
+            ),
         ]
 
 
@@ -264,7 +290,7 @@ Microtops_Number
 
 
 class DownloadSDAAP(models.Model):
-    date_DD_MM_YYYY = models.DateField(db_index=True)
+    date_DD_MM_YYYY = models.DateField()
     time_HH_MM_SS = models.TimeField(db_index=False)
     julian_day = models.FloatField(null=True, blank=True, default=-999.0)
     total_aod_500nm = models.FloatField(null=True, blank=True, default=-999.0)
@@ -312,7 +338,12 @@ class DownloadSDAAP(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=SDA_INDEX_INCLUDE,
+                name="sdaap_level_cruise_date",
+            ),
+            BrinIndex(fields=["date_DD_MM_YYYY"], name="sdaap_date_brin"),
         ]
 
 
@@ -448,7 +479,11 @@ class DownloadSDADaily(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=SDA_INDEX_INCLUDE,
+                name="sdadaily_level_cruise_date",
+            ),
         ]
 
 
@@ -536,7 +571,11 @@ class DownloadSDASeries(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["level", "cruise"]),
+            models.Index(
+                fields=["level", "cruise", "date_DD_MM_YYYY"],
+                include=SDA_INDEX_INCLUDE,
+                name="sdaseries_level_cruise_date",
+            ),
         ]
 
 
@@ -559,3 +598,174 @@ class TableHeader(models.Model):
                 fields=["datatype", "level", "freq"], name="unique_dataType_level"
             )
         ]
+
+
+class DataVersion(models.Model):
+    """
+    Single-row stamp bumped whenever the import commands load new data.
+
+    Anything derived from the measurement tables (cached downloads, cached API
+    responses) includes the current version in its key, so a reload makes the
+    old entries unreachable without having to find and delete them.
+    """
+
+    CACHE_KEY = "maritimeapp:data_version"
+    # Upper bound on how long a process-local cache can serve a stale version
+    CACHE_TIMEOUT = 60
+
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def current(cls):
+        stamp = cls.objects.filter(pk=1).values_list("version", flat=True).first()
+        return stamp or 0
+
+    @classmethod
+    def cached(cls):
+        """Current version, read through the default cache."""
+        version = cache.get(cls.CACHE_KEY)
+        if version is None:
+            version = cls.current()
+            cache.set(cls.CACHE_KEY, version, cls.CACHE_TIMEOUT)
+        return version
+
+    @classmethod
+    async def acached(cls):
+        """Async `cached` for the views, using the async cache and ORM calls."""
+        version = await cache.aget(cls.CACHE_KEY)
+        if version is None:
+            stamps = cls.objects.filter(pk=1).values_list("version", flat=True)
+            version = await stamps.afirst() or 0
+            await cache.aset(cls.CACHE_KEY, version, cls.CACHE_TIMEOUT)
+        return version
+
+    @classmethod
+    def bump(cls):
+        cls.objects.get_or_create(pk=1)
+        cls.objects.filter(pk=1).update(version=F("version") + 1, updated=now())
+        version = cls.current()
+        # Shared backends (Redis, file) see the new version immediately
+        cache.set(cls.CACHE_KEY, version, cls.CACHE_TIMEOUT)
+        return version
+
+
+class SourceFile(models.Model):
+    """
+    Manifest of the AERONET source files that have been converted and loaded.
+
+    Incremental imports compare each file's fingerprint against this table and
+    only convert and reload files whose content changed since the last run.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    cruise = models.CharField(max_length=255, default="")
+    datatype = models.CharField(max_length=8)
+    level = models.IntegerField()
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    sha256 = models.CharField(max_length=64)
+    last_processing_date = models.DateField(null=True, blank=True)
+    output_csv = models.CharField(max_length=1024, blank=True, default="")
+    loaded = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class SiteSpan(models.Model):
+    """
+    First and last measurement date of a cruise for one product.
+
+    Rebuilt in a single statement by maritimeapp.derived.refresh_site_spans;
+    the AOD / Daily / level 15 row is what Site.span_date mirrors.
+    """
+
+    cruise = models.CharField(max_length=255)
+    datatype = models.CharField(max_length=8)
+    freq = models.CharField(max_length=16)
+    level = models.IntegerField()
+    start_date = models.DateField(null=True)
+    end_date = models.DateField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cruise", "datatype", "freq", "level"],
+                name="unique_site_span",
+            )
+        ]
+
+
+class SiteTrack(models.Model):
+    """
+    Compact per-cruise geometry used to answer bbox lookups without touching
+    the measurement tables.
+
+    `track` holds the distinct level `level` daily AOD positions (snapped to a
+    small grid) and `envelope` the extent of every measurement of the cruise at
+    that level across all products. Both carry GiST indexes. Rebuilt by
+    maritimeapp.derived.refresh_site_tracks after an import.
+    """
+
+    cruise = models.CharField(max_length=255)
+    level = models.IntegerField()
+    track = gis_models.MultiPointField(null=True)
+    envelope = gis_models.PolygonField()
+    point_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cruise", "level"], name="unique_site_track"
+            )
+        ]
+
+
+class ExportJob(models.Model):
+    """
+    A queued download archive, built by the export_worker command.
+
+    Workers claim queued jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any
+    number of them can share the table without a broker. Finished archives
+    are kept until `expires`, after which the worker deletes the file.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    EXPIRED = "expired"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+        (EXPIRED, "Expired"),
+    ]
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    params = models.JSONField()
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True
+    )
+    # Export members finished out of the total, and archive bytes written
+    members_done = models.IntegerField(default=0)
+    members_total = models.IntegerField(default=0)
+    bytes_written = models.BigIntegerField(default=0)
+    archive_name = models.CharField(max_length=255, default="")
+    path = models.CharField(max_length=1024, default="")
+    error = models.TextField(default="")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    heartbeat = models.DateTimeField(null=True)
+    # Bumped by every claim; a worker only writes to the job while it holds
+    # the latest attempt
+    attempt = models.IntegerField(default=0)
+    finished = models.DateTimeField(null=True)
+    expires = models.DateTimeField(null=True, db_index=True)
+
+    def progress(self):
+        if self.status == self.DONE:
+            return 1.0
+        if not self.members_total:
+            return 0.0
+        return self.members_done / self.members_total
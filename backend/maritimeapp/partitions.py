@@ -0,0 +1,181 @@
+"""
+Native partitioning of the all_points tables.
+
+DownloadAODAP and DownloadSDAAP are partitioned LIST (level), each level
+sub-partitioned RANGE (date_DD_MM_YYYY) by calendar year:
+
+    maritimeapp_downloadaodap              PARTITION BY LIST (level)
+        maritimeapp_downloadaodap_l15      PARTITION BY RANGE (date)
+            maritimeapp_downloadaodap_l15_y2019
+            maritimeapp_downloadaodap_l15_default
+        maritimeapp_downloadaodap_default
+
+Every query already filters on level and usually on a date window, so the
+planner prunes down to a few leaf tables. Reloading a level is a TRUNCATE of
+its partition rather than a DELETE over the whole table.
+
+Migrations are not kept in the repository (reset_db.sh regenerates them), so
+the tables are created plain by Django and converted in place here by the
+create_partitions command.
+"""
+
+from datetime import date
+
+from django.db import connection, transaction
+
+from .ingest import TABLES
+
+PARTITIONED_TABLES = [TABLES[("AOD", "Point")], TABLES[("SDA", "Point")]]
+LEVELS = (10, 15, 20)
+FIRST_YEAR = 2004
+YEARS_AHEAD = 2
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def level_partition(table_name, level):
+    return f"{table_name}_l{level}"
+
+
+def year_partition(table_name, level, year):
+    return f"{table_name}_l{level}_y{year}"
+
+
+def is_partitioned(cursor, table_name):
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table_name]
+    )
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def _create_year_partitions(cursor, table_name, first_year, last_year):
+    """Create any missing yearly partitions, returning the names created."""
+    created = []
+    for level in LEVELS:
+        parent = level_partition(table_name, level)
+        for year in range(first_year, last_year + 1):
+            name = year_partition(table_name, level, year)
+            cursor.execute("SELECT to_regclass(%s)", [name])
+            if cursor.fetchone()[0] is not None:
+                continue
+            cursor.execute(
+                f"CREATE TABLE {_quote(name)} PARTITION OF {_quote(parent)} "
+                "FOR VALUES FROM (%s) TO (%s)",
+                [date(year, 1, 1), date(year + 1, 1, 1)],
+            )
+            created.append(name)
+    return created
+
+
+def ensure_partitions(years_ahead=YEARS_AHEAD):
+    """Create the yearly partitions up to `years_ahead` past the current year."""
+    last_year = date.today().year + years_ahead
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for table_name in PARTITIONED_TABLES:
+            if is_partitioned(cursor, table_name):
+                created += _create_year_partitions(
+                    cursor, table_name, FIRST_YEAR, last_year
+                )
+    return created
+
+
+def convert_table(table_name, years_ahead=YEARS_AHEAD):
+    """
+    Replace a plain table by its partitioned equivalent, keeping rows, ids and
+    indexes. Returns the number of rows copied, or None if already converted.
+    """
+    old_name = f"{table_name}_unpartitioned"
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor, table_name):
+            return None
+
+        # Secondary index definitions, replayed on the partitioned parent
+        cursor.execute(
+            """
+            SELECT indexdef FROM pg_indexes
+            WHERE tablename = %s
+            AND indexname NOT IN (
+                SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass
+            )
+            """,
+            [table_name, table_name],
+        )
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table_name])
+        old_sequence = cursor.fetchone()[0]
+        cursor.execute(
+            'SELECT COALESCE(MIN(EXTRACT(YEAR FROM "date_DD_MM_YYYY")), %s) '
+            f"FROM {_quote(table_name)}",
+            [FIRST_YEAR],
+        )
+        first_year = min(int(cursor.fetchone()[0]), FIRST_YEAR)
+
+        cursor.execute(
+            f"ALTER TABLE {_quote(table_name)} RENAME TO {_quote(old_name)}"
+        )
+        # The primary key of a partitioned table must contain the partition keys
+        cursor.execute(
+            f"""
+            CREATE TABLE {_quote(table_name)} (
+                LIKE {_quote(old_name)} INCLUDING DEFAULTS INCLUDING IDENTITY,
+                PRIMARY KEY (id, level, "date_DD_MM_YYYY")
+            ) PARTITION BY LIST (level)
+            """
+        )
+        for level in LEVELS:
+            parent = level_partition(table_name, level)
+            cursor.execute(
+                f"CREATE TABLE {_quote(parent)} "
+                f"PARTITION OF {_quote(table_name)} FOR VALUES IN (%s) "
+                'PARTITION BY RANGE ("date_DD_MM_YYYY")',
+                [level],
+            )
+            cursor.execute(
+                f"CREATE TABLE {_quote(parent + '_default')} "
+                f"PARTITION OF {_quote(parent)} DEFAULT"
+            )
+        cursor.execute(
+            f"CREATE TABLE {_quote(table_name + '_default')} "
+            f"PARTITION OF {_quote(table_name)} DEFAULT"
+        )
+        _create_year_partitions(
+            cursor, table_name, first_year, date.today().year + years_ahead
+        )
+
+        cursor.execute(
+            f"INSERT INTO {_quote(table_name)} SELECT * FROM {_quote(old_name)}"
+        )
+        rows = cursor.rowcount
+
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table_name])
+        sequence = cursor.fetchone()[0]
+        if sequence is None:
+            # serial rather than identity column: the copied default still
+            # points at the old sequence, which must outlive the old table
+            sequence = old_sequence
+            cursor.execute(
+                f"ALTER SEQUENCE {sequence} OWNED BY {_quote(table_name)}.id"
+            )
+        cursor.execute(
+            f"SELECT setval(%s, COALESCE(MAX(id), 0) + 1, false) "
+            f"FROM {_quote(table_name)}",
+            [sequence],
+        )
+
+        cursor.execute(f"DROP TABLE {_quote(old_name)}")
+        for definition in index_definitions:
+            cursor.execute(definition)
+        cursor.execute(f"ANALYZE {_quote(table_name)}")
+    return rows
+
+
+def truncate_level(table_name, level):
+    """Empty one level of a partitioned table (all of its yearly partitions)."""
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor, table_name):
+            raise ValueError(f"{table_name} is not partitioned")
+        cursor.execute(f"TRUNCATE {_quote(level_partition(table_name, level))}")
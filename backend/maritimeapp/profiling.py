@@ -0,0 +1,211 @@
+"""
+Opt-in profiling of single requests.
+
+With PROFILER_ENABLED set, ProfilerMiddleware (see middleware.py) profiles
+any request carrying a signed token, either in an `X-Profile` header or a
+`profile` query parameter (`manage.py profile_token` prints one). The trace
+covers the request until its last response byte and is written to
+PROFILER_DIR; the response names the file in an `X-Profile-File` header.
+Only the newest PROFILER_MAX_FILES traces are kept.
+Without the setting the middleware removes itself at startup, so requests
+pay nothing.
+
+PROFILER_ENGINE selects the profiler:
+
+* "sample" (default): samples the stacks of every thread each
+  PROFILER_INTERVAL seconds and writes collapsed stacks (`.collapsed`), which
+  speedscope and flamegraph.pl read. Being process wide, it also follows the
+  sync_to_async and download producer threads; threads blocked in a wait are
+  left out, but concurrent requests show up in the same trace.
+* "cprofile": deterministic cProfile of the request thread (`.prof`).
+* "pyinstrument": pyinstrument of the request thread, as speedscope JSON
+  (`.speedscope.json`); pyinstrument has to be installed.
+
+The request thread of an async view is the event loop, so use "sample" for
+download_data, list_sites and site_measurements.
+"""
+
+import cProfile
+import os
+import sys
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.core import signing
+
+TOKEN_SALT = "maritimeapp.profiling"
+TOKEN_VALUE = "profile"
+
+# Leaf frames of threads that are parked rather than working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+}
+
+
+def profiler_enabled():
+    return getattr(settings, "PROFILER_ENABLED", False)
+
+
+def profile_dir():
+    return getattr(
+        settings,
+        "PROFILER_DIR",
+        os.path.join(settings.BASE_DIR, "profiles"),
+    )
+
+
+def make_token():
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(TOKEN_VALUE)
+
+
+def profile_requested(request):
+    """True if the request carries a valid, unexpired profiling token."""
+    token = request.headers.get("X-Profile") or request.GET.get("profile")
+    if not token:
+        return False
+    try:
+        value = signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=getattr(settings, "PROFILER_TOKEN_MAX_AGE", 3600)
+        )
+    except signing.BadSignature:
+        return False
+    return value == TOKEN_VALUE
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class StackSampler:
+    """Count the stacks of all busy threads, sampled on a thread of its own."""
+
+    extension = ".collapsed"
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _sample(self, own):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)).replace(";", ":"))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self._sample(own)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class CProfiler:
+    extension = ".prof"
+
+    def __init__(self, interval=None):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class PyinstrumentProfiler:
+    extension = ".speedscope.json"
+
+    def __init__(self, interval=0.001):
+        from pyinstrument import Profiler
+
+        self.profiler = Profiler(interval=interval, async_mode="disabled")
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def write(self, path):
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        with open(path, "w") as f:
+            f.write(self.profiler.output(renderer=SpeedscopeRenderer()))
+
+
+ENGINES = {
+    "sample": StackSampler,
+    "cprofile": CProfiler,
+    "pyinstrument": PyinstrumentProfiler,
+}
+
+
+def start_profile():
+    engine = ENGINES.get(getattr(settings, "PROFILER_ENGINE", "sample"), StackSampler)
+    profiler = engine(getattr(settings, "PROFILER_INTERVAL", 0.001))
+    profiler.start()
+    return profiler
+
+
+def profile_name(profiler, view):
+    return (
+        f"{datetime.now():%Y%m%d%H%M%S}_{view}_{uuid.uuid4().hex[:8]}"
+        f"{profiler.extension}"
+    )
+
+
+def prune_profiles(directory, keep):
+    """Delete all but the `keep` most recently written traces in `directory`."""
+    extensions = tuple(engine.extension for engine in ENGINES.values())
+    paths = [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(extensions)
+    ]
+    paths.sort(key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+    for path in paths[max(keep, 0) :]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def finish_profile(profiler, name):
+    """Stop `profiler` and write its trace to PROFILER_DIR/`name`."""
+    profiler.stop()
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Make room first, so the new trace is never the one pruned
+    prune_profiles(directory, getattr(settings, "PROFILER_MAX_FILES", 100) - 1)
+    profiler.write(os.path.join(directory, name))
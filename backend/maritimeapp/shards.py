@@ -0,0 +1,625 @@
+"""
+Pre-built per-cruise export shards.
+
+At the end of an import (psql_add, stream_load, or `manage.py build_shards`
+by hand) one CSV and one Parquet file are written per cruise x retrieval x
+frequency x level under EXPORT_SHARD_DIR/v<DataVersion>/. Download requests
+without a bbox are then answered from the shards instead of the database, and
+the archive has the same layout as one built from the database:
+
+* CSV shards are raw deflate segments ending in a full flush, so they are
+  byte aligned and can be spliced one after the other. A CSV member is the
+  deflated preamble, the cruise segments and a final empty block; its CRC is
+  combined from the CRCs and sizes recorded in the manifest.
+* Parquet members are one `<name>.parquet` per dataset, as from the
+  database. A member with a single cruise stores its shard as it is; with
+  several, the row groups of the cruise shards are written into one file
+  with the PIs of every cruise in the schema metadata.
+
+With a date range, cruises whose span lies inside it use their shard whole,
+cruises that only overlap it are re-sliced from the database and the others
+are skipped. Shards of an older DataVersion are never used for new requests;
+until build_shards has run for the current version every request takes the
+regular path. Old versions are kept for a while for the downloads still
+reading them (see prune_shards).
+"""
+
+import json
+import os
+import shutil
+import struct
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from itertools import chain
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.utils.dateparse import parse_date
+
+from .downloads import (CSV_FORMAT, DATASETS, FORMAT_EXTENSIONS, POLICY_FILES,
+                        QUALITY_MAP, SRC_DIR, ExportEntry, export_columns,
+                        export_preamble, filter_queryset, get_export_engine)
+from .export_formats import (entry_schema, iter_entry_batches,
+                             iter_parquet_chunks, iter_parquet_file)
+from .metrics import record_rows
+from .models import DataVersion, SiteSpan, TableHeader
+
+MANIFEST = "manifest.json"
+SHARD_SUFFIXES = {"csv": ".csv.deflate", "parquet": ".parquet"}
+FILE_CHUNK_SIZE = 1024 * 1024
+DEFLATE_LEVEL = 6
+PARQUET_BATCH_ROWS = 100000
+
+# A shard file with its row count and, for CSV, the CRC-32 and size of the
+# text it inflates to (from the manifest)
+Shard = namedtuple("Shard", ["path", "rows", "crc32", "size"])
+
+# `parts` holds (cruise, source) pairs in order, where source is either a
+# Shard or an ExportEntry re-slicing the cruise from the database; `rows`
+# counts the rows of the shard files (the entries report their own)
+ShardMember = namedtuple(
+    "ShardMember", ["arcname", "format", "preamble", "parts", "rows"]
+)
+
+
+def shard_dir():
+    return getattr(
+        settings,
+        "EXPORT_SHARD_DIR",
+        os.path.join(settings.BASE_DIR, "export_shards"),
+    )
+
+
+def shard_root(version):
+    return os.path.join(shard_dir(), f"v{version}")
+
+
+def shard_path(root, retrieval, freq, level, cruise, output_format):
+    return os.path.join(
+        root,
+        f"{retrieval}_{freq}_{level}",
+        f"{cruise}{SHARD_SUFFIXES[output_format]}",
+    )
+
+
+def _cruise_entry(model, retrieval, freq, level, cruise, params, preamble=""):
+    _, columns = export_columns(model, retrieval)
+    return ExportEntry(
+        arcname="",
+        retrieval=retrieval,
+        freq=freq,
+        level=level,
+        preamble=preamble,
+        columns=columns,
+        queryset=filter_queryset(model, {**params, "sites": [cruise]}, level),
+    )
+
+
+def _cruise_params():
+    return {"start_date": None, "end_date": None, "bounds": None}
+
+
+def build_shards(version=None, log=print):
+    """Write every shard for `version`, then prune the shards of old versions."""
+    if version is None:
+        version = DataVersion.current()
+    root = shard_root(version)
+    building = f"{root}.building"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    engine = get_export_engine()
+    headers = {
+        (header.datatype, header.freq, header.level): header
+        for header in TableHeader.objects.all()
+    }
+
+    count = 0
+    files = {}
+    for span in SiteSpan.objects.order_by("datatype", "freq", "level", "cruise"):
+        dataset = DATASETS.get((span.datatype, span.freq))
+        if dataset is None:
+            continue
+        model, _ = dataset
+        header = headers.get((span.datatype, span.freq, span.level))
+        labels, _ = export_columns(model, span.datatype)
+        entry = _cruise_entry(
+            model,
+            span.datatype,
+            span.freq,
+            span.level,
+            span.cruise,
+            _cruise_params(),
+            export_preamble(header, span.freq, labels) if header else "",
+        )
+
+        csv_path = shard_path(
+            building, span.datatype, span.freq, span.level, span.cruise, "csv"
+        )
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        check = _Crc()
+        compressor = _deflater()
+        shard_rows = 0
+        with open(csv_path, "wb") as f:
+            # The preamble is written per request, shards hold rows only
+            for chunk in engine(entry._replace(preamble="")):
+                shard_rows += chunk.count(b"\n")
+                check.update(chunk)
+                f.write(compressor.compress(chunk))
+            f.write(compressor.flush(zlib.Z_FULL_FLUSH))
+
+        parquet_path = shard_path(
+            building, span.datatype, span.freq, span.level, span.cruise, "parquet"
+        )
+        with open(parquet_path, "wb") as f:
+            for chunk in iter_parquet_chunks(entry):
+                f.write(chunk)
+        files[os.path.relpath(csv_path, building)] = {
+            "rows": shard_rows,
+            "crc32": check.crc,
+            "size": check.size,
+        }
+        files[os.path.relpath(parquet_path, building)] = {"rows": shard_rows}
+        count += 1
+
+    with open(os.path.join(building, MANIFEST), "w") as f:
+        json.dump({"version": version, "shards": count, "files": files}, f)
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(building, root)
+
+    log(f"Wrote {count} shard pairs to {root}")
+    for removed in prune_shards():
+        log(f"Removed the shards of version {removed}")
+    return count
+
+
+def shard_versions():
+    """(version, path) of the finished shard directories, newest first."""
+    versions = []
+    for name in os.listdir(shard_dir()):
+        path = os.path.join(shard_dir(), name)
+        if name[:1] == "v" and name[1:].isdigit() and os.path.isdir(path):
+            versions.append((int(name[1:]), path))
+    return sorted(versions, reverse=True)
+
+
+def prune_shards(grace=None):
+    """
+    Remove the shards of old data versions, returning the versions removed.
+
+    Web processes see a new version only when their DataVersion cache expires
+    and downloads open shard files as they stream, so the previous version
+    stays in use after a build: the two newest versions are always kept, and
+    an older one goes once its successor has been in place for `grace`
+    seconds (EXPORT_SHARD_GRACE).
+    """
+    if grace is None:
+        grace = getattr(settings, "EXPORT_SHARD_GRACE", 6 * 3600)
+    versions = shard_versions()
+    removed = []
+    for (_, newer), (version, path) in zip(versions[1:], versions[2:]):
+        built = os.path.getmtime(os.path.join(newer, MANIFEST))
+        if time.time() - built > grace:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(version)
+    return removed
+
+
+def _parse(value):
+    """
+    Parse a request date as the ORM would (e.g. 2010-1-1 too). Raises
+    ValueError for anything that does not parse.
+    """
+    if not value:
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+def shard_plan(params, version=None):
+    """
+    Return the ShardMembers answering `params`, or None when the request has
+    to go through the regular export (bbox filter, Arrow format, or no shards
+    for the current data version).
+    """
+    output_format = params.get("format", CSV_FORMAT)
+    if params["bounds"] is not None or output_format not in SHARD_SUFFIXES:
+        return None
+    if version is None:
+        version = DataVersion.cached()
+    root = shard_root(version)
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        # Not built yet, or by a version of build_shards without CRCs
+        return None
+
+    try:
+        start, end = _parse(params["start_date"]), _parse(params["end_date"])
+    except ValueError:
+        # Left to the regular export, which reports it as it always has
+        return None
+    members = []
+    for retrieval in params["retrievals"]:
+        for freq in params["frequency"]:
+            dataset = DATASETS.get((retrieval, freq))
+            if dataset is None:
+                continue
+            model, basename = dataset
+            labels, _ = export_columns(model, retrieval)
+
+            for quality in params["quality"]:
+                level = QUALITY_MAP.get(quality)
+                if level is None:
+                    continue
+                header = TableHeader.objects.filter(
+                    level=level, freq=freq, datatype=retrieval
+                ).first()
+                if header is None:
+                    continue
+
+                parts = []
+                rows = 0
+                spans = SiteSpan.objects.filter(
+                    datatype=retrieval,
+                    freq=freq,
+                    level=level,
+                    cruise__in=params["sites"],
+                ).order_by("cruise")
+                preamble = export_preamble(header, freq, labels)
+                for span in spans:
+                    if span.start_date is None:
+                        continue
+                    if (start and span.end_date < start) or (
+                        end and span.start_date > end
+                    ):
+                        continue
+                    inside = (not start or span.start_date >= start) and (
+                        not end or span.end_date <= end
+                    )
+                    if inside:
+                        path = shard_path(
+                            root, retrieval, freq, level, span.cruise, output_format
+                        )
+                        info = files.get(os.path.relpath(path, root))
+                        if info is None or not os.path.isfile(path):
+                            return None
+                        shard = Shard(
+                            path, info["rows"], info.get("crc32"), info.get("size")
+                        )
+                        parts.append((span.cruise, shard))
+                        rows += shard.rows
+                    else:
+                        # CSV members carry the preamble once, Parquet in the schema
+                        entry = _cruise_entry(
+                            model,
+                            retrieval,
+                            freq,
+                            level,
+                            span.cruise,
+                            params,
+                            preamble if output_format != CSV_FORMAT else "",
+                        )
+                        parts.append((span.cruise, entry))
+                if parts:
+                    members.append(
+                        ShardMember(
+                            arcname=f"{basename}{level}",
+                            format=output_format,
+                            preamble=preamble,
+                            parts=parts,
+                            rows=rows,
+                        )
+                    )
+    return members
+
+
+def _iter_file(path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(FILE_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+# ---- zip members from pre-compressed data ----
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    for row in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= row
+        vector >>= 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    CRC-32 of A + B from crc1 = crc32(A), crc2 = crc32(B) and len2 = len(B),
+    as zlib's crc32_combine (which the zlib module does not expose).
+    """
+    if len2 <= 0:
+        return crc1
+    # Operator appending one zero bit, squared up to one zero byte
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+class _Crc:
+    """Running CRC-32 and size of the uncompressed data of a member."""
+
+    def __init__(self):
+        self.crc = 0
+        self.size = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def extend(self, crc, size):
+        """Account for `size` bytes with CRC `crc` that follow."""
+        self.crc = crc32_combine(self.crc, crc, size)
+        self.size += size
+
+
+def _deflater():
+    return zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+# A final, empty deflate block: ends a member of spliced segments
+_FINAL_BLOCK = _deflater().flush(zlib.Z_FINISH)
+
+
+def _iter_deflate(chunks, check):
+    """
+    Raw-deflate `chunks` into one segment. The full flush at the end leaves it
+    byte aligned without a final block, so more segments can follow it.
+    """
+    compressor = _deflater()
+    for chunk in chunks:
+        check.update(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+def _iter_stored(chunks, check):
+    for chunk in chunks:
+        check.update(chunk)
+        yield chunk
+
+
+def _dos_time():
+    t = time.localtime()
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+class RawZipWriter:
+    """
+    Streaming zip writer for member data that is compressed already.
+
+    zipfile compresses whatever is written to a member, so it cannot splice
+    deflate segments. Members are laid out as zipfile writes them to a
+    ZipStream: data descriptors after the data and zip64 sizes throughout.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.central = []
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def member(self, name, method, chunks, check):
+        """
+        Yield the member `name` holding `chunks`, already compressed with
+        `method`; `check` holds the CRC and size of the data once they end.
+        """
+        encoded = name.encode("utf-8")
+        flags = 0x08 | (0x800 if not encoded.isascii() else 0)
+        dos_time, dos_date = _dos_time()
+        header_offset = self.offset
+        yield self._emit(
+            struct.pack(
+                "<4s2B4HL2L2H",
+                b"PK\x03\x04",
+                45,
+                0,
+                flags,
+                method,
+                dos_time,
+                dos_date,
+                0,
+                0xFFFFFFFF,
+                0xFFFFFFFF,
+                len(encoded),
+                20,
+            )
+            + encoded
+            + struct.pack("<2H2Q", 1, 16, 0, 0)
+        )
+
+        start = self.offset
+        for data in chunks:
+            if data:
+                yield self._emit(data)
+        compressed = self.offset - start
+        yield self._emit(
+            struct.pack("<4sL2Q", b"PK\x07\x08", check.crc, compressed, check.size)
+        )
+        self.central.append(
+            struct.pack(
+                "<4s4B4HL2L5H2L",
+                b"PK\x01\x02",
+                45,
+                3,
+                45,
+                0,
+                flags,
+                method,
+                dos_time,
+                dos_date,
+                check.crc,
+                0xFFFFFFFF,
+                0xFFFFFFFF,
+                len(encoded),
+                28,
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                0xFFFFFFFF,
+            )
+            + encoded
+            + struct.pack("<2H3Q", 1, 24, check.size, compressed, header_offset)
+        )
+
+    def close(self):
+        """The central directory and the (zip64) end records."""
+        start = self.offset
+        directory = self._emit(b"".join(self.central))
+        end64 = self.offset
+        count = len(self.central)
+        return directory + self._emit(
+            struct.pack(
+                "<4sQ2H2L4Q",
+                b"PK\x06\x06",
+                44,
+                45,
+                45,
+                0,
+                0,
+                count,
+                count,
+                len(directory),
+                start,
+            )
+            + struct.pack("<4sLQL", b"PK\x06\x07", 0, end64, 1)
+            + struct.pack(
+                "<4s4H2LH",
+                b"PK\x05\x06",
+                0,
+                0,
+                min(count, 0xFFFF),
+                min(count, 0xFFFF),
+                min(len(directory), 0xFFFFFFFF),
+                min(start, 0xFFFFFFFF),
+                0,
+            )
+        )
+
+
+def _iter_csv_member(member, engine, check):
+    """The deflate stream of a CSV member: preamble, cruises, final block."""
+    yield from _iter_deflate([member.preamble.encode("utf-8")], check)
+    for _, source in member.parts:
+        if isinstance(source, Shard):
+            yield from _iter_file(source.path)
+            check.extend(source.crc32, source.size)
+        else:
+            yield from _iter_deflate(engine(source), check)
+    yield _FINAL_BLOCK
+
+
+def member_schema(member):
+    """The Parquet schema of a member: that of its parts, with every PI."""
+    schema = None
+    pis = {}
+    for _, source in member.parts:
+        if isinstance(source, Shard):
+            part_schema = pq.read_schema(source.path)
+        else:
+            part_schema = entry_schema(source)
+        schema = schema or part_schema
+        pis.update(json.loads(part_schema.metadata[b"pis"]))
+    metadata = {**schema.metadata, b"pis": json.dumps(pis).encode("utf-8")}
+    return schema.with_metadata(metadata)
+
+
+def _iter_member_batches(member, schema):
+    for _, source in member.parts:
+        if isinstance(source, Shard):
+            shard = pq.ParquetFile(source.path)
+            for batch in shard.iter_batches(batch_size=PARQUET_BATCH_ROWS):
+                yield pa.RecordBatch.from_arrays(batch.columns, schema=schema)
+        else:
+            yield from iter_entry_batches(source, schema)
+
+
+def _iter_parquet_member(member):
+    """
+    The Parquet file of a member. A single cruise shard is stored as it is;
+    several cruises are written into one file, as from the database.
+    """
+    if len(member.parts) == 1:
+        (_, source), = member.parts
+        if isinstance(source, Shard):
+            return _iter_file(source.path)
+        return iter_parquet_chunks(source)
+    schema = member_schema(member)
+    return iter_parquet_file(_iter_member_batches(member, schema), schema)
+
+
+def stream_shard_archive(members, root, member_done=None):
+    """Yield a zip of shard members (plus the data policy) under `root/`."""
+    engine = get_export_engine()
+    archive = RawZipWriter()
+    for member in members:
+        if member.format == CSV_FORMAT:
+            check = _Crc()
+            name = f"{root}/{member.arcname}{FORMAT_EXTENSIONS[member.format]}"
+            chunks = _iter_csv_member(member, engine, check)
+            yield from archive.member(name, zipfile.ZIP_DEFLATED, chunks, check)
+        else:
+            check = _Crc()
+            name = f"{root}/{member.arcname}{FORMAT_EXTENSIONS[member.format]}"
+            chunks = _iter_stored(_iter_parquet_member(member), check)
+            yield from archive.member(name, zipfile.ZIP_STORED, chunks, check)
+        record_rows(member.rows)
+        if member_done is not None:
+            member_done(member)
+
+    for policy_file in POLICY_FILES:
+        src_policy_file = os.path.join(SRC_DIR, policy_file)
+        if os.path.isfile(src_policy_file):
+            check = _Crc()
+            chunks = chain(
+                _iter_deflate(_iter_file(src_policy_file), check), [_FINAL_BLOCK]
+            )
+            yield from archive.member(
+                f"{root}/{policy_file}", zipfile.ZIP_DEFLATED, chunks, check
+            )
+    yield archive.close()
@@ -0,0 +1,195 @@
+"""
+Response caching for list_sites.
+
+A bbox is snapped outward onto a grid of tiles of 360 / 2**n degrees, sized so
+that the viewport covers roughly TILES_PER_SIDE tiles per axis. The cruises that have
+measurements in each tile are cached per tile, so panning the map reuses the
+tiles it already saw and only the newly exposed ones hit PostGIS (all of them
+in one query against the small SiteTrack table, never the measurements).
+Cruises from tiles wholly inside the bbox are kept as they are; those that
+only come from the edge tiles are checked against the bbox itself on SiteTrack,
+so the response matches the viewport exactly. Sites without a SiteTrack row
+(before refresh_derived_tables has run) are matched on their measurements.
+
+Every key carries the DataVersion stamp, so an import invalidates the cache
+without any explicit deletes.
+"""
+
+import math
+
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.db import connection
+from django.utils.dateparse import parse_date
+
+from .models import DownloadAODDaily, Site, SiteTrack
+
+TILES_PER_SIDE = 4
+MIN_TILE_DEGREES = 360.0 / 2**16
+
+
+def tile_size(min_lng, min_lat, max_lng, max_lat):
+    span = max(max_lng - min_lng, max_lat - min_lat, MIN_TILE_DEGREES)
+    size = 360.0
+    while size / 2 >= span / TILES_PER_SIDE and size / 2 >= MIN_TILE_DEGREES:
+        size /= 2
+    return size
+
+
+def tile_range(min_lng, min_lat, max_lng, max_lat):
+    """Return (size, x0, y0, x1, y1): the tiles covering the bbox, inclusive."""
+    size = tile_size(min_lng, min_lat, max_lng, max_lat)
+    return (
+        size,
+        math.floor(min_lng / size),
+        math.floor(min_lat / size),
+        math.floor(max_lng / size),
+        math.floor(max_lat / size),
+    )
+
+
+def _tile_key(version, size, x, y):
+    return f"sites:tile:{version}:{size!r}:{x}:{y}"
+
+
+def cruises_in_tiles(tiles, version):
+    """Return the set of cruises with level 1.5 daily points in `tiles`."""
+    size, x0, y0, x1, y1 = tiles
+    keys = {
+        _tile_key(version, size, x, y): (x, y)
+        for x in range(x0, x1 + 1)
+        for y in range(y0, y1 + 1)
+    }
+    found = cache.get_many(list(keys))
+    cruises = set()
+    for names in found.values():
+        cruises.update(names)
+
+    missing = [keys[key] for key in keys if key not in found]
+    if not missing:
+        return cruises
+
+    # Fill every missing tile from one query: tracks are prefiltered on the
+    # GiST index against the envelope of the missing tiles, then matched
+    # against each tile in it
+    mx0 = min(x for x, _ in missing)
+    my0 = min(y for _, y in missing)
+    mx1 = max(x for x, _ in missing)
+    my1 = max(y for _, y in missing)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT track.cruise, tile_x, tile_y
+            FROM maritimeapp_sitetrack AS track,
+                 generate_series(%(x0)s, %(x1)s) AS tile_x,
+                 generate_series(%(y0)s, %(y1)s) AS tile_y
+            WHERE track.level = 15
+            AND track.track && ST_MakeEnvelope(
+                %(x0)s * %(size)s, %(y0)s * %(size)s,
+                (%(x1)s + 1) * %(size)s, (%(y1)s + 1) * %(size)s, 4326
+            )
+            AND ST_Intersects(track.track, ST_MakeEnvelope(
+                tile_x * %(size)s, tile_y * %(size)s,
+                (tile_x + 1) * %(size)s, (tile_y + 1) * %(size)s, 4326
+            ))
+            """,
+            {"x0": mx0, "y0": my0, "x1": mx1, "y1": my1, "size": size},
+        )
+        rows = cursor.fetchall()
+    filled = {tile: [] for tile in missing}
+    for cruise, tile_x, tile_y in rows:
+        tile = (int(tile_x), int(tile_y))
+        if tile in filled:
+            filled[tile].append(cruise)
+
+    cache.set_many(
+        {_tile_key(version, size, x, y): names for (x, y), names in filled.items()}
+    )
+    for names in filled.values():
+        cruises.update(names)
+    return cruises
+
+
+def _inner_tiles(tiles, min_lng, min_lat, max_lng, max_lat):
+    """Return the part of `tiles` lying wholly inside the bbox, or None."""
+    size = tiles[0]
+    inner = (
+        size,
+        math.ceil(min_lng / size),
+        math.ceil(min_lat / size),
+        math.floor(max_lng / size) - 1,
+        math.floor(max_lat / size) - 1,
+    )
+    _, x0, y0, x1, y1 = inner
+    return inner if x0 <= x1 and y0 <= y1 else None
+
+
+def cruises_in_bbox(bbox, version):
+    """Return the set of cruises with level 1.5 daily points inside `bbox`."""
+    tiles = tile_range(*bbox)
+    candidates = cruises_in_tiles(tiles, version)
+    inner = _inner_tiles(tiles, *bbox)
+    # Already cached by the call above, so this is a cache read only
+    cruises = cruises_in_tiles(inner, version) if inner else set()
+    edge = candidates - cruises
+    envelope = Polygon.from_bbox(bbox)
+    envelope.srid = 4326
+    if edge:
+        cruises.update(
+            SiteTrack.objects.filter(
+                level=15, cruise__in=edge, track__intersects=envelope
+            ).values_list("cruise", flat=True)
+        )
+    # Sites without a track yet (derived tables not refreshed) are matched on
+    # their measurements instead of being left out
+    untracked = list(
+        Site.objects.exclude(
+            name__in=SiteTrack.objects.filter(level=15).values("cruise")
+        ).values_list("name", flat=True)
+    )
+    if untracked:
+        cruises.update(
+            DownloadAODDaily.objects.filter(
+                level=15, cruise__in=untracked, coordinates__within=envelope
+            )
+            .values_list("cruise", flat=True)
+            .distinct()
+        )
+    return cruises
+
+
+def _parse(value):
+    try:
+        return parse_date(value) if value else None
+    except ValueError:
+        # Well formed but not a real date, e.g. 2010-02-30
+        return None
+
+
+def date_range(start_date, end_date, today):
+    """
+    Return the (start, end) dates list_sites filters the site spans on, or None.
+
+    A start alone runs to `today` and an end alone is a single day. A start
+    that does not parse, or an end that does not parse next to a start, turns
+    the filter off.
+    """
+    start, end = _parse(start_date), _parse(end_date)
+    if start_date:
+        if start is None or (end_date and end is None):
+            return None
+        return start, end or today
+    if end is not None:
+        return end, end
+    return None
+
+
+def site_list_key(version, bbox, dates):
+    """
+    Key a list_sites response on what it was filtered by: the exact bbox and
+    the parsed date range, so spellings of the same dates (or invalid ones,
+    which filter nothing) share an entry.
+    """
+    bbox_part = "all" if bbox is None else ":".join(repr(value) for value in bbox)
+    dates_part = "all" if dates is None else ":".join(map(str, dates))
+    return f"sites:list:{version}:{bbox_part}:{dates_part}"
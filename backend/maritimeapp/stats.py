@@ -0,0 +1,193 @@
+"""
+Per-cruise, per-period statistics of one reading, computed in PostgreSQL.
+
+The rows of each cruise are grouped on date_trunc(period, date) and reduced
+in SQL to count, mean, standard deviation, min, max and percentile_cont at
+the requested fractions, with the missing (-999) values excluded. Only the
+aggregates leave the database, so monthly means of every cruise cost a few
+kilobytes instead of a full download.
+
+Results depend only on the request and the DataVersion stamp and are cached
+under a key including both, like the tiles.
+"""
+
+import hashlib
+import math
+
+from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
+from django.db.models import (Aggregate, Avg, Count, DateField, FloatField, Max,
+                              Min, StdDev)
+from django.db.models.functions import Trunc
+from django.utils.dateparse import parse_date
+
+from .downloads import (DATASETS, QUALITY_MAP, filter_queryset,
+                        parse_download_request)
+from .measurements import MISSING_VALUE, reading_fields
+
+PERIODS = ("day", "month", "year")
+LEVELS = (10, 15, 20)
+DEFAULT_PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+MAX_PERCENTILES = 10
+
+
+class PercentileCont(Aggregate):
+    """percentile_cont over an array of fractions: one sort, one array back."""
+
+    function = "percentile_cont"
+    template = "%(function)s(%(fractions)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+
+    def __init__(self, expression, fractions, **extra):
+        # The fractions are validated floats, so they are inlined as literals
+        literals = ",".join(repr(float(fraction)) for fraction in fractions)
+        super().__init__(
+            expression,
+            fractions=f"ARRAY[{literals}]::double precision[]",
+            output_field=ArrayField(FloatField()),
+            **extra,
+        )
+
+
+def percentile_label(fraction):
+    return f"p{fraction * 100:g}"
+
+
+def _date(value):
+    """Parse an ISO date, raising ValueError for anything else."""
+    parsed = parse_date(value) if value else None
+    if value and parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+def parse_stats_request(data):
+    """
+    Normalise the JSON body of a stats request. Raises ValueError, with a
+    message fit for the response, when a parameter is invalid.
+    """
+    params = parse_download_request(data)
+    if not params["sites"]:
+        raise ValueError("No sites selected")
+
+    retrieval = data.get("retrieval") or "AOD"
+    frequency = data.get("frequency") or "Daily"
+    if not isinstance(retrieval, str) or not isinstance(frequency, str):
+        raise ValueError("Invalid retrieval or frequency")
+    if (retrieval, frequency) not in DATASETS:
+        raise ValueError("Invalid retrieval or frequency")
+    model = DATASETS[(retrieval, frequency)][0]
+
+    level = data.get("level") or 15
+    try:
+        level = int(QUALITY_MAP.get(level, level))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid level")
+    if level not in LEVELS:
+        raise ValueError("Invalid level")
+
+    reading = data.get("reading")
+    if reading not in reading_fields(model):
+        raise ValueError("Invalid reading")
+
+    period = data.get("period") or "month"
+    if period not in PERIODS:
+        raise ValueError("Invalid period")
+
+    try:
+        percentiles = [
+            float(value) for value in data.get("percentiles", DEFAULT_PERCENTILES)
+        ]
+    except (TypeError, ValueError):
+        raise ValueError("Invalid percentiles")
+    if len(percentiles) > MAX_PERCENTILES or not all(
+        math.isfinite(value) and 0 <= value <= 1 for value in percentiles
+    ):
+        raise ValueError("Invalid percentiles")
+
+    try:
+        _date(params["start_date"])
+        _date(params["end_date"])
+        if params["bounds"] is not None:
+            params["bounds"] = {
+                name: float(value) for name, value in params["bounds"].items()
+            }
+    except (TypeError, ValueError):
+        raise ValueError("Invalid date or bounds")
+
+    params.update(
+        {
+            "model": model,
+            "retrieval": retrieval,
+            "frequency": frequency,
+            "level": level,
+            "reading": reading,
+            "period": period,
+            "percentiles": percentiles,
+        }
+    )
+    return params
+
+
+def stats_queryset(params):
+    """One row per (cruise, period) with the aggregates of the reading."""
+    reading = params["reading"]
+    queryset = filter_queryset(params["model"], params, params["level"])
+    return (
+        queryset.exclude(**{reading: MISSING_VALUE})
+        .annotate(
+            period=Trunc("date_DD_MM_YYYY", params["period"], output_field=DateField())
+        )
+        .values("cruise", "period")
+        .annotate(
+            count=Count(reading),
+            mean=Avg(reading),
+            std=StdDev(reading, sample=True),
+            min=Min(reading),
+            max=Max(reading),
+            percentiles=PercentileCont(reading, params["percentiles"]),
+        )
+        .order_by("cruise", "period")
+    )
+
+
+def site_statistics(params):
+    """The statistics of a parsed stats request, as a JSON-ready dict."""
+    labels = [percentile_label(fraction) for fraction in params["percentiles"]]
+    stats = []
+    for row in stats_queryset(params):
+        stats.append(
+            {
+                "site": row["cruise"],
+                "period": row["period"].isoformat(),
+                "count": row["count"],
+                "mean": row["mean"],
+                "std": row["std"],
+                "min": row["min"],
+                "max": row["max"],
+                "percentiles": dict(zip(labels, row["percentiles"] or [])),
+            }
+        )
+    return {
+        "retrieval": params["retrieval"],
+        "frequency": params["frequency"],
+        "level": params["level"],
+        "reading": params["reading"],
+        "period": params["period"],
+        "percentiles": labels,
+        "stats": stats,
+    }
+
+
+def stats_cache_key(version, params):
+    normalised = {name: value for name, value in params.items() if name != "model"}
+    digest = hashlib.sha256(repr(sorted(normalised.items())).encode("utf-8"))
+    return f"stats:{version}:{digest.hexdigest()}"
+
+
+def cached_statistics(version, params):
+    key = stats_cache_key(version, params)
+    payload = cache.get(key)
+    if payload is None:
+        payload = site_statistics(params)
+        cache.set(key, payload)
+    return payload
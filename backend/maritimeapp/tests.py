@@ -1,3 +1,2446 @@
-from django.test import TestCase
+"""
+Query-plan regression tests for the Download* tables.
 
-# Create your tests here.
+A synthetic dataset is loaded into the (PostGIS) test database and the hot
+queries of site_measurements, download_data and site_stats are EXPLAINed. They
+must be served by the (level, cruise, date) covering index, or the BRIN date
+index on the all_points tables, and never by a sequential scan. A model change
+that drops or reorders those indexes fails here rather than in production.
+
+Unit tests of the export, cache and ingest helpers follow the query-plan tests.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import zipfile
+import zlib
+from datetime import date, datetime, time, timedelta
+from unittest import mock
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from prometheus_client import REGISTRY
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.gis.geos import MultiPoint, Point, Polygon
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import (AsyncRequestFactory, RequestFactory, SimpleTestCase,
+                         TestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+from . import db, downloads, ingest_telemetry, metrics, shards, tiles, views
+from .derived import refresh_derived_tables
+from .download_cache import (cache_key, cached_path, evict, serve_cached,
+                             tee_to_cache)
+from .downloads import (ExportEntry, ZipStream, aiter_chunks,
+                        build_export_plan, export_columns, filter_queryset,
+                        iter_csv_chunks, parse_download_request,
+                        stream_archive)
+from .export_formats import (_record_batch, iter_arrow_chunks,
+                             iter_parquet_chunks)
+from .export_jobs import claim_job, owned, purge_expired, requeue_stale
+from .ingest import (ChunkPipe, convert_files, copy_columns, describe_file,
+                     describe_frequency, is_measurement_file, iter_copy_rows,
+                     iter_csv_bytes, output_csv_path, parse_preamble,
+                     read_measurements, wkt_point)
+from .ingest_telemetry import IngestRun, timed, timing
+from .management.commands import import_dd, psql_add
+from .management.commands.import_dd import Command as ImportDDCommand
+from .management.commands.psql_add import Command as PsqlAddCommand
+from .management.commands.psql_add import rebuild_definition
+from .measurements import (MISSING_VALUE, downsampled_columns,
+                           filter_measurements, measurement_rows)
+from .metrics import can_read_metrics, record_rows, set_shape
+from .middleware import MetricsMiddleware, ProfilerMiddleware
+from .profiling import StackSampler, make_token
+from .models import (DataVersion, DownloadAODAP, DownloadAODDaily,
+                     DownloadAODSeries, DownloadSDAAP, DownloadSDADaily,
+                     DownloadSDASeries, ExportJob, Site, SiteSpan, SiteTrack,
+                     SourceFile, TableHeader)
+from .partitions import convert_table
+from .shards import (MANIFEST, Shard, ShardMember, crc32_combine, prune_shards,
+                     shard_path, shard_plan, shard_root, stream_shard_archive)
+from .site_cache import (MIN_TILE_DEGREES, TILES_PER_SIDE, cruises_in_bbox,
+                         cruises_in_tiles, date_range, site_list_key,
+                         tile_range)
+from .stats import (DEFAULT_PERCENTILES, cached_statistics, parse_stats_request,
+                    site_statistics, stats_cache_key, stats_queryset)
+from .tiles import MVT_CONTENT_TYPE
+
+CRUISES = 60
+ROWS_PER_CRUISE = 400
+LEVELS = (10, 15, 20)
+FIRST_DAY = date(2010, 1, 1)
+
+INDEX_SCANS = {"Index Only Scan", "Index Scan", "Bitmap Index Scan"}
+
+
+def plan_nodes(plan):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan tree."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(queryset):
+    return json.loads(queryset.explain(format="json"))[0]["Plan"]
+
+
+def load_synthetic(model):
+    """Rows appended a cruise at a time in date order, as the importers do."""
+    rows = []
+    for number in range(CRUISES):
+        cruise = f"Cruise_{number:03d}"
+        start = FIRST_DAY + timedelta(days=number * 30)
+        for index in range(ROWS_PER_CRUISE):
+            day = start + timedelta(days=index // 20)
+            rows.append(
+                model(
+                    date_DD_MM_YYYY=day,
+                    time_HH_MM_SS=time(index % 24, index % 60),
+                    last_processing_date_DD_MM_YYYY=FIRST_DAY,
+                    coordinates=Point(-180 + number * 5 + index / 100, index / 10),
+                    cruise=cruise,
+                    level=LEVELS[index % len(LEVELS)],
+                    aeronet_number=number,
+                )
+            )
+    model.objects.bulk_create(rows, batch_size=5000)
+
+
+class QueryPlanTests(TestCase):
+    models = [
+        DownloadAODAP,
+        DownloadAODDaily,
+        DownloadAODSeries,
+        DownloadSDAAP,
+        DownloadSDADaily,
+        DownloadSDASeries,
+    ]
+    brin_models = [DownloadAODAP, DownloadSDAAP]
+
+    @classmethod
+    def setUpTestData(cls):
+        Site.objects.bulk_create(
+            Site(name=f"Cruise_{number:03d}", aeronet_number=number, span_date=[])
+            for number in range(CRUISES)
+        )
+        for model in cls.models:
+            load_synthetic(model)
+        with connection.cursor() as cursor:
+            for model in cls.models:
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+    def assertIndexPlan(self, queryset, index_suffix):
+        """No sequential scan of the measurement table; `*index_suffix` used."""
+        table = queryset.model._meta.db_table
+        plan = explain(queryset)
+        nodes = list(plan_nodes(plan))
+        seq_scans = [
+            node
+            for node in nodes
+            if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == table
+        ]
+        self.assertFalse(seq_scans, json.dumps(plan, indent=2))
+        used = [
+            node.get("Index Name", "")
+            for node in nodes
+            if node["Node Type"] in INDEX_SCANS
+        ]
+        self.assertTrue(
+            any(name.endswith(index_suffix) for name in used),
+            f"expected an index scan on *{index_suffix}, got {used}",
+        )
+
+    def params(self, **overrides):
+        params = {
+            "sites": ["Cruise_010", "Cruise_011"],
+            "start_date": "2010-11-01",
+            "end_date": "2010-11-20",
+            "retrievals": [],
+            "frequency": [],
+            "quality": [],
+            "bounds": None,
+        }
+        params.update(overrides)
+        return params
+
+    def test_measurements_use_covering_index(self):
+        data = {
+            "sites": ["Cruise_010", "Cruise_011"],
+            "start_date": "2010-11-01",
+            "end_date": "2010-11-20",
+        }
+        for model in self.models:
+            with self.subTest(model=model.__name__):
+                queryset = filter_measurements(data, model=model)
+                self.assertIndexPlan(queryset, "_level_cruise_date")
+
+    def test_columnar_measurements_use_covering_index(self):
+        data = {"sites": ["Cruise_010"], "start_date": "2010-11-01"}
+        for model in self.models:
+            reading = "total_aod_500nm" if "SDA" in model.__name__ else "aod_500nm"
+            with self.subTest(model=model.__name__):
+                queryset = filter_measurements(data, model=model)
+                self.assertIndexPlan(
+                    measurement_rows(queryset, reading), "_level_cruise_date"
+                )
+
+    def test_download_export_uses_covering_index(self):
+        for model in self.models:
+            retrieval = "SDA" if "SDA" in model.__name__ else "AOD"
+            with self.subTest(model=model.__name__):
+                _, columns = export_columns(model, retrieval)
+                queryset = filter_queryset(model, self.params(), 15).values_list(
+                    *columns
+                )
+                self.assertIndexPlan(queryset, "_level_cruise_date")
+
+    def test_stats_use_covering_index(self):
+        for model in self.models:
+            reading = "total_aod_500nm" if "SDA" in model.__name__ else "aod_500nm"
+            params = self.params(
+                model=model,
+                level=15,
+                reading=reading,
+                period="month",
+                percentiles=list(DEFAULT_PERCENTILES),
+            )
+            with self.subTest(model=model.__name__):
+                self.assertIndexPlan(stats_queryset(params), "_level_cruise_date")
+
+    def test_downsampling_samples_every_cruise(self):
+        sites = [f"Cruise_{number:03d}" for number in range(CRUISES)]
+        queryset = filter_measurements({"sites": sites})
+        columns, truncated = downsampled_columns(queryset, "aod_500nm", max_points=10)
+        self.assertTrue(truncated)
+        self.assertLessEqual(len(columns["site"]), 10)
+        # Spread over the cruises rather than the first ones in full
+        self.assertEqual(columns["site"][0], sites[0])
+        self.assertGreaterEqual(columns["site"][-1], sites[CRUISES // 2])
+
+        columns, truncated = downsampled_columns(
+            queryset, "aod_500nm", max_points=ROWS_PER_CRUISE * CRUISES
+        )
+        self.assertFalse(truncated)
+
+    def test_downsampling_refines_the_grid_once(self):
+        sites = [f"Cruise_{number:03d}" for number in range(CRUISES)]
+        queryset = filter_measurements({"sites": sites})
+        with CaptureQueriesContext(connection) as queries:
+            columns, truncated = downsampled_columns(
+                queryset, "aod_500nm", max_points=500
+            )
+        # The extent and row count, the first grid and at most one refinement
+        self.assertLessEqual(len(queries), 3)
+        self.assertLessEqual(len(columns["site"]), 500)
+        self.assertFalse(truncated)
+
+    def test_all_points_date_range_uses_brin(self):
+        # On a table this small a sequential scan, or an index-only scan of the
+        # whole covering index, can cost the same as the BRIN bitmap scan and
+        # the planner's pick would flip with the statistics. BRIN only serves
+        # bitmap scans, so with the others disabled (for this transaction) the
+        # plan shows whether the index exists and can answer the date range.
+        for model in self.brin_models:
+            table = model._meta.db_table
+            with self.subTest(model=model.__name__), transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT indexname FROM pg_indexes"
+                        " WHERE tablename = %s AND indexdef LIKE %s",
+                        [table, "% USING brin %"],
+                    )
+                    self.assertTrue(cursor.fetchall(), f"no BRIN index on {table}")
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+                    cursor.execute("SET LOCAL enable_indexscan = off")
+                    cursor.execute("SET LOCAL enable_indexonlyscan = off")
+                queryset = model.objects.filter(
+                    date_DD_MM_YYYY__range=(date(2011, 3, 1), date(2011, 3, 5))
+                ).values_list("cruise", "date_DD_MM_YYYY")
+                self.assertIndexPlan(queryset, "_date_brin")
+                transaction.set_rollback(True)
+
+
+class PartitionIndexTests(TestCase):
+    """psql_add --rebuild-indexes on a partitioned all_points table."""
+
+    table = DownloadAODAP._meta.db_table
+
+    def leaf_indexes(self, cursor):
+        cursor.execute(
+            """
+            SELECT c.relname, count(i.indexrelid)
+            FROM pg_inherits h
+            JOIN pg_class c ON c.oid = h.inhrelid
+            LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisvalid
+            WHERE c.relkind = 'r' AND c.relname LIKE %s
+            GROUP BY c.relname
+            """,
+            [f"{self.table}_l%"],
+        )
+        return dict(cursor.fetchall())
+
+    def test_rebuild_keeps_partition_indexes(self):
+        load_synthetic(DownloadAODAP)
+        convert_table(self.table)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.object(psql_add, "CSV_FOLDER", directory.name), \
+                connection.cursor() as cursor:
+            before = self.leaf_indexes(cursor)
+            definitions = PsqlAddCommand().drop_indexes(cursor, self.table)
+            self.assertTrue(definitions)
+            for definition in definitions:
+                cursor.execute(rebuild_definition(definition))
+            after = self.leaf_indexes(cursor)
+            cursor.execute(
+                """
+                SELECT count(*) FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indrelid
+                WHERE c.relname = %s AND NOT i.indisvalid
+                """,
+                [self.table],
+            )
+            invalid = cursor.fetchone()[0]
+
+        self.assertTrue(before)
+        self.assertEqual(after, before)
+        self.assertTrue(all(count > 1 for count in after.values()), after)
+        self.assertEqual(invalid, 0)
+
+
+class DroppedIndexTests(SimpleTestCase):
+    """The indexes dropped by --rebuild-indexes outlive a failed load."""
+
+    definitions = [
+        "CREATE INDEX a_idx ON ONLY public.t USING btree (cruise)",
+        "CREATE UNIQUE INDEX b_idx ON public.t USING btree (date)",
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(psql_add, "CSV_FOLDER", directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conn = mock.MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        self.cursor.fetchall.return_value = [
+            (f"{name}_idx", definition)
+            for name, definition in zip("ab", self.definitions)
+        ]
+        self.command = PsqlAddCommand(stdout=io.StringIO())
+        self.command.telemetry = mock.Mock()
+        connect = mock.patch.object(
+            PsqlAddCommand, "get_db_connection", return_value=mock.MagicMock()
+        )
+        connect.start().return_value.__enter__.return_value = self.conn
+        self.addCleanup(connect.stop)
+
+    def executed(self):
+        return [call.args[0] for call in self.cursor.execute.call_args_list]
+
+    def test_definitions_are_recorded_before_dropping(self):
+        def drop(statement, *args):
+            if not isinstance(statement, str):
+                with open(psql_add.dropped_indexes_path("t")) as f:
+                    self.assertEqual(json.load(f), self.definitions)
+
+        self.cursor.execute.side_effect = drop
+        self.command.drop_indexes(self.cursor, "t")
+        self.assertEqual(self.cursor.execute.call_count, 3)
+
+    def test_indexes_are_rebuilt_when_the_load_is_interrupted(self):
+        with mock.patch.object(
+            PsqlAddCommand, "copy_csv", side_effect=KeyboardInterrupt
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                self.command.load_table("t", ["t.csv"], rebuild_indexes=True)
+
+        self.assertEqual(
+            self.executed()[-2:],
+            [psql_add.rebuild_definition(d) for d in self.definitions],
+        )
+        self.conn.rollback.assert_called()
+        self.assertFalse(os.path.exists(psql_add.dropped_indexes_path("t")))
+
+    def test_a_failed_rebuild_keeps_the_record(self):
+        with mock.patch.object(
+            PsqlAddCommand, "rebuild_indexes", side_effect=psycopg2.OperationalError
+        ):
+            with self.assertRaises(psycopg2.OperationalError):
+                self.command.load_table("t", ["t.csv"], rebuild_indexes=True)
+        self.assertTrue(os.path.exists(psql_add.dropped_indexes_path("t")))
+
+    def test_next_run_restores_recorded_indexes(self):
+        self.command.record_dropped_indexes("t", self.definitions)
+        self.command.restore_dropped_indexes()
+        self.assertEqual(
+            self.executed(),
+            [psql_add.rebuild_definition(d) for d in self.definitions],
+        )
+        self.assertFalse(os.path.exists(psql_add.dropped_indexes_path("t")))
+
+    def test_rebuild_can_be_replayed(self):
+        self.assertEqual(
+            psql_add.rebuild_definition(self.definitions[0]),
+            "CREATE INDEX IF NOT EXISTS a_idx ON public.t USING btree (cruise)",
+        )
+        self.assertEqual(
+            psql_add.rebuild_definition(self.definitions[1]),
+            "CREATE UNIQUE INDEX IF NOT EXISTS b_idx ON public.t USING btree (date)",
+        )
+
+
+class ParseDownloadRequestTests(SimpleTestCase):
+    def test_full_date_range_is_no_filter(self):
+        today = datetime.now().date().isoformat()
+        params = parse_download_request({"start_date": "2004-10-16", "end_date": today})
+        self.assertIsNone(params["start_date"])
+        self.assertIsNone(params["end_date"])
+
+        params = parse_download_request(
+            {"start_date": "2004-10-17", "end_date": "2010-01-01"}
+        )
+        self.assertEqual(params["start_date"], "2004-10-17")
+        self.assertEqual(params["end_date"], "2010-01-01")
+
+    def test_bounds_need_all_four_corners(self):
+        # Zero is a valid corner, only missing ones drop the bbox
+        corners = {"min_lat": 0, "min_lng": 0, "max_lat": 5, "max_lng": 20}
+        self.assertEqual(parse_download_request(corners)["bounds"], corners)
+        self.assertIsNone(
+            parse_download_request({**corners, "max_lng": None})["bounds"]
+        )
+        self.assertEqual(parse_download_request(corners)["format"], "csv")
+
+
+def _entry(arcname):
+    return ExportEntry(arcname, "AOD", "Daily", 15, "", [], None)
+
+
+class FilterMeasurementsTests(SimpleTestCase):
+    def test_invalid_filters_are_errors(self):
+        for data in [
+            {"start_date": "2010-02-30"},
+            {"end_date": "last week"},
+            {"start_date": 20100101},
+            {"min_lat": "a", "min_lng": 0, "max_lat": 1, "max_lng": 1},
+        ]:
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    filter_measurements({"sites": ["Cruise_A"], **data})
+
+    def test_site_measurements_answers_400(self):
+        request = AsyncRequestFactory().post(
+            "/",
+            {"sites": ["Cruise_A"], "reading": "aod_500nm", "end_date": "2010-13-01"},
+            content_type="application/json",
+        )
+        request._dont_enforce_csrf_checks = True
+        response = async_to_sync(views.site_measurements)(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            json.loads(response.content), {"error": "Invalid date: 2010-13-01"}
+        )
+
+
+class ParseStatsRequestTests(SimpleTestCase):
+    def test_lists_are_invalid_input(self):
+        for field in ["retrieval", "frequency"]:
+            with self.subTest(field=field):
+                with self.assertRaisesMessage(
+                    ValueError, "Invalid retrieval or frequency"
+                ):
+                    parse_stats_request({"sites": ["Cruise_A"], field: ["AOD"]})
+
+
+class SiteStatisticsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Site.objects.create(name="Cruise_A", aeronet_number=1, span_date=[])
+        cls.add_rows(
+            [
+                (date(2010, 1, 1), 0.1),
+                (date(2010, 1, 2), 0.4),
+                (date(2010, 1, 2), MISSING_VALUE),
+                (date(2010, 1, 3), 0.2),
+                (date(2010, 1, 31), 0.3),
+                (date(2010, 2, 1), 0.5),
+            ]
+        )
+
+    @staticmethod
+    def add_rows(values, cruise="Cruise_A"):
+        DownloadAODDaily.objects.bulk_create(
+            DownloadAODDaily(
+                date_DD_MM_YYYY=day,
+                time_HH_MM_SS=time(12),
+                last_processing_date_DD_MM_YYYY=date(2010, 3, 1),
+                coordinates=Point(10, 20),
+                cruise=cruise,
+                level=15,
+                aod_500nm=value,
+            )
+            for day, value in values
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.params = parse_stats_request(
+            {
+                "sites": ["Cruise_A"],
+                "reading": "aod_500nm",
+                "percentiles": [0, 0.25, 0.5, 1],
+            }
+        )
+
+    def test_aggregates_exclude_missing_values(self):
+        january, february = stats_queryset(self.params)
+        self.assertEqual(january["period"], date(2010, 1, 1))
+        self.assertEqual(january["count"], 4)
+        self.assertAlmostEqual(january["mean"], 0.25)
+        self.assertAlmostEqual(january["std"], 0.1290994, places=6)
+        self.assertEqual((january["min"], january["max"]), (0.1, 0.4))
+        self.assertEqual(february["count"], 1)
+
+    def test_percentiles_interpolate(self):
+        january = stats_queryset(self.params)[0]
+        for got, expected in zip(january["percentiles"], [0.1, 0.175, 0.25, 0.4]):
+            self.assertAlmostEqual(got, expected)
+        payload = site_statistics(self.params)
+        self.assertEqual(payload["percentiles"], ["p0", "p25", "p50", "p100"])
+        self.assertAlmostEqual(payload["stats"][0]["percentiles"]["p25"], 0.175)
+
+    def test_a_period_of_missing_values_has_no_row(self):
+        self.add_rows([(date(2010, 5, 1), MISSING_VALUE)])
+        periods = [row["period"] for row in stats_queryset(self.params)]
+        self.assertEqual(periods, [date(2010, 1, 1), date(2010, 2, 1)])
+
+    def test_key_covers_the_version_and_the_request(self):
+        key = stats_cache_key(1, self.params)
+        self.assertEqual(key, stats_cache_key(1, dict(self.params)))
+        self.assertNotEqual(key, stats_cache_key(2, self.params))
+        for name, value in [("percentiles", [0.5]), ("period", "year")]:
+            with self.subTest(name=name):
+                params = dict(self.params, **{name: value})
+                self.assertNotEqual(key, stats_cache_key(1, params))
+
+    def test_cached_until_the_version_changes(self):
+        version = DataVersion.cached()
+        first = cached_statistics(version, self.params)
+        self.add_rows([(date(2010, 2, 2), 0.7)])
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_statistics(version, self.params), first)
+
+        DataVersion.bump()
+        self.assertNotEqual(DataVersion.cached(), version)
+        fresh = cached_statistics(DataVersion.cached(), self.params)
+        self.assertEqual(fresh["stats"][1]["count"], 2)
+
+
+class StreamArchiveTests(SimpleTestCase):
+    def setUp(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        self.src = src.name
+        patcher = mock.patch.object(downloads, "SRC_DIR", self.src)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def archive(self, chunks):
+        return zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+
+    def test_members_round_trip(self):
+        contents = {
+            "A.csv": [b"preamble\n", b"1,2\n" * 5000],
+            "B.csv": [b"x\n"],
+            "C.csv": [],
+        }
+        entries = [_entry(name) for name in contents]
+        archive = self.archive(
+            stream_archive(entries, "root", lambda entry: contents[entry.arcname])
+        )
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ["root/A.csv", "root/B.csv", "root/C.csv"])
+        for name, parts in contents.items():
+            info = archive.getinfo(f"root/{name}")
+            # Written front to back, so sizes and CRC follow the data
+            self.assertTrue(info.flag_bits & 0x08)
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.read(info), b"".join(parts))
+
+    def test_parquet_members_are_stored(self):
+        entries = [_entry("A.parquet"), _entry("A.arrow")]
+        archive = self.archive(
+            stream_archive(entries, "root", lambda entry: [b"PAR1" * 100])
+        )
+        self.assertEqual(
+            archive.getinfo("root/A.parquet").compress_type, zipfile.ZIP_STORED
+        )
+        self.assertEqual(
+            archive.getinfo("root/A.arrow").compress_type, zipfile.ZIP_DEFLATED
+        )
+        self.assertEqual(archive.read("root/A.parquet"), b"PAR1" * 100)
+
+    def test_policy_files_are_appended(self):
+        with open(os.path.join(self.src, "data_usage_policy.txt"), "wb") as f:
+            f.write(b"policy\n")
+        archive = self.archive(stream_archive([], "root", iter))
+        self.assertEqual(archive.namelist(), ["root/data_usage_policy.txt"])
+        self.assertEqual(archive.read("root/data_usage_policy.txt"), b"policy\n")
+
+    def test_output_starts_before_the_member_is_encoded(self):
+        produced = []
+
+        def chunk_source(entry):
+            for _ in range(20):
+                produced.append(entry.arcname)
+                yield os.urandom(64 * 1024)
+
+        chunks = stream_archive([_entry("A.csv")], "root", chunk_source)
+        first = next(chunk for chunk in chunks if chunk)
+        self.assertTrue(first.startswith(b"PK\x03\x04"))
+        self.assertLess(len(produced), 20)
+        chunks.close()
+
+    def test_zip_stream_counts_drained_bytes(self):
+        sink = ZipStream()
+        sink.write(b"abc")
+        self.assertEqual(sink.drain(), b"abc")
+        sink.write(b"de")
+        self.assertEqual(sink.tell(), 5)
+        self.assertEqual(sink.drain(), b"de")
+        self.assertEqual(sink.drain(), b"")
+
+
+class CsvChunkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        DownloadAODDaily.objects.bulk_create(
+            DownloadAODDaily(
+                date_DD_MM_YYYY=date(2010, 1, day),
+                time_HH_MM_SS=time(12),
+                last_processing_date_DD_MM_YYYY=date(2010, 2, 1),
+                cruise="Cruise_A",
+                level=15,
+                aod_500nm=day / 10,
+            )
+            for day in range(1, 6)
+        )
+
+    def entry(self):
+        return ExportEntry(
+            "A.csv",
+            "AOD",
+            "Daily",
+            15,
+            "preamble\n",
+            ["date_DD_MM_YYYY", "aod_500nm"],
+            DownloadAODDaily.objects.order_by("date_DD_MM_YYYY"),
+        )
+
+    def test_rows_are_encoded_in_chunks(self):
+        chunks = list(iter_csv_chunks(self.entry(), chunk_size=2))
+        self.assertEqual(chunks[0], b"preamble\n")
+        self.assertEqual(chunks[1], b"2010-01-01,0.1\n2010-01-02,0.2\n")
+        self.assertEqual([chunk.count(b"\n") for chunk in chunks[1:]], [2, 2, 1])
+
+    def test_no_empty_chunk_after_a_full_one(self):
+        chunks = list(iter_csv_chunks(self.entry(), chunk_size=5))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[1].count(b"\n"), 5)
+
+
+class BboxFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        DownloadAODDaily.objects.bulk_create(
+            DownloadAODDaily(
+                date_DD_MM_YYYY=date(2010, 1, 1),
+                time_HH_MM_SS=time(12),
+                last_processing_date_DD_MM_YYYY=date(2010, 2, 1),
+                coordinates=Point(lng, 10),
+                cruise=cruise,
+                level=15,
+            )
+            for cruise, lng in [("Cruise_A", 5), ("Cruise_B", 50)]
+        )
+        TableHeader.objects.create(
+            datatype="AOD",
+            freq="Daily",
+            level=15,
+            base_header_l1="l1\n",
+            base_header_l2="l2\n",
+        )
+
+    def params(self):
+        return parse_download_request(
+            {
+                "sites": ["Cruise_A", "Cruise_B"],
+                "min_lng": 0,
+                "min_lat": 0,
+                "max_lng": 20,
+                "max_lat": 20,
+            }
+        )
+
+    def cruises(self):
+        queryset = filter_queryset(DownloadAODDaily, self.params(), 15)
+        return sorted(queryset.values_list("cruise", flat=True))
+
+    def test_cruises_without_a_track_are_not_dropped(self):
+        # SiteTrack is empty until refresh_derived_tables has run
+        self.assertEqual(self.cruises(), ["Cruise_A"])
+        (entry,) = build_export_plan(
+            {
+                **self.params(),
+                "retrievals": ["AOD"],
+                "frequency": ["Daily"],
+                "quality": ["Level 1.5"],
+            }
+        )
+        text = b"".join(iter_csv_chunks(entry)).decode()
+        self.assertTrue(text.startswith(entry.preamble))
+        (row,) = text[len(entry.preamble):].splitlines()
+        self.assertIn("Cruise_A", row)
+
+    def test_tracks_prune_cruises_outside_the_bbox(self):
+        for cruise, lng in [("Cruise_A", 5), ("Cruise_B", 50)]:
+            SiteTrack.objects.create(
+                cruise=cruise,
+                level=15,
+                envelope=Polygon.from_bbox((lng, 10, lng + 0.1, 10.1)),
+            )
+        self.assertEqual(self.cruises(), ["Cruise_A"])
+
+
+class DownsamplingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Site.objects.create(name="Cruise_A", aeronet_number=1, span_date=[])
+        DownloadAODDaily.objects.bulk_create(
+            DownloadAODDaily(
+                date_DD_MM_YYYY=day,
+                time_HH_MM_SS=at,
+                last_processing_date_DD_MM_YYYY=date(2010, 2, 1),
+                coordinates=Point(10.2 + index / 10, 20.2),
+                cruise="Cruise_A",
+                level=15,
+                aod_500nm=0.1,
+            )
+            for index, (day, at) in enumerate(
+                [
+                    (date(2010, 1, 2), time(1)),
+                    (date(2010, 1, 1), time(23)),
+                    (date(2010, 1, 3), time(0, 30)),
+                ]
+            )
+        )
+
+    def test_bins_carry_the_time_of_their_first_measurement(self):
+        queryset = filter_measurements({"sites": ["Cruise_A"]})
+        columns, truncated = downsampled_columns(queryset, "aod_500nm", resolution=1)
+        self.assertFalse(truncated)
+        self.assertEqual(columns["date"], [date(2010, 1, 1)])
+        self.assertEqual(columns["time"], [time(23)])
+        self.assertEqual(columns["end_date"], [date(2010, 1, 3)])
+        self.assertEqual(columns["count"], [3])
+
+    def test_points_that_fit_are_kept_apart(self):
+        queryset = filter_measurements({"sites": ["Cruise_A"]})
+        with CaptureQueriesContext(connection) as queries:
+            columns, truncated = downsampled_columns(
+                queryset, "aod_500nm", max_points=3
+            )
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(truncated)
+        self.assertEqual(columns["count"], [1, 1, 1])
+
+
+@override_settings(DOWNLOAD_EXPORT_ENGINE="orm")
+class ExportEngineTests(SimpleTestCase):
+    def test_configured_engine(self):
+        self.assertIs(downloads.get_export_engine(), iter_csv_chunks)
+        self.assertIs(
+            downloads.get_export_engine("copy"), downloads.iter_copy_chunks
+        )
+
+    def test_copy_is_forced_without_server_side_cursors(self):
+        # Behind pgbouncer .iterator() would fetch the whole result at once
+        with mock.patch.dict(
+            connection.settings_dict, {"DISABLE_SERVER_SIDE_CURSORS": True}
+        ):
+            self.assertIs(downloads.get_export_engine(), downloads.iter_copy_chunks)
+            self.assertIs(
+                downloads.get_export_engine("orm"), downloads.iter_copy_chunks
+            )
+
+
+class CopyCancelTests(SimpleTestCase):
+    def cursor(self, copy_expert):
+        cursor = mock.Mock()
+        cursor.copy_expert.side_effect = copy_expert
+        return cursor
+
+    def test_abandoned_copy_closes_the_connection(self):
+        def endless(statement, target, size):
+            while True:
+                target.write(b"x" * downloads.COPY_CHUNK_BYTES)
+
+        cursor = self.cursor(endless)
+        chunks = downloads._iter_copy_psycopg2(cursor, "COPY")
+        next(chunks)
+        chunks.close()
+        cursor.db.close.assert_called_once_with()
+
+    def test_finished_copy_keeps_the_connection(self):
+        def short(statement, target, size):
+            target.write(b"1,2\n")
+
+        cursor = self.cursor(short)
+        chunks = downloads._iter_copy_psycopg2(cursor, "COPY")
+        self.assertEqual(b"".join(chunks), b"1,2\n")
+        cursor.db.close.assert_not_called()
+
+
+class AiterChunksTests(SimpleTestCase):
+    def collect(self, chunks, maxsize=2):
+        async def run():
+            return [chunk async for chunk in aiter_chunks(chunks, maxsize)]
+
+        return asyncio.run(run())
+
+    def test_chunks_arrive_in_order(self):
+        chunks = [str(i).encode() for i in range(20)]
+        self.assertEqual(self.collect(iter(chunks)), chunks)
+
+    def test_producer_error_is_raised_after_its_chunks(self):
+        def failing():
+            yield b"a"
+            raise ValueError("boom")
+
+        with self.assertRaisesMessage(ValueError, "boom"):
+            self.collect(failing())
+
+    def test_producer_stops_when_the_client_does(self):
+        produced = []
+
+        def endless():
+            while True:
+                produced.append(1)
+                yield b"x"
+
+        async def run():
+            chunks = aiter_chunks(endless(), maxsize=3)
+            await chunks.__anext__()
+            await asyncio.sleep(0.2)
+            ahead = len(produced)
+            await chunks.aclose()
+            await asyncio.sleep(1)
+            return ahead
+
+        ahead = asyncio.run(run())
+        # One chunk read, three in flight, one waiting for a slot
+        self.assertEqual(ahead, 5)
+        self.assertEqual(len(produced), ahead)
+
+
+DOWNLOAD_PARAMS = {
+    "sites": ["Cruise_B", "Cruise_A"],
+    "retrievals": ["AOD", "SDA"],
+    "frequency": ["Daily"],
+    "quality": ["Level 1.5", "Level 2.0"],
+    "start_date": "2010-01-01",
+    "end_date": None,
+    "bounds": {"min_lat": "1", "max_lat": 2, "min_lng": 3, "max_lng": "4"},
+}
+
+
+class CacheKeyTests(SimpleTestCase):
+    def key(self, engine="copy", version=1, **overrides):
+        return cache_key({**DOWNLOAD_PARAMS, **overrides}, engine, data_version=version)
+
+    def test_equivalent_requests_share_a_key(self):
+        same = self.key(
+            sites=["Cruise_A", "Cruise_B", "Cruise_A"],
+            retrievals=["SDA", "AOD"],
+            quality=["Level 2.0", "Level 1.5"],
+            bounds={"max_lng": 4.0, "min_lng": 3, "max_lat": 2, "min_lat": 1.0},
+        )
+        self.assertEqual(same, self.key())
+
+    def test_anything_that_changes_the_archive_changes_the_key(self):
+        variants = {
+            "engine": self.key(engine="orm"),
+            "version": self.key(version=2),
+            "sites": self.key(sites=["Cruise_A"]),
+            "end_date": self.key(end_date="2011-01-01"),
+            "bounds": self.key(bounds=None),
+            "format": self.key(format="parquet"),
+        }
+        for name, key in variants.items():
+            with self.subTest(name):
+                self.assertNotEqual(key, self.key())
+
+
+class CacheKeyVersionTests(TestCase):
+    def test_bump_retires_every_key(self):
+        before = cache_key(DOWNLOAD_PARAMS, "copy")
+        DataVersion.bump()
+        self.assertNotEqual(cache_key(DOWNLOAD_PARAMS, "copy"), before)
+
+    def test_async_read_falls_back_to_the_table(self):
+        version = DataVersion.bump()
+        cache.delete(DataVersion.CACHE_KEY)
+        self.assertEqual(async_to_sync(DataVersion.acached)(), version)
+        self.assertEqual(cache.get(DataVersion.CACHE_KEY), version)
+
+
+class TeeToCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(
+            DOWNLOAD_CACHE_DIR=self.directory, DOWNLOAD_CACHE_MAX_BYTES=0
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def read(self, key):
+        with open(cached_path(key), "rb") as f:
+            return f.read()
+
+    def test_only_complete_archives_are_published(self):
+        self.assertEqual(b"".join(tee_to_cache("full", [b"a", b"b"])), b"ab")
+        self.assertEqual(self.read("full"), b"ab")
+
+        aborted = tee_to_cache("aborted", iter([b"a", b"b", b"c"]))
+        next(aborted)
+        aborted.close()
+
+        def broken():
+            yield b"a"
+            raise OSError("connection lost")
+
+        with self.assertRaises(OSError):
+            b"".join(tee_to_cache("broken", broken()))
+
+        self.assertIsNone(cached_path("aborted"))
+        self.assertIsNone(cached_path("broken"))
+        self.assertEqual(os.listdir(self.directory), ["full.zip"])
+
+    def test_concurrent_writers_do_not_mix(self):
+        first = tee_to_cache("key", [b"one", b"more"])
+        next(first)
+        other = threading.Thread(target=lambda: b"".join(tee_to_cache("key", [b"two"])))
+        other.start()
+        other.join()
+        self.assertEqual(self.read("key"), b"two")
+
+        # The slower writer replaces the archive whole once it completes
+        list(first)
+        self.assertEqual(self.read("key"), b"onemore")
+        self.assertEqual(os.listdir(self.directory), ["key.zip"])
+
+    def archive(self, name, size, mtime):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (mtime, mtime))
+
+    def test_evict_least_recently_used(self):
+        self.archive("a.zip", 10, 1000)
+        self.archive("b.zip", 10, 2000)
+        self.archive(".c.1.2.part", 100, 0)
+        # A hit refreshes the archive, so b is now the oldest
+        cached_path("a")
+        evict(max_bytes=15)
+        self.assertEqual(sorted(os.listdir(self.directory)), [".c.1.2.part", "a.zip"])
+
+        # No budget, no eviction
+        evict()
+        self.assertEqual(sorted(os.listdir(self.directory)), [".c.1.2.part", "a.zip"])
+
+
+class ServeCachedTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "archive.zip")
+        self.write_archive()
+
+    def write_archive(self):
+        with open(self.path, "wb") as f:
+            f.write(b"0123456789")
+
+    def serve(self, range_header=None):
+        headers = {"HTTP_RANGE": range_header} if range_header else {}
+        request = RequestFactory().get("/", **headers)
+        response = serve_cached(request, self.path, "download.zip")
+        self.addCleanup(response.close)
+        return response
+
+    def test_whole_archive(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn('filename="download.zip"', response["Content-Disposition"])
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+    def test_single_ranges(self):
+        cases = [
+            ("bytes=2-5", "bytes 2-5/10", b"2345"),
+            ("bytes=7-", "bytes 7-9/10", b"789"),
+            ("bytes=-3", "bytes 7-9/10", b"789"),
+            ("bytes=-20", "bytes 0-9/10", b"0123456789"),
+            ("bytes=8-100", "bytes 8-9/10", b"89"),
+            ("bytes=9-9", "bytes 9-9/10", b"9"),
+        ]
+        for range_header, content_range, body in cases:
+            with self.subTest(range=range_header):
+                response = self.serve(range_header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response["Content-Range"], content_range)
+                self.assertEqual(response["Content-Length"], str(len(body)))
+                self.assertEqual(b"".join(response.streaming_content), body)
+
+    def test_unsatisfiable_ranges(self):
+        for range_header in ("bytes=10-", "bytes=5-2"):
+            with self.subTest(range=range_header):
+                response = self.serve(range_header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response["Content-Range"], "bytes */10")
+
+    def test_unsupported_ranges_get_the_whole_archive(self):
+        for range_header in ("bytes=0-1,4-5", "bytes=-", "items=0-1"):
+            with self.subTest(range=range_header):
+                response = self.serve(range_header)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+    def test_evicted_archive(self):
+        os.remove(self.path)
+        with self.assertRaises(FileNotFoundError):
+            self.serve()
+
+    def test_eviction_does_not_cut_responses_short(self):
+        for range_header in (None, "bytes=2-"):
+            with self.subTest(range=range_header):
+                response = self.serve(range_header)
+                os.remove(self.path)
+                body = b"".join(response.streaming_content)
+                self.assertTrue(body.endswith(b"23456789"))
+                self.write_archive()
+
+    @override_settings(DOWNLOAD_CACHE_SENDFILE_HEADER="X-Accel-Redirect")
+    def test_sendfile_hands_the_archive_to_the_front_end(self):
+        request = RequestFactory().get("/", HTTP_RANGE="bytes=2-5")
+        for prefix, location in [
+            ("/protected/downloads/", "/protected/downloads/archive.zip"),
+            ("/protected/exports/", "/protected/exports/archive.zip"),
+            ("", self.path),
+        ]:
+            with self.subTest(prefix=prefix):
+                response = serve_cached(request, self.path, "download.zip", prefix)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response["X-Accel-Redirect"], location)
+                self.assertEqual(response.content, b"")
+
+        # Evicted or expired archives are reported as without sendfile
+        os.remove(self.path)
+        with self.assertRaises(FileNotFoundError):
+            serve_cached(request, self.path, "download.zip", "/protected/exports/")
+
+
+class ExportQueueTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def job(self, **fields):
+        return ExportJob.objects.create(params={}, archive_name="a.zip", **fields)
+
+    def test_jobs_are_claimed_oldest_first_and_once(self):
+        first = self.job()
+        second = self.job()
+        claimed = claim_job()
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, ExportJob.RUNNING)
+        self.assertEqual(claimed.attempt, 1)
+        self.assertIsNotNone(claimed.heartbeat)
+        self.assertEqual(claim_job().pk, second.pk)
+        self.assertIsNone(claim_job())
+
+    def test_stale_jobs_are_requeued_and_the_old_claim_is_lost(self):
+        self.job()
+        stale = claim_job()
+        owned(stale).update(heartbeat=now() - timedelta(minutes=20), bytes_written=9)
+        fresh = self.job()
+        claim_job()
+
+        self.assertEqual(requeue_stale(timedelta(minutes=10)), 1)
+        requeued = ExportJob.objects.get(pk=stale.pk)
+        self.assertEqual(requeued.status, ExportJob.QUEUED)
+        self.assertEqual(requeued.bytes_written, 0)
+        self.assertEqual(ExportJob.objects.get(pk=fresh.pk).status, ExportJob.RUNNING)
+
+        again = claim_job()
+        self.assertEqual((again.pk, again.attempt), (stale.pk, 2))
+        # The first worker can no longer write to the job
+        self.assertEqual(owned(stale).update(heartbeat=now()), 0)
+        self.assertEqual(owned(again).update(heartbeat=now()), 1)
+
+    def test_expired_archives_are_deleted(self):
+        paths = []
+        for name in ("old", "new"):
+            path = os.path.join(self.directory, f"{name}.zip")
+            with open(path, "wb") as f:
+                f.write(b"zip")
+            paths.append(path)
+        old = self.job(
+            status=ExportJob.DONE, path=paths[0], expires=now() - timedelta(hours=1)
+        )
+        new = self.job(
+            status=ExportJob.DONE, path=paths[1], expires=now() + timedelta(hours=1)
+        )
+
+        self.assertEqual(purge_expired(), 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        old.refresh_from_db()
+        self.assertEqual((old.status, old.path), (ExportJob.EXPIRED, ""))
+        self.assertEqual(ExportJob.objects.get(pk=new.pk).status, ExportJob.DONE)
+
+        response = views.export_file(RequestFactory().get("/"), old.job_id)
+        self.assertEqual(response.status_code, 410)
+
+
+class CachedDownloadTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            DOWNLOAD_CACHE_DIR=directory.name, DOWNLOAD_CACHE_SENDFILE_HEADER=None
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        with open(os.path.join(directory.name, "hit.zip"), "wb") as f:
+            f.write(b"0123456789")
+        cache.set(DataVersion.CACHE_KEY, 1)
+        self.addCleanup(cache.delete, DataVersion.CACHE_KEY)
+        for name, value in [("shard_plan", None), ("cache_key", "hit")]:
+            patcher = mock.patch.object(views, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def download(self, factory, **headers):
+        request = factory.post(
+            "/download/", {"sites": []}, content_type="application/json", **headers
+        )
+        request._dont_enforce_csrf_checks = True
+        return async_to_sync(views.download_data)(request)
+
+    def test_cache_hits_stream_asynchronously_under_asgi(self):
+        for range_header in (None, "bytes=2-5"):
+            with self.subTest(range=range_header):
+                headers = {"HTTP_RANGE": range_header} if range_header else {}
+                response = self.download(AsyncRequestFactory(), **headers)
+                self.assertTrue(response.is_async)
+
+                async def body():
+                    chunks = [chunk async for chunk in response.streaming_content]
+                    return b"".join(chunks)
+
+                expected = b"2345" if range_header else b"0123456789"
+                self.assertEqual(async_to_sync(body)(), expected)
+                response.close()
+
+    def test_cache_hits_stay_synchronous_under_wsgi(self):
+        response = self.download(RequestFactory())
+        self.addCleanup(response.close)
+        self.assertFalse(response.is_async)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+
+AERONET_PREAMBLE = [
+    "Maritime Aerosol Network (MAN) Version 3: AOD Level 1.5\n",
+    "Cruise_X,Synthetic test cruise\n",
+    "Version 3: Level 1.5\n",
+    "PI=Jane Doe,Email=jane@example.org,john@example.org\n",
+    "Date(dd:mm:yyyy),Time(hh:mm:ss),Air Mass,Latitude,Longitude,AOD_500nm(int),"
+    "Last_Processing_Date(dd:mm:yyyy),AERONET_Number\n",
+]
+AERONET_ROWS = (
+    "02:03:2010,10:20:30,1.5,-12.5, 45.25,0.123456,01:04:2010,7\n"
+    "\n"
+    "03:03:2010,11:00:00,1.6,-12.6,45.5,-999.000000,01:04:2010,7\n"
+)
+
+
+class AeronetParsingTests(SimpleTestCase):
+    def test_preamble(self):
+        cruise, pi, pi_email, header = parse_preamble(AERONET_PREAMBLE)
+        self.assertEqual((cruise, pi), ("Cruise_X", "Jane Doe"))
+        # Several addresses are kept, ";"-separated so the CSV stays intact
+        self.assertEqual(pi_email, "jane@example.org;john@example.org")
+        self.assertIn("AOD_500nm", header)
+        self.assertEqual(header[-1], "AERONET_Number")
+
+    def test_file_names(self):
+        cases = {
+            "./src/Cruise_X/Cruise_X_daily.lev15": ("AOD", "15"),
+            "./src/Cruise_X/Cruise_X_all_points.lev20": ("AOD", "20"),
+            "./src/Cruise_X/Cruise_X_series.ONEILL_10": ("SDA", "10"),
+        }
+        for name, expected in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(describe_file(name), expected)
+        self.assertEqual(
+            output_csv_path("./src/Cruise_X/Cruise_X_series.ONEILL_10"),
+            "./src/Cruise_X/Cruise_X_series_SDA_10.csv",
+        )
+
+    def test_measurements(self):
+        *_, header = parse_preamble(AERONET_PREAMBLE)
+        df = read_measurements(io.StringIO(AERONET_ROWS), header, "AOD")
+        self.assertEqual(len(df), 2)
+        self.assertNotIn("Latitude", df.columns)
+        self.assertEqual(list(df["date_DD_MM_YYYY"]), ["2010-03-02", "2010-03-03"])
+        self.assertEqual(df["coordinates"].iloc[0], "POINT (45.25 -12.5)")
+        self.assertEqual(df["coordinates_wkt"].iloc[1], "POINT (45.5 -12.6)")
+        # Values stay as the source text, sentinels included
+        self.assertEqual(list(df["aod_500nm"]), ["0.123456", "-999.000000"])
+
+    def test_points_are_written_as_geos_does(self):
+        # As Point(-70.1, 41).wkt: shortest digits, no trailing zeros
+        self.assertEqual(wkt_point("-70.100000", "41.000000"), "POINT (-70.1 41)")
+        self.assertEqual(wkt_point(" 0.000010", "-0.5"), "POINT (0.00001 -0.5)")
+        *_, header = parse_preamble(AERONET_PREAMBLE)
+        rows = AERONET_ROWS.replace("-12.5, 45.25", "41.000000,-70.100000")
+        df = read_measurements(io.StringIO(rows), header, "AOD")
+        self.assertEqual(df["coordinates_wkt"].iloc[0], "POINT (-70.1 41)")
+
+    def test_blank_coordinates_are_loaded_as_empty_points(self):
+        self.assertEqual(wkt_point("", "41.000000"), "POINT EMPTY")
+        self.assertEqual(wkt_point("-70.1", "nan"), "POINT EMPTY")
+        *_, header = parse_preamble(AERONET_PREAMBLE)
+        rows = AERONET_ROWS.replace("-12.5, 45.25", ",")
+        df = read_measurements(io.StringIO(rows), header, "AOD")
+        self.assertEqual(
+            list(df["coordinates"]), ["POINT EMPTY", "POINT (45.5 -12.6)"]
+        )
+
+    def test_vectorised_points_match_wkt_point(self):
+        *_, header = parse_preamble(AERONET_PREAMBLE)
+        coordinates = [
+            ("-12.500000", "45.250000"),
+            ("+007.50", "-0.000010"),
+            ("1e-5", "12.3456789012345678"),
+            ("abc", "1"),
+        ]
+        rows = "".join(
+            f"02:03:2010,10:20:30,1.5,{lat},{lng},0.1,01:04:2010,7\n"
+            for lat, lng in coordinates
+        )
+        df = read_measurements(io.StringIO(rows), header, "AOD")
+        self.assertEqual(
+            list(df["coordinates_wkt"]),
+            [wkt_point(lng, lat) for lat, lng in coordinates],
+        )
+
+    def test_convert_files(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        os.mkdir("Cruise_X")
+        daily = "./Cruise_X/Cruise_X_daily.lev15"
+        with open(daily, "w", encoding="latin-1") as f:
+            f.writelines(AERONET_PREAMBLE)
+            f.write(AERONET_ROWS)
+        # No ",Email=" on the PI line
+        broken = "./Cruise_X/Cruise_X_series.lev20"
+        with open(broken, "w", encoding="latin-1") as f:
+            f.writelines(AERONET_PREAMBLE[:3] + ["PI=Jane Doe\n", AERONET_PREAMBLE[4]])
+
+        results = {
+            result["file"]: result for result in convert_files([daily, broken], 1)
+        }
+
+        converted = results[daily]
+        self.assertIsNone(converted["error"])
+        self.assertEqual(converted["rows"], 2)
+        self.assertEqual(converted["site"][:2], ["Cruise_X", "7"])
+        with open(converted["output"], newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            [rows[0][name] for name in ("cruise", "level", "pi", "coordinates")],
+            ["Cruise_X", "15", "Jane Doe", "POINT (45.25 -12.5)"],
+        )
+
+        failed = results[broken]
+        self.assertIsNone(failed["output"])
+        self.assertIsNone(failed["site"])
+        self.assertIsNone(failed["error"]["cruise"])
+        self.assertIn("error", failed["error"])
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def perf_counter(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class IngestTelemetryTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ingest_telemetry, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lines = []
+        self.run = IngestRun("test", self.lines.append)
+        self.run.expected = 4
+
+    def parse_and_copy(self, name, parse, copy, rows, size):
+        timings = {}
+        with timed(timings, "parse") as entry:
+            self.clock.advance(parse)
+            entry["rows"] = rows
+            entry["bytes"] = size
+        timings["copy"] = timing(copy, size, rows)
+        self.clock.advance(copy)
+        self.run.record_file(name, timings)
+
+    def record(self):
+        self.parse_and_copy("a.csv", parse=2, copy=0.5, rows=1000, size=4096)
+        self.parse_and_copy("b.csv", parse=1, copy=2.5, rows=500, size=1024)
+        with self.run.stage("download") as entry:
+            self.clock.advance(4)
+            entry["bytes"] = 8 * 1024**2
+        self.run.record_file("c.csv", error="boom")
+
+    def test_stage_throughput(self):
+        self.record()
+        summary = self.run.summary()
+        stages = summary["stages"]
+        self.assertEqual(
+            stages["parse"],
+            {
+                "seconds": 3.0,
+                "bytes": 5120,
+                "rows": 1500,
+                "files": 2,
+                "rows_per_second": 500.0,
+                "bytes_per_second": round(5120 / 3, 1),
+            },
+        )
+        self.assertEqual(stages["copy"]["rows_per_second"], 500.0)
+        self.assertEqual(stages["download"]["files"], 0)
+        self.assertEqual(stages["download"]["bytes_per_second"], 2 * 1024**2)
+        self.assertEqual(summary["elapsed_seconds"], 10.0)
+        self.assertEqual((summary["files"], summary["errors"]), (3, 1))
+
+    def test_per_file_timings(self):
+        self.record()
+        summary = self.run.summary()
+        files = {record["file"]: record for record in summary["file_timings"]}
+        self.assertEqual(files["a.csv"]["stages"]["parse"], timing(2, 4096, 1000))
+        self.assertEqual(files["b.csv"]["stages"]["copy"]["seconds"], 2.5)
+        self.assertEqual(files["c.csv"]["error"], "boom")
+
+        self.run.report(slowest=1)
+        self.assertIn("Slowest 1 of 3 files:", self.lines)
+        slowest = self.lines[self.lines.index("Slowest 1 of 3 files:") + 2]
+        self.assertTrue(slowest.startswith("b.csv"), slowest)
+
+    def test_progress_every_interval(self):
+        self.record()
+        # b.csv lands 6s in; c.csv, 4s later, is within the interval again
+        self.assertEqual(
+            self.lines,
+            ["test: 2/4 files, 1500 rows in 6s (250 rows/s), about 6s left"],
+        )
+
+    def test_summary_file(self):
+        self.record()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = self.run.write_summary(os.path.join(directory.name, "run.json"))
+        with open(path) as f:
+            self.assertEqual(json.load(f), self.run.summary())
+
+
+class IncrementalImportTests(TestCase):
+    """import_dd --incremental against the SourceFile manifest."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        os.mkdir("src_csvs")
+        for cruise in ["Cruise_X", "Cruise_Y"]:
+            self.write(cruise, AERONET_ROWS)
+
+    def write(self, cruise, rows):
+        preamble = [line.replace("Cruise_X", cruise) for line in AERONET_PREAMBLE]
+        with open(f"./src_csvs/{cruise}_daily.lev15", "w", encoding="latin-1") as f:
+            f.writelines(preamble)
+            f.write(rows)
+
+    def import_changed(self):
+        telemetry = IngestRun("test", lambda line: None)
+        with mock.patch.object(
+            import_dd, "convert_files", wraps=convert_files
+        ) as convert:
+            ImportDDCommand().csv(workers=1, incremental=True, telemetry=telemetry)
+        return sorted(convert.call_args.args[0])
+
+    def test_unchanged_files_are_skipped(self):
+        converted = self.import_changed()
+        self.assertEqual(
+            converted,
+            ["./src_csvs/Cruise_X_daily.lev15", "./src_csvs/Cruise_Y_daily.lev15"],
+        )
+        manifest = {source.cruise: source for source in SourceFile.objects.all()}
+        self.assertEqual(set(manifest), {"Cruise_X", "Cruise_Y"})
+        self.assertFalse(any(source.loaded for source in manifest.values()))
+        self.assertTrue(os.path.isfile(manifest["Cruise_X"].output_csv))
+        self.assertEqual(manifest["Cruise_X"].level, 15)
+        # As psql_add --incremental does once the rows are in
+        SourceFile.objects.update(loaded=True)
+
+        self.assertEqual(self.import_changed(), [])
+        self.assertTrue(all(SourceFile.objects.values_list("loaded", flat=True)))
+
+        self.write("Cruise_Y", AERONET_ROWS.replace("0.123456", "0.2"))
+        self.assertEqual(self.import_changed(), ["./src_csvs/Cruise_Y_daily.lev15"])
+        self.assertEqual(
+            dict(SourceFile.objects.values_list("cruise", "loaded")),
+            {"Cruise_X": True, "Cruise_Y": False},
+        )
+        self.assertNotEqual(
+            SourceFile.objects.get(cruise="Cruise_Y").sha256,
+            manifest["Cruise_Y"].sha256,
+        )
+
+
+class StreamingIngestTests(SimpleTestCase):
+    def copy_rows(self, lines):
+        cruise, pi, pi_email, header = parse_preamble(AERONET_PREAMBLE)
+        columns = copy_columns(header, "AOD")
+        rows = iter_copy_rows(lines, header, cruise, "15", pi, pi_email)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def test_rows_line_up_with_copy_columns(self):
+        rows = self.copy_rows(AERONET_ROWS.splitlines())
+        self.assertEqual(len(rows), 2)
+        first = rows[0]
+        self.assertEqual(first["date_DD_MM_YYYY"], "2010-03-02")
+        self.assertEqual(first["last_processing_date_DD_MM_YYYY"], "2010-04-01")
+        self.assertEqual(first["coordinates"], "POINT (45.25 -12.5)")
+        self.assertEqual(first["coordinates_wkt"], first["coordinates"])
+        self.assertEqual(first["aod_500nm"], "0.123456")
+        self.assertEqual(
+            [first[name] for name in ("cruise", "level", "pi", "pi_email")],
+            ["Cruise_X", "15", "Jane Doe", "jane@example.org;john@example.org"],
+        )
+
+    def test_blank_coordinates_do_not_abort_the_member(self):
+        lines = AERONET_ROWS.replace("-12.6,45.5", ",").splitlines()
+        rows = self.copy_rows(lines)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]["coordinates"], "POINT EMPTY")
+        self.assertEqual(rows[1]["coordinates_wkt"], "POINT EMPTY")
+        self.assertEqual(rows[1]["aod_500nm"], "-999.000000")
+
+    def test_malformed_dates_are_loaded_as_null(self):
+        line = "2010-03-02,10:20:30,1.5,-12.5,45.25,0.1,01:04:2010,7"
+        (row,) = self.copy_rows(["   ", line])
+        self.assertEqual(row["date_DD_MM_YYYY"], "")
+        self.assertEqual(row["last_processing_date_DD_MM_YYYY"], "2010-04-01")
+
+    def test_member_names(self):
+        self.assertTrue(is_measurement_file("src/Cruise_X/Cruise_X_daily.lev15"))
+        self.assertTrue(is_measurement_file("Cruise_X_all_points.ONEILL_20"))
+        self.assertFalse(is_measurement_file("Cruise_X_daily.lev15.txt"))
+        self.assertFalse(is_measurement_file("data_usage_policy.pdf"))
+        self.assertEqual(describe_frequency("Cruise_X_all_points.lev10"), "Point")
+        self.assertEqual(describe_frequency("Cruise_X_series.ONEILL_15"), "Series")
+        self.assertEqual(describe_frequency("Cruise_X_daily.lev20"), "Daily")
+        self.assertIsNone(describe_frequency("Cruise_X_monthly.lev20"))
+
+    def test_csv_bytes_split_between_rows(self):
+        rows = [[index, "a,b", 'quote "x"', "café"] for index in range(1000)]
+        chunks = list(iter_csv_bytes(rows, chunk_bytes=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunk.endswith(b"\n") for chunk in chunks))
+        decoded = b"".join(chunks).decode("utf-8")
+        self.assertEqual(
+            list(csv.reader(io.StringIO(decoded))),
+            [[str(index), "a,b", 'quote "x"', "café"] for index in range(1000)],
+        )
+        self.assertEqual(list(iter_csv_bytes([])), [])
+
+    def test_chunk_pipe(self):
+        pipe = ChunkPipe(iter([b"abc", b"", b"defgh", b"ij"]))
+        self.assertEqual(pipe.read(2), b"ab")
+        self.assertEqual(pipe.read(4), b"cdef")
+        self.assertEqual(pipe.read(0), b"")
+        self.assertEqual(pipe.read(), b"ghij")
+        self.assertEqual(pipe.read(8), b"")
+        self.assertEqual(pipe.bytes_read, 10)
+
+
+def add_measurements(model, cruise, level, points):
+    """Rows of `cruise` at `level`, one per (day, lng, lat)."""
+    model.objects.bulk_create(
+        model(
+            date_DD_MM_YYYY=day,
+            time_HH_MM_SS=time(12),
+            last_processing_date_DD_MM_YYYY=date(2011, 1, 1),
+            coordinates=Point(lng, lat),
+            cruise=cruise,
+            level=level,
+        )
+        for day, lng, lat in points
+    )
+
+
+class DerivedTablesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ["Cruise_A", "Cruise_B"]:
+            Site.objects.create(name=name, aeronet_number=1, span_date=[])
+        add_measurements(
+            DownloadAODDaily,
+            "Cruise_A",
+            15,
+            [
+                (date(2010, 3, 2), 10.0001, 20.0),
+                (date(2010, 3, 1), 10.0002, 20.0),
+                (date(2010, 3, 9), 12.0, 21.0),
+            ],
+        )
+        add_measurements(
+            DownloadAODDaily, "Cruise_A", 20, [(date(2010, 3, 5), 11.0, 20.5)]
+        )
+        add_measurements(
+            DownloadSDASeries, "Cruise_A", 15, [(date(2010, 2, 20), 9.0, 19.0)]
+        )
+        add_measurements(
+            DownloadAODDaily, "Cruise_B", 15, [(date(2012, 6, 1), -40.0, -10.0)]
+        )
+
+    def test_spans(self):
+        refresh_derived_tables()
+        spans = {
+            (span.cruise, span.datatype, span.freq, span.level): (
+                span.start_date,
+                span.end_date,
+            )
+            for span in SiteSpan.objects.all()
+        }
+        self.assertEqual(
+            spans,
+            {
+                ("Cruise_A", "AOD", "Daily", 15): (date(2010, 3, 1), date(2010, 3, 9)),
+                ("Cruise_A", "AOD", "Daily", 20): (date(2010, 3, 5), date(2010, 3, 5)),
+                ("Cruise_A", "SDA", "Series", 15): (
+                    date(2010, 2, 20),
+                    date(2010, 2, 20),
+                ),
+                ("Cruise_B", "AOD", "Daily", 15): (date(2012, 6, 1), date(2012, 6, 1)),
+            },
+        )
+        # span_date mirrors the AOD / Daily / level 15 span only
+        self.assertEqual(
+            Site.objects.get(name="Cruise_A").span_date,
+            [date(2010, 3, 1), date(2010, 3, 9)],
+        )
+        self.assertEqual(
+            Site.objects.get(name="Cruise_B").span_date,
+            [date(2012, 6, 1), date(2012, 6, 1)],
+        )
+
+    def test_tracks(self):
+        refresh_derived_tables()
+        track = SiteTrack.objects.get(cruise="Cruise_A", level=15)
+        # The two positions 0.0001 degrees apart share a grid cell
+        self.assertEqual(track.point_count, 2)
+        self.assertEqual(len(track.track), 2)
+        # The envelope covers every product at its level, the SDA point too
+        for corner in [Point(9.0, 19.0), Point(12.0, 21.0)]:
+            self.assertTrue(track.envelope.contains(corner))
+        other_level = SiteTrack.objects.get(cruise="Cruise_A", level=20)
+        self.assertFalse(other_level.envelope.contains(Point(12.0, 21.0)))
+        self.assertEqual(
+            set(SiteTrack.objects.values_list("cruise", "level")),
+            {("Cruise_A", 15), ("Cruise_A", 20), ("Cruise_B", 15)},
+        )
+
+    def test_refresh_replaces_the_previous_rows(self):
+        refresh_derived_tables()
+        DownloadAODDaily.objects.filter(cruise="Cruise_B").delete()
+        add_measurements(
+            DownloadAODDaily, "Cruise_B", 15, [(date(2013, 1, 1), -41.0, -11.0)]
+        )
+        refresh_derived_tables()
+        self.assertEqual(SiteSpan.objects.filter(cruise="Cruise_B").count(), 1)
+        self.assertEqual(
+            Site.objects.get(name="Cruise_B").span_date,
+            [date(2013, 1, 1), date(2013, 1, 1)],
+        )
+        track = SiteTrack.objects.get(cruise="Cruise_B", level=15)
+        self.assertTrue(track.envelope.contains(Point(-41.0, -11.0)))
+        self.assertFalse(track.envelope.contains(Point(-40.0, -10.0)))
+
+
+class TileRangeTests(SimpleTestCase):
+    def test_tiles_cover_the_bbox(self):
+        boxes = [
+            (-180, -90, 180, 90),
+            (-10.3, 35.2, 12.7, 48.9),
+            (100.01, -5.5, 100.02, -5.49),
+            (0, 0, 0, 0),
+        ]
+        for bbox in boxes:
+            with self.subTest(bbox=bbox):
+                size, x0, y0, x1, y1 = tile_range(*bbox)
+                min_lng, min_lat, max_lng, max_lat = bbox
+                self.assertGreaterEqual(size, MIN_TILE_DEGREES)
+                self.assertTrue(math.log2(360.0 / size).is_integer())
+                self.assertLessEqual(x0 * size, min_lng)
+                self.assertLessEqual(y0 * size, min_lat)
+                self.assertGreaterEqual((x1 + 1) * size, max_lng)
+                self.assertGreaterEqual((y1 + 1) * size, max_lat)
+                self.assertLessEqual(max(x1 - x0, y1 - y0), 2 * TILES_PER_SIDE)
+
+    def test_negative_coordinates_round_down(self):
+        # Tiles are 360 / 2**n degrees: 360 / 1024 for a one degree viewport
+        size, x0, y0, x1, y1 = tile_range(-0.5, -0.5, 0.5, 0.5)
+        self.assertEqual(size, 360.0 / 1024)
+        self.assertEqual((x0, y0, x1, y1), (-2, -2, 1, 1))
+
+    def test_panning_within_the_tiles_keeps_the_range(self):
+        self.assertEqual(tile_range(1, 1, 39, 39), tile_range(2, 3, 40, 41))
+        self.assertNotEqual(tile_range(1, 1, 39, 39), tile_range(1, 1, 79, 79))
+
+    def test_list_keys(self):
+        bbox = (0.0, 0.0, 40.0, 40.0)
+        dates = (date(2010, 1, 1), date(2024, 5, 1))
+        key = site_list_key(1, bbox, dates)
+        others = [
+            site_list_key(2, bbox, dates),
+            site_list_key(1, None, dates),
+            site_list_key(1, (0.0, 0.0, 40.0, 40.5), dates),
+            site_list_key(1, bbox, None),
+            site_list_key(1, bbox, (date(2010, 1, 1), date(2024, 5, 2))),
+        ]
+        self.assertEqual(len({key, *others}), 6)
+
+    def test_date_range(self):
+        today = date(2024, 5, 1)
+        cases = [
+            ("2010-01-01", None, (date(2010, 1, 1), today)),
+            ("2010-01-01", "2012-03-04", (date(2010, 1, 1), date(2012, 3, 4))),
+            (None, "2012-03-04", (date(2012, 3, 4), date(2012, 3, 4))),
+            ("2010-01-01", "soon", None),
+            ("2010-02-30", "2012-03-04", None),
+            (None, "2012-13-01", None),
+            ("", "", None),
+        ]
+        for start, end, expected in cases:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(date_range(start, end, today), expected)
+
+    def test_date_spellings_share_a_key(self):
+        today = date(2024, 5, 1)
+
+        def key(start):
+            return site_list_key(1, None, date_range(start, None, today))
+
+        self.assertEqual(key("2010-1-1"), key("2010-01-01"))
+        # Invalid dates filter nothing, so they share the unfiltered entry
+        unfiltered = site_list_key(1, None, None)
+        for start in ["bogus", "2010-02-30"]:
+            with self.subTest(start=start):
+                self.assertEqual(key(start), unfiltered)
+
+
+class CruisesInTilesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def add(self, cruise, lng, lat, level=15):
+        SiteTrack.objects.create(
+            cruise=cruise,
+            level=level,
+            track=MultiPoint(Point(lng, lat)),
+            envelope=Polygon.from_bbox((lng, lat, lng + 0.1, lat + 0.1)),
+            point_count=1,
+        )
+
+    def test_tiles_are_filled_once_per_version(self):
+        self.add("Cruise_A", 10.5, 20.5)
+        self.add("Cruise_B", 10.5, 20.5, level=10)
+        self.add("Cruise_C", -100, -40)
+        tiles = tile_range(0, 0, 40, 40)
+
+        self.assertEqual(cruises_in_tiles(tiles, 1), {"Cruise_A"})
+        with self.assertNumQueries(0):
+            self.assertEqual(cruises_in_tiles(tiles, 1), {"Cruise_A"})
+
+        # New data only shows up under a new version
+        self.add("Cruise_D", 30.5, 5.5)
+        self.assertEqual(cruises_in_tiles(tiles, 1), {"Cruise_A"})
+        self.assertEqual(cruises_in_tiles(tiles, 2), {"Cruise_A", "Cruise_D"})
+
+    def test_empty_tiles_are_cached_too(self):
+        tiles = tile_range(100, -50, 101, -49)
+        self.assertEqual(cruises_in_tiles(tiles, 1), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(cruises_in_tiles(tiles, 1), set())
+
+    def test_panning_only_queries_new_tiles(self):
+        self.add("Cruise_A", 1, 1)
+        self.add("Cruise_B", 25, 1)
+        self.add("Cruise_C", 60, 1)
+        self.assertEqual(
+            cruises_in_tiles(tile_range(0, 0, 40, 40), 1), {"Cruise_A", "Cruise_B"}
+        )
+
+        # Shares the tile size and two columns of tiles with the first bbox
+        panned = tile_range(30, 0, 70, 40)
+        self.assertEqual(panned[0], tile_range(0, 0, 40, 40)[0])
+        self.add("Cruise_D", 25, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(cruises_in_tiles(panned, 1), {"Cruise_B", "Cruise_C"})
+
+    def test_bbox_is_exact(self):
+        bbox = (0, 0, 39, 39)
+        # An inner tile, then the edge tile past x = 33.75: inside and outside
+        self.add("Cruise_A", 10.5, 20.5)
+        self.add("Cruise_B", 36, 20.5)
+        self.add("Cruise_C", 39.5, 20.5)
+        self.assertEqual(
+            cruises_in_tiles(tile_range(*bbox), 1),
+            {"Cruise_A", "Cruise_B", "Cruise_C"},
+        )
+        self.assertEqual(cruises_in_bbox(bbox, 1), {"Cruise_A", "Cruise_B"})
+        # Only the edge cruises are checked again, plus the sites without tracks
+        with self.assertNumQueries(2):
+            self.assertEqual(cruises_in_bbox(bbox, 1), {"Cruise_A", "Cruise_B"})
+
+    def test_sites_without_a_track_are_matched_on_their_points(self):
+        # SiteTrack is empty until refresh_derived_tables has run
+        for number, cruise, lng in [(1, "Cruise_A", 10.5), (2, "Cruise_B", 50)]:
+            Site.objects.create(name=cruise, aeronet_number=number, span_date=[])
+            DownloadAODDaily.objects.create(
+                date_DD_MM_YYYY=date(2010, 1, 1),
+                time_HH_MM_SS=time(12),
+                last_processing_date_DD_MM_YYYY=date(2010, 2, 1),
+                coordinates=Point(lng, 20.5),
+                cruise=cruise,
+                level=15,
+            )
+        self.assertEqual(cruises_in_bbox((0, 0, 39, 39), 1), {"Cruise_A"})
+        # Tracked sites still come from SiteTrack alone
+        self.add("Cruise_C", 30, 10)
+        Site.objects.create(name="Cruise_C", aeronet_number=3, span_date=[])
+        self.assertEqual(cruises_in_bbox((0, 0, 39, 39), 2), {"Cruise_A", "Cruise_C"})
+
+
+class TileEndpointTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        DownloadAODDaily.objects.create(
+            date_DD_MM_YYYY=date(2010, 1, 1),
+            time_HH_MM_SS=time(12),
+            last_processing_date_DD_MM_YYYY=date(2010, 2, 1),
+            coordinates=Point(10.5, 20.5),
+            cruise="Cruise_A",
+            level=15,
+            aod_500nm=0.2,
+            aod_440nm=0.3,
+        )
+
+    def setUp(self):
+        cache.clear()
+        cache.set(DataVersion.CACHE_KEY, 1)
+
+    def get(self, z, x, y, reading="aod_500nm", query=None, **headers):
+        request = RequestFactory().get("/", query or {}, **headers)
+        return views.measurement_tile(request, reading, z, x, y)
+
+    def test_invalid_requests(self):
+        cases = [
+            ((23, 0, 0), "aod_500nm", {}),
+            ((1, 2, 0), "aod_500nm", {}),
+            ((1, 0, -1), "aod_500nm", {}),
+            ((0, 0, 0), "not_a_reading", {}),
+            ((0, 0, 0), "aod_500nm", {"freq": "hourly"}),
+            ((0, 0, 0), "aod_500nm", {"level": "high"}),
+        ]
+        for tile, reading, query in cases:
+            with self.subTest(tile=tile, reading=reading, query=query):
+                self.assertEqual(self.get(*tile, reading, query).status_code, 400)
+
+    def test_tile(self):
+        response = self.get(0, 0, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], MVT_CONTENT_TYPE)
+        self.assertTrue(response.content)
+        self.assertIn("max-age=", response["Cache-Control"])
+        # A tile without points is an empty body, not an error
+        self.assertEqual(self.get(1, 0, 1).content, b"")
+
+    def test_matching_etag_is_answered_before_building(self):
+        etag = self.get(0, 0, 0)["ETag"]
+        cache.clear()
+        cache.set(DataVersion.CACHE_KEY, 1)
+        with mock.patch.object(tiles, "build_tile") as build:
+            response = self.get(0, 0, 0, HTTP_IF_NONE_MATCH=f'"other", {etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        build.assert_not_called()
+
+        others = [
+            self.get(1, 1, 0)["ETag"],
+            self.get(0, 0, 0, "aod_440nm")["ETag"],
+            self.get(0, 0, 0, query={"freq": "series"})["ETag"],
+            self.get(0, 0, 0, query={"level": 20})["ETag"],
+        ]
+        self.assertNotIn(etag, others)
+        self.assertEqual(len(set(others)), len(others))
+        cache.set(DataVersion.CACHE_KEY, 2)
+        self.assertNotEqual(self.get(0, 0, 0)["ETag"], etag)
+
+
+class ColumnarExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for number, cruise in enumerate(["Cruise_A", "Cruise_B"]):
+            DownloadAODDaily.objects.create(
+                date_DD_MM_YYYY=date(2012, 5, number + 1),
+                time_HH_MM_SS=time(6, 30),
+                last_processing_date_DD_MM_YYYY=date(2012, 6, 1),
+                coordinates=Point(10.5 + number, -20.25),
+                coordinates_wkt=f"POINT ({10.5 + number} -20.25)",
+                aod_500nm=-999.0 if number else 0.25,
+                aeronet_number=7,
+                cruise=cruise,
+                level=15,
+                pi=f"PI {number}",
+                pi_email=f"pi{number}@example.org",
+            )
+
+    def entry(self, queryset=None):
+        labels, columns = export_columns(DownloadAODDaily, "AOD")
+        if queryset is None:
+            queryset = DownloadAODDaily.objects.order_by("cruise")
+        preamble = "AERONET preamble\n" + ",".join(labels) + "\n"
+        return ExportEntry("A.parquet", "AOD", "Daily", 15, preamble, columns, queryset)
+
+    def test_parquet_keeps_types_and_provenance(self):
+        entry = self.entry()
+        table = pq.read_table(io.BytesIO(b"".join(iter_parquet_chunks(entry))))
+        self.assertEqual(table.num_rows, 2)
+        self.assertNotIn("coordinates_wkt", table.column_names)
+        self.assertEqual(table.column("longitude").to_pylist(), [10.5, 11.5])
+        self.assertEqual(table.column("latitude").to_pylist(), [-20.25, -20.25])
+        self.assertEqual(table.column("aod_500nm").to_pylist(), [0.25, None])
+        self.assertEqual(table.column("aeronet_number").type, pa.int32())
+        self.assertEqual(
+            table.column("date_DD_MM_YYYY").to_pylist(),
+            [date(2012, 5, 1), date(2012, 5, 2)],
+        )
+        self.assertEqual(table.column("time_HH_MM_SS").to_pylist()[0], time(6, 30))
+
+        metadata = table.schema.metadata
+        self.assertEqual(metadata[b"aeronet_preamble"].decode(), entry.preamble)
+        self.assertEqual(metadata[b"level"], b"15")
+        labels = json.loads(metadata[b"aeronet_labels"])
+        self.assertEqual(labels["aod_500nm"], "AOD_500nm")
+        self.assertEqual(
+            json.loads(metadata[b"pis"])["Cruise_B"],
+            {"pi": "PI 1", "pi_email": "pi1@example.org"},
+        )
+
+    def test_arrow_stream_matches_parquet(self):
+        entry = self.entry()
+        stream = pa.ipc.open_stream(b"".join(iter_arrow_chunks(entry))).read_all()
+        table = pq.read_table(io.BytesIO(b"".join(iter_parquet_chunks(entry))))
+        self.assertEqual(stream.to_pylist(), table.to_pylist())
+        self.assertTrue(pa.types.is_dictionary(stream.schema.field("cruise").type))
+
+    def test_empty_selection_is_a_valid_file(self):
+        entry = self.entry(DownloadAODDaily.objects.none())
+        table = pq.read_table(io.BytesIO(b"".join(iter_parquet_chunks(entry))))
+        self.assertEqual(table.num_rows, 0)
+        self.assertIn("longitude", table.column_names)
+        self.assertEqual(json.loads(table.schema.metadata[b"pis"]), {})
+
+    def test_record_batch_nulls_only_the_sentinel(self):
+        schema = pa.schema([("aod", pa.float64()), ("count", pa.int32())])
+        batch = _record_batch([(-999.0, -999), (0.0, 3), (None, None)], schema)
+        self.assertEqual(batch.column(0).to_pylist(), [None, 0.0, None])
+        # Integer columns keep their values, -999 included
+        self.assertEqual(batch.column(1).to_pylist(), [-999, 3, None])
+
+
+class ShardPlanTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(EXPORT_SHARD_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        TableHeader.objects.create(
+            datatype="AOD",
+            freq="Daily",
+            level=15,
+            base_header_l1="l1\n",
+            base_header_l2="l2\n",
+        )
+        spans = {
+            "Cruise_A": (date(2010, 1, 1), date(2010, 1, 31)),
+            "Cruise_B": (date(2010, 2, 1), date(2010, 2, 20)),
+            "Cruise_C": (date(2011, 6, 1), date(2011, 6, 9)),
+        }
+        self.root = shard_root(3)
+        files = {}
+        for cruise, (start, end) in spans.items():
+            SiteSpan.objects.create(
+                cruise=cruise,
+                datatype="AOD",
+                freq="Daily",
+                level=15,
+                start_date=start,
+                end_date=end,
+            )
+            for output_format in ("csv", "parquet"):
+                path = shard_path(self.root, "AOD", "Daily", 15, cruise, output_format)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "wb").close()
+                files[os.path.relpath(path, self.root)] = {
+                    "rows": (end - start).days + 1,
+                    "crc32": 1234,
+                    "size": 5678,
+                }
+        self.manifest = {"version": 3, "shards": 3, "files": files}
+        self.write_manifest()
+
+    def write_manifest(self):
+        with open(os.path.join(self.root, MANIFEST), "w") as f:
+            json.dump(self.manifest, f)
+
+    def params(self, **overrides):
+        return {
+            "sites": ["Cruise_C", "Cruise_B", "Cruise_A"],
+            "retrievals": ["AOD", "SDA"],
+            "frequency": ["Daily"],
+            "quality": ["Level 1.5", "Level 2.0"],
+            "start_date": None,
+            "end_date": None,
+            "bounds": None,
+            "format": "csv",
+            **overrides,
+        }
+
+    def test_whole_cruises_come_from_their_shards(self):
+        (member,) = shard_plan(self.params(), version=3)
+        self.assertEqual(member.arcname, "MAN_DATASET_AOD_DAILY15")
+        self.assertTrue(member.preamble.startswith("l1\nDaily,"))
+        self.assertEqual(
+            [(cruise, shard.path) for cruise, shard in member.parts],
+            [
+                (cruise, shard_path(self.root, "AOD", "Daily", 15, cruise, "csv"))
+                for cruise in ("Cruise_A", "Cruise_B", "Cruise_C")
+            ],
+        )
+        self.assertEqual(member.parts[0][1][1:], (31, 1234, 5678))
+        self.assertEqual(member.rows, 31 + 20 + 9)
+
+    def test_partial_overlap_is_resliced_from_the_database(self):
+        DownloadAODDaily.objects.bulk_create(
+            DownloadAODDaily(
+                date_DD_MM_YYYY=date(2010, 1, day),
+                time_HH_MM_SS=time(12),
+                last_processing_date_DD_MM_YYYY=date(2010, 3, 1),
+                cruise="Cruise_A",
+                level=15,
+            )
+            for day in range(20, 32)
+        )
+        params = self.params(
+            start_date="2010-01-25", end_date="2010-12-31", format="parquet"
+        )
+        (member,) = shard_plan(params, version=3)
+        (cruise_a, entry), (cruise_b, shard) = member.parts
+        self.assertEqual((cruise_a, cruise_b), ("Cruise_A", "Cruise_B"))
+        self.assertIsInstance(entry, ExportEntry)
+        self.assertEqual(entry.queryset.count(), 7)
+        # Parquet parts carry the preamble in their own metadata
+        self.assertEqual(entry.preamble, member.preamble)
+        self.assertEqual(
+            shard.path,
+            shard_path(self.root, "AOD", "Daily", 15, "Cruise_B", "parquet"),
+        )
+
+        (member,) = shard_plan({**params, "format": "csv"}, version=3)
+        self.assertEqual(member.parts[0][1].preamble, "")
+
+    def test_everything_else_goes_to_the_database(self):
+        bbox = {"min_lat": 0, "min_lng": 0, "max_lat": 1, "max_lng": 1}
+        self.assertIsNone(shard_plan(self.params(bounds=bbox), version=3))
+        self.assertIsNone(shard_plan(self.params(format="arrow"), version=3))
+        self.assertIsNone(shard_plan(self.params(), version=4))
+
+        os.remove(shard_path(self.root, "AOD", "Daily", 15, "Cruise_B", "csv"))
+        self.assertIsNone(shard_plan(self.params(), version=3))
+        # Cruise_B lies outside the range and is skipped, shard or not
+        later = self.params(start_date="2011-01-01")
+        self.assertEqual(len(shard_plan(later, version=3)), 1)
+
+        # Shards of a build that recorded no CRCs cannot be spliced
+        del self.manifest["files"]
+        self.write_manifest()
+        self.assertIsNone(shard_plan(later, version=3))
+
+    def test_dates_parse_as_the_orm_does(self):
+        (member,) = shard_plan(self.params(start_date="2011-6-1"), version=3)
+        self.assertEqual([cruise for cruise, _ in member.parts], ["Cruise_C"])
+        # Anything else is left to the database path rather than raising
+        for value in ("2011-06-31", "June 2011"):
+            with self.subTest(start_date=value):
+                self.assertIsNone(shard_plan(self.params(start_date=value), version=3))
+
+
+class ShardArchiveTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(shards, "SRC_DIR", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def csv_shard(self, name, text):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(text) + compressor.flush(zlib.Z_FULL_FLUSH)
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return Shard(path, text.count(b"\n"), zlib.crc32(text), len(text)), data
+
+    def parquet_shard(self, cruise, rows):
+        path = os.path.join(self.directory, f"{cruise}.parquet")
+        pis = json.dumps({cruise: {"pi": f"PI {cruise}", "pi_email": ""}})
+        table = pa.table({"cruise": [cruise] * rows, "aod": [0.1] * rows})
+        pq.write_table(table.replace_schema_metadata({"pis": pis}), path)
+        with open(path, "rb") as f:
+            return Shard(path, rows, None, None), f.read()
+
+    def member(self, output_format, parts):
+        return ShardMember(
+            arcname="MAN_DATASET_AOD_DAILY15",
+            format=output_format,
+            preamble="preamble\nlabels\n",
+            parts=parts,
+            rows=0,
+        )
+
+    def stream(self, member):
+        engine = mock.patch.object(
+            shards, "get_export_engine", return_value=lambda entry: [b"4,d\n"]
+        )
+        with engine:
+            return b"".join(stream_shard_archive([member], "root"))
+
+    def test_csv_shards_are_spliced_as_they_are(self):
+        a, a_data = self.csv_shard("a.csv.deflate", b"1,a\n2,a\n" * 1000)
+        b, _ = self.csv_shard("b.csv.deflate", b"")
+        c, c_data = self.csv_shard("c.csv.deflate", b"3,c\n")
+        resliced = ExportEntry("", "AOD", "Daily", 15, "", [], None)
+        parts = [("Cruise_A", a), ("Cruise_B", b), ("Cruise_D", resliced)]
+        data = self.stream(self.member("csv", parts + [("Cruise_C", c)]))
+
+        self.assertIn(a_data, data)
+        self.assertIn(c_data, data)
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ["root/MAN_DATASET_AOD_DAILY15.csv"])
+        info = archive.getinfo("root/MAN_DATASET_AOD_DAILY15.csv")
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+            archive.read(info),
+            b"preamble\nlabels\n" + b"1,a\n2,a\n" * 1000 + b"4,d\n3,c\n",
+        )
+
+    def test_parquet_shards_are_stored_as_they_are(self):
+        a, a_data = self.parquet_shard("Cruise_A", 2)
+        b, b_data = self.parquet_shard("Cruise_B", 3)
+
+        archive = zipfile.ZipFile(
+            io.BytesIO(self.stream(self.member("parquet", [("Cruise_A", a)])))
+        )
+        info = archive.getinfo("root/MAN_DATASET_AOD_DAILY15.parquet")
+        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.read(info), a_data)
+
+        parts = [("Cruise_A", a), ("Cruise_B", b)]
+        archive = zipfile.ZipFile(
+            io.BytesIO(self.stream(self.member("parquet", parts)))
+        )
+        self.assertIsNone(archive.testzip())
+        table = pq.read_table(
+            io.BytesIO(archive.read("root/MAN_DATASET_AOD_DAILY15.parquet"))
+        )
+        self.assertEqual(
+            table.column("cruise").to_pylist(), ["Cruise_A"] * 2 + ["Cruise_B"] * 3
+        )
+        self.assertEqual(
+            sorted(json.loads(table.schema.metadata[b"pis"])), ["Cruise_A", "Cruise_B"]
+        )
+
+    def test_parquet_members_are_named_as_from_the_database(self):
+        a, _ = self.parquet_shard("Cruise_A", 2)
+        b, _ = self.parquet_shard("Cruise_B", 3)
+        member = self.member("parquet", [("Cruise_A", a), ("Cruise_B", b)])
+        from_shards = zipfile.ZipFile(io.BytesIO(self.stream(member)))
+        with mock.patch.object(downloads, "SRC_DIR", self.directory):
+            from_database = zipfile.ZipFile(
+                io.BytesIO(
+                    b"".join(
+                        stream_archive(
+                            [_entry(f"{member.arcname}.parquet")],
+                            "root",
+                            lambda entry: [b"PAR1"],
+                        )
+                    )
+                )
+            )
+        self.assertEqual(from_shards.namelist(), from_database.namelist())
+        self.assertEqual(
+            from_shards.getinfo("root/MAN_DATASET_AOD_DAILY15.parquet").compress_type,
+            zipfile.ZIP_STORED,
+        )
+
+    def test_policy_files_follow_the_members(self):
+        with open(os.path.join(self.directory, "data_usage_policy.txt"), "wb") as f:
+            f.write(b"policy\n")
+        archive = zipfile.ZipFile(io.BytesIO(self.stream(self.member("csv", []))))
+        self.assertEqual(
+            archive.namelist(),
+            ["root/MAN_DATASET_AOD_DAILY15.csv", "root/data_usage_policy.txt"],
+        )
+        self.assertEqual(
+            archive.read("root/MAN_DATASET_AOD_DAILY15.csv"), b"preamble\nlabels\n"
+        )
+        self.assertEqual(archive.read("root/data_usage_policy.txt"), b"policy\n")
+
+    def test_crc32_combine(self):
+        for first, second in [
+            (b"", b"abc"),
+            (b"abc", b""),
+            (b"x" * 70000, b"yz" * 999),
+        ]:
+            with self.subTest(sizes=(len(first), len(second))):
+                self.assertEqual(
+                    crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second)),
+                    zlib.crc32(first + second),
+                )
+
+    def version(self, version, age):
+        path = os.path.join(self.directory, f"v{version}")
+        os.makedirs(path)
+        manifest = os.path.join(path, MANIFEST)
+        with open(manifest, "w") as f:
+            f.write("{}")
+        built = datetime.now().timestamp() - age
+        os.utime(manifest, (built, built))
+
+    def test_prune_keeps_versions_still_in_use(self):
+        self.version(1, 5000)
+        self.version(2, 1000)
+        self.version(3, 50)
+        self.version(4, 5000)
+        with override_settings(EXPORT_SHARD_DIR=self.directory):
+            # v1 was replaced long ago; v2 only 50 seconds ago, by v3
+            self.assertEqual(prune_shards(grace=100), [1])
+            self.assertEqual(sorted(os.listdir(self.directory)), ["v2", "v3", "v4"])
+            # The two newest versions stay regardless of age
+            self.assertEqual(prune_shards(grace=10), [2])
+            self.assertEqual(sorted(os.listdir(self.directory)), ["v3", "v4"])
+            self.assertEqual(prune_shards(grace=0), [])
+
+
+@override_settings(METRICS_ALLOWED_IPS=["10.0.0.1"], METRICS_TOKEN="s3cret")
+class MetricsAccessTests(SimpleTestCase):
+    def allowed(self, **headers):
+        return can_read_metrics(RequestFactory().get("/metrics", **headers))
+
+    def test_listed_address_or_token(self):
+        # RequestFactory requests come from 127.0.0.1, which is not listed here
+        self.assertFalse(self.allowed())
+        self.assertTrue(self.allowed(REMOTE_ADDR="10.0.0.1"))
+        self.assertTrue(self.allowed(HTTP_AUTHORIZATION="Bearer s3cret"))
+        self.assertTrue(self.allowed(HTTP_AUTHORIZATION="bearer s3cret"))
+
+    def test_wrong_credentials(self):
+        for header in ["Bearer wrong", "Basic s3cret", "s3cret", "Bearer "]:
+            with self.subTest(header=header):
+                self.assertFalse(self.allowed(HTTP_AUTHORIZATION=header))
+
+    @override_settings(METRICS_TOKEN="")
+    def test_no_token_means_addresses_only(self):
+        self.assertFalse(self.allowed(HTTP_AUTHORIZATION="Bearer "))
+
+    @override_settings()
+    def test_no_address_is_listed_by_default(self):
+        # Deleted under this test's own override, so it is back afterwards
+        del settings.METRICS_ALLOWED_IPS
+        # A proxy in front makes every request come from the loopback address
+        self.assertFalse(self.allowed())
+        self.assertTrue(self.allowed(HTTP_AUTHORIZATION="Bearer s3cret"))
+
+
+def shaped_view(request):
+    set_shape("AOD", "Daily", 15)
+    record_rows(7)
+    return HttpResponse(b"abc", status=201)
+
+
+def plain_view(request):
+    return HttpResponse(b"abcd")
+
+
+async def async_shaped_view(request):
+    return shaped_view(request)
+
+
+async def async_plain_view(request):
+    return plain_view(request)
+
+
+class MetricsMiddlewareTests(SimpleTestCase):
+    shape = {"retrieval": "AOD", "frequency": "Daily", "level": "15"}
+    no_shape = {"retrieval": "", "frequency": "", "level": ""}
+
+    def setUp(self):
+        # The registry is process wide: each test observes under its own view
+        self.view = f"test_{self._testMethodName}"
+
+    def request(self, factory=RequestFactory):
+        request = factory().get("/")
+        request.resolver_match = mock.Mock(url_name=self.view)
+        return request
+
+    def sample(self, name, shape, **labels):
+        labels = {"view": self.view, "method": "GET", **shape, **labels}
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def assertRecorded(self, shape, rows, size, status="200"):
+        self.assertEqual(
+            self.sample("maritime_requests_total", {}, status=status), 1
+        )
+        self.assertEqual(
+            self.sample("maritime_request_duration_seconds_count", shape), 1
+        )
+        self.assertGreater(
+            self.sample("maritime_request_duration_seconds_sum", shape), 0
+        )
+        self.assertEqual(self.sample("maritime_request_rows_sum", shape), rows)
+        self.assertEqual(self.sample("maritime_response_bytes_sum", shape), size)
+
+    def test_sync_request(self):
+        response = MetricsMiddleware(shaped_view)(self.request())
+        self.assertEqual(response.status_code, 201)
+        self.assertRecorded(self.shape, rows=7, size=3, status="201")
+        self.assertIsNone(metrics._current.get())
+
+    def test_async_request(self):
+        middleware = MetricsMiddleware(async_shaped_view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(self.request(AsyncRequestFactory))
+        self.assertEqual(response.status_code, 201)
+        self.assertRecorded(self.shape, rows=7, size=3, status="201")
+
+    def test_streamed_response_is_measured_to_the_last_chunk(self):
+        def chunks():
+            for chunk in [b"ab", b"cde"]:
+                record_rows(5)
+                yield chunk
+
+        def view(request):
+            set_shape("AOD", "Daily", 15)
+            return StreamingHttpResponse(chunks())
+
+        response = MetricsMiddleware(view)(self.request())
+        self.assertEqual(
+            self.sample("maritime_request_duration_seconds_count", self.shape), 0
+        )
+        self.assertEqual(b"".join(response.streaming_content), b"abcde")
+        self.assertRecorded(self.shape, rows=10, size=5)
+
+    def test_shape_is_reset_between_requests(self):
+        for shaped, plain, factory in [
+            (shaped_view, plain_view, RequestFactory),
+            (async_shaped_view, async_plain_view, AsyncRequestFactory),
+        ]:
+            with self.subTest(factory=factory.__name__):
+                self.view = f"test_shape_reset_{factory.__name__}"
+                for view in (shaped, plain):
+                    middleware = MetricsMiddleware(view)
+                    request = self.request(factory)
+                    if iscoroutinefunction(middleware):
+                        async_to_sync(middleware)(request)
+                    else:
+                        middleware(request)
+                self.assertEqual(
+                    self.sample("maritime_request_rows_sum", self.shape), 7
+                )
+                self.assertEqual(
+                    self.sample("maritime_request_rows_count", self.no_shape), 1
+                )
+                self.assertEqual(
+                    self.sample("maritime_request_rows_sum", self.no_shape), 0
+                )
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+@override_settings(PROFILER_ENABLED=True, PROFILER_ENGINE="cprofile")
+class ProfilerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        override = override_settings(PROFILER_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get(self, view=plain_view, **headers):
+        request = RequestFactory().get("/", **headers)
+        request.resolver_match = mock.Mock(url_name="profiled")
+        return ProfilerMiddleware(view)(request)
+
+    def profiled(self, view=plain_view):
+        return self.get(view, HTTP_X_PROFILE=make_token())
+
+    @override_settings(PROFILER_ENABLED=False)
+    def test_disabled_middleware_removes_itself(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilerMiddleware(plain_view)
+
+    def test_only_requests_with_a_valid_token_are_profiled(self):
+        with mock.patch("maritimeapp.middleware.start_profile") as start:
+            for headers in [{}, {"HTTP_X_PROFILE": "profile:forged"}]:
+                with self.subTest(headers=headers):
+                    self.assertFalse(self.get(**headers).has_header("X-Profile-File"))
+            with override_settings(PROFILER_TOKEN_MAX_AGE=-1):
+                self.assertFalse(self.profiled().has_header("X-Profile-File"))
+            start.assert_not_called()
+        self.assertEqual(os.listdir(self.directory), [])
+
+        response = self.get(QUERY_STRING=f"profile={make_token()}")
+        self.assertTrue(response.has_header("X-Profile-File"))
+
+    def test_trace_is_written_after_the_last_chunk(self):
+        def view(request):
+            return StreamingHttpResponse(iter([b"ab", b"cd"]))
+
+        response = self.profiled(view)
+        name = response["X-Profile-File"]
+        self.assertTrue(name.endswith(".prof"))
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(b"".join(response.streaming_content), b"abcd")
+        self.assertEqual(os.listdir(self.directory), [name])
+
+    @override_settings(PROFILER_MAX_FILES=2)
+    def test_only_the_newest_traces_are_kept(self):
+        names = [self.profiled()["X-Profile-File"] for _ in range(4)]
+        kept = os.listdir(self.directory)
+        self.assertEqual(len(kept), 2)
+        self.assertIn(names[-1], kept)
+        self.assertTrue(set(kept) <= set(names))
+
+    def test_sampler_follows_other_threads_until_stopped(self):
+        stop, pause = threading.Event(), threading.Event()
+        worker = threading.Thread(target=busy_loop, args=(stop,), name="worker")
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stop.set)
+
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        while not any("busy_loop" in stack for stack in sampler.stacks):
+            pause.wait(0.001)
+        sampler.stop()
+        self.assertFalse(sampler._thread.is_alive())
+
+        stacks = dict(sampler.stacks)
+        self.assertTrue(any(stack.startswith("worker;") for stack in stacks))
+        self.assertFalse(any(stack.startswith("profiler;") for stack in stacks))
+        pause.wait(0.01)
+        self.assertEqual(dict(sampler.stacks), stacks)
+
+        path = os.path.join(self.directory, "trace.collapsed")
+        sampler.write(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), len(stacks))
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertEqual(stacks[stack], int(count))
+
+
+class BorrowConnectionTests(SimpleTestCase):
+    def pool(self, *healthy):
+        conns = [mock.Mock(healthy=ok) for ok in healthy]
+        pool = mock.Mock(maxconn=len(conns) - 1)
+        pool.getconn.side_effect = conns
+        patcher = mock.patch.object(db, "connection_pool", return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        healthy = mock.patch.object(db, "_healthy", lambda conn: conn.healthy)
+        healthy.start()
+        self.addCleanup(healthy.stop)
+        return pool, conns
+
+    def test_stale_connections_are_closed_until_one_works(self):
+        pool, conns = self.pool(False, False, True)
+        self.assertIs(db.borrow_connection(), conns[2])
+        pool.putconn.assert_has_calls(
+            [mock.call(conns[0], close=True), mock.call(conns[1], close=True)]
+        )
+
+    def test_gives_up_once_fresh_connections_fail_too(self):
+        pool, conns = self.pool(False, False, False)
+        with self.assertRaises(psycopg2.OperationalError):
+            db.borrow_connection()
+        self.assertEqual(pool.putconn.call_count, 3)
@@ -0,0 +1,123 @@
+"""
+Mapbox Vector Tiles of the measurement points.
+
+Tiles are built in PostGIS with ST_AsMVT/ST_AsMVTGeom: one `measurements`
+layer with a point per measurement, carrying site, date, time and the
+requested reading as properties. Missing (-999) readings are left out.
+
+A tile depends only on its URL and query string and on the DataVersion stamp,
+so tiles are cached server side under a key including both, and served with
+an ETag derived from that key and Cache-Control so a browser or CDN can keep
+them too. A matching If-None-Match is answered before the tile is built.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+from django.db import connection
+from django.utils.dateparse import parse_date
+
+from .measurements import MISSING_VALUE, reading_fields
+from .models import (DownloadAODAP, DownloadAODDaily, DownloadAODSeries,
+                     DownloadSDAAP, DownloadSDADaily, DownloadSDASeries)
+
+MVT_CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+LAYER_NAME = "measurements"
+EXTENT = 4096
+MAX_ZOOM = 22
+
+# `freq` query value -> (AOD model, SDA model)
+TILE_MODELS = {
+    "daily": (DownloadAODDaily, DownloadSDADaily),
+    "series": (DownloadAODSeries, DownloadSDASeries),
+    "all_points": (DownloadAODAP, DownloadSDAAP),
+}
+
+
+def tile_model(reading, freq):
+    """The model carrying `reading` at `freq`, preferring AOD; None if neither."""
+    for model in TILE_MODELS.get(freq, ()):
+        if reading in reading_fields(model):
+            return model
+    return None
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def tile_params(query):
+    """Normalise the tile query string: level, dates and sites."""
+    return {
+        "level": int(query.get("level", 15)),
+        "start_date": parse_date(query.get("start_date") or "") or None,
+        "end_date": parse_date(query.get("end_date") or "") or None,
+        "sites": sorted(
+            name for name in (query.get("sites") or "").split(",") if name
+        ),
+    }
+
+
+def tile_cache_key(version, reading, freq, z, x, y, params):
+    digest = hashlib.sha256(repr(sorted(params.items())).encode("utf-8"))
+    return f"tiles:{version}:{freq}:{reading}:{z}:{x}:{y}:{digest.hexdigest()}"
+
+
+def build_tile(model, reading, z, x, y, params):
+    """Return the MVT bytes of tile z/x/y (empty when it has no points)."""
+    quote = connection.ops.quote_name
+    filters = ["t.level = %(level)s", f"t.{quote(reading)} <> %(missing)s"]
+    if params["start_date"]:
+        filters.append('t."date_DD_MM_YYYY" >= %(start_date)s')
+    if params["end_date"]:
+        filters.append('t."date_DD_MM_YYYY" <= %(end_date)s')
+    if params["sites"]:
+        filters.append("t.cruise = ANY(%(sites)s)")
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH bounds AS (
+                SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+            ),
+            features AS (
+                SELECT ST_AsMVTGeom(
+                           ST_Transform(t.coordinates, 3857), bounds.geom, %(extent)s
+                       ) AS geom,
+                       t.cruise AS site,
+                       t."date_DD_MM_YYYY"::text AS date,
+                       t."time_HH_MM_SS"::text AS time,
+                       t.{quote(reading)} AS {quote(reading)}
+                FROM {quote(model._meta.db_table)} AS t, bounds
+                WHERE t.coordinates && ST_Transform(bounds.geom, 4326)
+                AND {" AND ".join(filters)}
+            )
+            SELECT ST_AsMVT(features, %(layer)s, %(extent)s, 'geom')
+            FROM features
+            WHERE geom IS NOT NULL
+            """,
+            {
+                **params,
+                "z": z,
+                "x": x,
+                "y": y,
+                "extent": EXTENT,
+                "layer": LAYER_NAME,
+                "missing": MISSING_VALUE,
+            },
+        )
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile else b""
+
+
+def tile_etag(key):
+    """ETag of the tile cached under `key`: every part of the key changes it."""
+    return f'"{hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def cached_tile(key, model, reading, z, x, y, params):
+    tile = cache.get(key)
+    if tile is None:
+        tile = build_tile(model, reading, z, x, y, params)
+        cache.set(key, tile)
+    return tile
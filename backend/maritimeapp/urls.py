@@ -1,13 +1,24 @@
 from django.urls import include, path
 
 # from . import views
-from .views import (download_data, get_display_info, list_sites,
-                    set_csrf_token, site_measurements)
+from .views import (download_data, export_file, export_status,
+                    get_display_info, list_sites, measurement_tile,
+                    set_csrf_token, site_measurements, site_stats,
+                    submit_export)
 
 urlpatterns = [
     path("download/", download_data, name="download_data"),
+    path("export/", submit_export, name="submit_export"),
+    path("export/<uuid:job_id>/", export_status, name="export_status"),
+    path("export/<uuid:job_id>/file/", export_file, name="export_file"),
     path("measurements/sites/", list_sites, name="list_sites"),
     path("measurements/", site_measurements, name="site_measurements"),
+    path("stats/", site_stats, name="site_stats"),
     path("display_info/", get_display_info, name="display_info"),
+    path(
+        "tiles/<str:reading>/<int:z>/<int:x>/<int:y>.mvt",
+        measurement_tile,
+        name="measurement_tile",
+    ),
     path("set-csrf/", set_csrf_token, name="set-csrf"),
 ]
@@ -11,7 +11,8 @@ The user selects sites, start date, end date, retrievals, frequency, quality, an
 The backend filters the files based on the user's selection - a list of files names are generated based on parameters
 and  this list is used to processes the files to filter by date and bounds.
 
-The processed files are then zipped and sent to the user as a stream to be downloaded.
+The matching rows are encoded as CSV straight into an in-process zip stream and
+sent to the user as a streaming response, without touching disk.
 """
 from django.http import JsonResponse
 from django.middleware.csrf import get_token
@@ -61,301 +62,137 @@ from datetime import date, datetime, time
 import geopandas as gpd
 import polars as pl
 import pyarrow.csv as pv
+from django.conf import settings
 from django.contrib.gis.geos import Point, Polygon
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils.dateparse import parse_date
 from django.utils.timezone import make_naive
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_POST
 
+from asgiref.sync import sync_to_async
+
+from .download_cache import cache_key, cached_path, serve_cached, tee_to_cache
+from .downloads import (FORMAT_EXTENSIONS, QUALITY_MAP, aiter_chunks,
+                        build_export_plan, parse_download_request,
+                        stream_archive)
+from .export_formats import format_chunk_source
+from .measurements import (ARROW_FORMAT, COLUMNAR_FORMAT, ROW_FORMAT,
+                           arrow_response, binned_rows, columnar_json_response,
+                           downsampled_columns, filter_measurements,
+                           measurement_columns, reading_fields)
+from .metrics import record_rows, set_shape
 from .models import *
+from .shards import shard_plan, stream_shard_archive
+
+
+def read_only(func):
+    """
+    Wrap a blocking read for an async view.
+
+    The call runs on the default executor rather than the single thread shared
+    by every thread-sensitive call, so independent queries of concurrent
+    requests do not queue behind one another. That thread keeps its own
+    connection, so it is checked against CONN_MAX_AGE around each call the way
+    request_started/finished do for the shared one.
+    """
+
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def set_download_shape(params):
+    set_shape(
+        params["retrievals"],
+        params["frequency"],
+        [QUALITY_MAP.get(quality) for quality in params["quality"]],
+    )
+
+
+def relay_file(request, response):
+    """
+    Under ASGI, read a file response on a thread of its own (aiter_chunks):
+    Django would otherwise collect a sync iterator into memory before sending
+    the first byte. Under WSGI the response is returned as it is.
+    """
+    if isinstance(request, ASGIRequest) and response.streaming:
+        response.streaming_content = aiter_chunks(response.streaming_content)
+    return response
 
 
 @csrf_protect
 @require_POST
-def download_data(request):
-    aod_dict = {
-        "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
-        "time_HH_MM_SS": "Time(hh:mm:ss)",
-        "air_mass": "Air Mass",
-        "aod_340nm": "AOD_340nm",
-        "aod_380nm": "AOD_380nm",
-        "aod_440nm": "AOD_440nm",
-        "aod_500nm": "AOD_500nm",
-        "aod_675nm": "AOD_675nm",
-        "aod_870nm": "AOD_870nm",
-        "aod_1020nm": "AOD_1020nm",
-        "aod_1640nm": "AOD_1640nm",
-        "water_vapor_CM": "Water Vapor(cm)",
-        "angstrom_exponent_440_870": "440-870nm_Angstrom_Exponent",
-        "std_340nm": "STD_340nm",
-        "std_380nm": "STD_380nm",
-        "std_440nm": "STD_440nm",
-        "std_500nm": "STD_500nm",
-        "std_675nm": "STD_675nm",
-        "std_870nm": "STD_870nm",
-        "std_1020nm": "STD_1020nm",
-        "std_1640nm": "STD_1640nm",
-        "std_water_vapor_CM": "STD_Water_Vapor(cm)",
-        "std_angstrom_exponent_440_870": "STD_440-870nm_Angstrom_Exponent",
-        "number_of_observations": "Number_of_Observations",
-        "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
-        "aeronet_number": "AERONET_Number",
-        "microtops_number": "Microtops_Number",
-    }
-
-    sda_dict = {
-        "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
-        "time_HH_MM_SS": "Time(hh:mm:ss)",
-        "julian_day": "Julian_Day",
-        "air_mass": "Air_Mass",
-        "total_aod_500nm": "Total_AOD_500nm(tau_a)",
-        "fine_mode_aod_500nm": "Fine_Mode_AOD_500nm(tau_f)",
-        "coarse_mode_aod_500nm": "Coarse_Mode_AOD_500nm(tau_c)",
-        "fine_mode_fraction_500nm": "FineModeFraction_500nm(eta)",
-        "coarse_mode_fraction_500nm": "CoarseModeFraction_500nm(1_eta)",
-        "regression_dtau_a": "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
-        "rmse_fine_mode_aod_500nm": "RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
-        "rmse_coarse_mode_aod_500nm": "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
-        "rmse_fmf_and_cmf_fractions_500nm": "RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
-        "angstrom_exponent_total_500nm": "Angstrom_Exponent(AE)_Total_500nm(alpha)",
-        "dae_dln_wavelength_total_500nm": "dAE/dln(wavelength)_Total_500nm(alphap)",
-        "ae_fine_mode_500nm": "AE_Fine_Mode_500nm(alpha_f)",
-        "dae_dln_wavelength_fine_mode_500nm": "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
-        "aod_870nm": "870nm_Input_AOD",
-        "aod_675nm": "675nm_Input_AOD",
-        "aod_500nm": "500nm_Input_AOD",
-        "aod_440nm": "440nm_Input_AOD",
-        "aod_380nm": "380nm_Input_AOD",
-        "stdev_total_aod_500nm": "STDEV-Total_AOD_500nm(tau_a)",
-        "stdev_fine_mode_aod_500nm": "STDEV-Fine_Mode_AOD_500nm(tau_f)",
-        "stdev_coarse_mode_aod_500nm": "STDEV-Coarse_Mode_AOD_500nm(tau_c)",
-        "stdev_fine_mode_fraction_500nm": "STDEV-FineModeFraction_500nm(eta)",
-        "stdev_coarse_mode_fraction_500nm": "STDEV-CoarseModeFraction_500nm(1_eta)",
-        "stdev_regression_dtau_a": "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
-        "stdev_rmse_fine_mode_aod_500nm": "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
-        "stdev_rmse_coarse_mode_aod_500nm": "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
-        "stdev_rmse_fmf_and_cmf_fractions_500nm": "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
-        "stdev_angstrom_exponent_total_500nm": "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)",
-        "stdev_dae_dln_wavelength_total_500nm": "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)",
-        "stdev_ae_fine_mode_500nm": "STDEV-AE_Fine_Mode_500nm(alpha_f)",
-        "stdev_dae_dln_wavelength_fine_mode_500nm": "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
-        "stdev_aod_870nm": "STDEV-870nm_Input_AOD",
-        "stdev_aod_675nm": "STDEV-675nm_Input_AOD",
-        "stdev_aod_500nm": "STDEV-500nm_Input_AOD",
-        "solar_zenith_angle": "Solar_Zenith_Angle",
-        "stdev_aod_440nm": "STDEV-440nm_Input_AOD",
-        "stdev_aod_380nm": "STDEV-380nm_Input_AOD",
-        "number_of_observations": "Number_of_Observations",
-        "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
-        "aeronet_number": "AERONET_Number",
-        "microtops_number": "Microtops_Number",
-    }
-
-    src_dir = r"./src"
-    temp_base_dir = r"./temp"
-    unique_temp_folder = str(int(tme.time())) + "_MAN_DATA"
-
+async def download_data(request):
     try:
         data = json.loads(request.body.decode("utf-8"))
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
-    sites = data.get("sites", [])
-    start_date = data.get("start_date", "")
-    end_date = data.get("end_date", "")
-    retrievals = data.get("retrievals", [])
-    frequency = data.get("frequency", [])
-    quality = data.get("quality", [])
-    bounds = {
-        "min_lat": data.get("min_lat", None),
-        "min_lng": data.get("min_lng", None),
-        "max_lat": data.get("max_lat", None),
-        "max_lng": data.get("max_lng", None),
-    }
-
-    if (start_date is not None) or (end_date is not None):
-        init_start_date = datetime(2004, 10, 16).strftime("%Y-%m-%d")
-        today_date = datetime.now().date().strftime("%Y-%m-%d")
-
-        if start_date is not None:
-            if start_date == init_start_date:
-                start_date = None
-        if end_date is not None:
-            if end_date == today_date:
-                end_date = None
-
-    full_temp_path = os.path.join(temp_base_dir, unique_temp_folder)
-    os.makedirs(full_temp_path, exist_ok=True)
-
-    # print(sites, retrievals, frequency, quality)
-
-    zip_filename = f"{unique_temp_folder}.zip"
-    zip_path = os.path.join(temp_base_dir, zip_filename)
-    directory_to_archive = os.path.join(temp_base_dir, unique_temp_folder)
-
-    model = None
-    filename = None
-    date_filter = Q()
-
-    if start_date:
-        date_filter &= Q(date_DD_MM_YYYY__gte=start_date)
-    if end_date:
-        date_filter &= Q(date_DD_MM_YYYY__lte=end_date)
-
-    for retrieval in retrievals:
-        for freq in frequency:
-            match (retrieval, freq):
-                case ("SDA", "Point"):
-                    model = DownloadSDAAP
-                    filename = "MAN_DATASET_SDA_POINT"
-
-                case ("SDA", "Series"):
-                    model = DownloadSDASeries
-                    filename = "MAN_DATASET_SDA_SERIES"
-
-                case ("SDA", "Daily"):
-                    model = DownloadSDADaily
-                    filename = "MAN_DATASET_SDA_DAILY"
-
-                case ("AOD", "Daily"):
-                    model = DownloadAODDaily
-                    filename = "MAN_DATASET_AOD_DAILY"
-
-                case ("AOD", "Series"):
-                    model = DownloadAODSeries
-                    filename = "MAN_DATASET_AOD_SERIES"
-
-                case ("AOD", "Point"):
-                    model = DownloadAODAP
-                    filename = "MAN_DATASET_AOD_POINT"
-
-            fieldnames = [field.name for field in model._meta.fields]
-            fieldnames.pop(0)
-            quality_map = {"Level 1.0": 10, "Level 1.5": 15, "Level 2.0": 20}
-
-            temp_fn = filename
-
-            for level in quality:
-                level_value = quality_map.get(level)
-
-                filename = temp_fn + str(level_value)
-
-                cur_header = TableHeader.objects.filter(
-                    level=quality_map[level], freq=freq, datatype=retrieval
-                ).first()
-
-                if "SDA" in retrieval:
-                    translated_cols = [
-                        sda_dict.get(header, header) for header in fieldnames
-                    ]
-                else:
-                    translated_cols = [
-                        aod_dict.get(header, header) for header in fieldnames
-                    ]
-
-                if cur_header is not None:
-                    l1_header = cur_header.base_header_l1
-                    l2_header = cur_header.base_header_l2
-                    translated_cols.remove("coordinates_wkt")
-                    header = ",".join(translated_cols)
-                    # print(header)
-                    query = model.objects.filter(cruise__in=sites, level=level_value)
-                    if date_filter:
-                        query = query.filter(date_filter)
-
-                    if all(value is not None for value in bounds.values()):
-                        min_point = Point(bounds["min_lng"], bounds["min_lat"])
-                        max_point = Point(bounds["max_lng"], bounds["max_lat"])
-                        bbox_polygon = Polygon.from_bbox(
-                            (min_point.x, min_point.y, max_point.x, max_point.y)
-                        )
-                        query = query.filter(coordinates__within=bbox_polygon)
-                    if query.exists():
-                        file_path = os.path.join(full_temp_path, filename + str(".csv"))
-
-                        with open(file_path, "w", newline="") as file:
-                            file.write(f"{l1_header}")
-                            file.write(f"{freq},** interpolated 500nm channel **\n")
-                            file.write(f"{l2_header}")
-                            file.write(f"{header}\n")
-                            file.close()
-
-                        queryset_dict = query.values(*fieldnames)
-
-                        df = pl.DataFrame(list(queryset_dict))
-                        df = df.drop("coordinates")
-                        df.write_csv(
-                            open(file_path, "a"),
-                            include_header=False,
-                            batch_size=20000,
-                        )
-
-    try:
-        keep_files = ["data_usage_policy.pdf", "data_usage_policy.txt"]
-        for policy_file in keep_files:
-            src_policy_file = os.path.join(src_dir, policy_file)
-            temp_policy_file = os.path.join(full_temp_path, policy_file)
-
-            os.makedirs(os.path.dirname(temp_policy_file), exist_ok=True)
-
-            if os.path.isfile(src_policy_file):
-                shutil.copy(src_policy_file, temp_policy_file)
-                print(f"Copied {src_policy_file} to {temp_policy_file}")
-            else:
-                print(f"Source policy file {src_policy_file} does not exist")
-
-        print("zip", "-r", "-X", zip_filename, unique_temp_folder)
-        subprocess.run(
-            ["zip", "-r", "-X", zip_filename, unique_temp_folder],
-            cwd=temp_base_dir,
-            check=True,
-        )
-
-        print(f"Successfully created {zip_filename} from {directory_to_archive}")
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while creating the tar file: {e}")
-        return JsonResponse(
-            {"error": "An error occurred while creating the tar file."}, status=500
-        )
-
-    try:
-        with open(zip_path, "rb") as f:
-            response = HttpResponse(
-                f.read(),
-                content_type="application/zip",
-                headers={
-                    "Content-Disposition": f'attachment; filename="{zip_filename}"'
-                },
+    params = parse_download_request(data)
+    set_download_shape(params)
+    if params["format"] not in FORMAT_EXTENSIONS:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+    archive_root = str(int(tme.time())) + "_MAN_DATA"
+    engine = format_chunk_source(params["format"])
+
+    # Without a bbox the archive is assembled from the per-cruise shards
+    version = await DataVersion.acached()
+    members = await read_only(shard_plan)(params, version)
+    source = "shards" if members is not None else engine.__name__
+    key = cache_key(params, source, version)
+    path = await sync_to_async(cached_path, thread_sensitive=False)(key)
+    if path is not None:
+        try:
+            response = await sync_to_async(serve_cached, thread_sensitive=False)(
+                request,
+                path,
+                f"{archive_root}.zip",
+                getattr(settings, "DOWNLOAD_CACHE_SENDFILE_PREFIX", ""),
             )
-
-            return response
-    except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
-    finally:
-        if os.path.exists(full_temp_path):
-            shutil.rmtree(full_temp_path)
-            print(f"Deleted temporary directory {full_temp_path}")
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-            print(f"Deleted temporary file {zip_path}")
-
-    return JsonResponse({"error": "Invalid request method"}, status=405)
+            return relay_file(request, response)
+        except FileNotFoundError:
+            # Evicted since the lookup: build it again like any other miss
+            pass
+
+    if members is not None:
+        chunks = stream_shard_archive(members, archive_root)
+    else:
+        entries = await read_only(build_export_plan)(params)
+        chunks = stream_archive(entries, archive_root, chunk_source=engine)
+    chunks = tee_to_cache(key, chunks)
+    if isinstance(request, ASGIRequest):
+        # The archive is built on a thread of its own; the event loop only
+        # relays its chunks, so slow downloads do not tie up a worker.
+        chunks = aiter_chunks(chunks)
+    # Under WSGI the sync iterator is streamed as is: an async one would be
+    # collected into memory before the first byte is sent.
+    response = StreamingHttpResponse(chunks, content_type="application/zip")
+    response["Content-Disposition"] = f'attachment; filename="{archive_root}.zip"'
+    return response
 
 
 from django.contrib.gis.geos import Point, Polygon
-from django.db.models import F, Q
+from django.db.models import F
 ##### INTERFACING FRONT-END ####
+from django.core.cache import cache
 from django.http import JsonResponse
-from django.utils.dateparse import parse_date
 from django.utils.timezone import now
 from django.views.decorators.http import require_GET
 
-from .models import Site
+from .models import DataVersion, Site
+from .site_cache import cruises_in_bbox, date_range, site_list_key
 
 
 @require_GET
-def list_sites(request):
+async def list_sites(request):
     reading = request.GET.get("reading")
     min_lat = request.GET.get("min_lat")
     min_lng = request.GET.get("min_lng")
@@ -365,68 +202,48 @@ def list_sites(request):
     end_date_str = request.GET.get("end_date")
 
     queryset = Site.objects.all()
+    version = await DataVersion.acached()
+    bbox = None
 
     if min_lat and min_lng and max_lat and max_lng:
         try:
-            min_point = Point(float(min_lng), float(min_lat))
-            max_point = Point(float(max_lng), float(max_lat))
-            bbox_polygon = Polygon.from_bbox(
-                (min_point.x, min_point.y, max_point.x, max_point.y)
-            )
-
-            # Get all Site IDs that have measurements within the bounding box
-            filtered_sites_ids = (
-                DownloadAODDaily.objects.filter(
-                    coordinates__within=bbox_polygon, level=15
-                )
-                .values_list("cruise", flat=True)
-                .distinct()
-            )
-
-            # Debug
-            # print(f"list sites: {list(filtered_sites_ids)}")
-
-            if filtered_sites_ids:
-                queryset = queryset.filter(name__in=filtered_sites_ids)
-            else:
-                return JsonResponse([], safe=False)
-
+            bbox = (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
         except (ValueError, TypeError) as e:
             # invalid coordinates provided
             print(f"Error with bounding box coordinates: {e}")
             return JsonResponse([], safe=False)
 
-    today = now().date()
-
-    if start_date_str:
-        start_date = parse_date(start_date_str)
-        if start_date:
-            if end_date_str:
-                end_date = parse_date(end_date_str)
-                if end_date:
-                    # Filter for sites with span_date that intersects with [start_date, end_date]
-                    queryset = queryset.filter(
-                        Q(span_date__0__lte=end_date, span_date__1__gte=start_date)
-                        | Q(span_date__0__lte=start_date, span_date__1__gte=end_date)
-                    ).distinct()
-            else:
-                # span_date [0, 1] 0 = start_date, 1 = end_date
-                # Filter for sites with span_date that intersects with [today, start_date]
-                queryset = queryset.filter(
-                    Q(span_date__0__lte=today, span_date__1__gte=start_date)
-                    | Q(span_date__0__lte=start_date, span_date__1__gte=today)
-                ).distinct()
-    elif end_date_str:
-        end_date = parse_date(end_date_str)
-        if end_date:
-            queryset = queryset.filter(
-                Q(span_date__0__lte=end_date, span_date__1__gte=end_date)
-            ).distinct()
+    dates = date_range(start_date_str, end_date_str, now().date())
+    key = site_list_key(version, bbox, dates)
+    sites = await cache.aget(key)
+    if sites is not None:
+        record_rows(len(sites))
+        return JsonResponse(sites, safe=False)
+
+    if bbox is not None:
+        # Get all Site IDs that have measurements within the bounding box
+        filtered_sites_ids = await read_only(cruises_in_bbox)(bbox, version)
+
+        if filtered_sites_ids:
+            queryset = queryset.filter(name__in=filtered_sites_ids)
+        else:
+            await cache.aset(key, [])
+            return JsonResponse([], safe=False)
+
+    if dates is not None:
+        # span_date [0, 1] 0 = start_date, 1 = end_date
+        # Filter for sites with span_date that intersects with [start, end]
+        start_date, end_date = dates
+        queryset = queryset.filter(
+            span_date__0__lte=end_date, span_date__1__gte=start_date
+        )
 
     queryset = queryset.annotate(start_date=F("span_date__0")).order_by("start_date")
 
-    sites = queryset.values("name", "span_date")
-    return JsonResponse(list(sites), safe=False)
+    sites = [site async for site in queryset.values("name", "span_date")]
+    await cache.aset(key, sites)
+    record_rows(len(sites))
+    return JsonResponse(sites, safe=False)
 
 
 from django.db import models
@@ -454,53 +271,64 @@ from .models import Site
 
 @csrf_protect
 @require_POST
-def site_measurements(request):
+async def site_measurements(request):
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON"}, status=400)
 
     aod_key = data.get("reading")
-    min_lat = data.get("min_lat")
-    min_lng = data.get("min_lng")
-    max_lat = data.get("max_lat")
-    max_lng = data.get("max_lng")
-    start_date_str = data.get("start_date")
-    end_date_str = data.get("end_date")
-    selected_sites = data.get("sites", [])
-    site_names = selected_sites if selected_sites else []
+    response_format = data.get("format", ROW_FORMAT)
+    site_names = data.get("sites", []) or []
 
     if len(site_names) == 0:
         return JsonResponse({"error": "No sites selected"}, status=400)
 
-    sites = (
-        Site.objects.filter(name__in=site_names) if site_names else Site.objects.all()
-    )
-    queryset = None
     try:
-
-        queryset = DownloadAODDaily.objects.filter(cruise__in=sites, level=15)
-        if min_lat and min_lng and max_lat and max_lng:
-            polygon = Polygon.from_bbox(
-                (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
+        max_points = data.get("max_points")
+        max_points = int(max_points) if max_points else None
+        resolution = data.get("resolution")
+        resolution = float(resolution) if resolution else None
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "Invalid max_points or resolution"}, status=400)
+    if (max_points is not None and max_points <= 0) or (
+        resolution is not None and resolution <= 0
+    ):
+        return JsonResponse({"error": "Invalid max_points or resolution"}, status=400)
+    downsample = max_points is not None or resolution is not None
+
+    # filter_measurements reads the level 1.5 daily AOD table
+    set_shape("AOD", "Daily", 15)
+    try:
+        queryset = filter_measurements(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    if downsample or response_format in (COLUMNAR_FORMAT, ARROW_FORMAT):
+        if aod_key not in reading_fields():
+            return JsonResponse({"error": "Invalid reading"}, status=400)
+        truncated = None
+        if downsample:
+            columns, truncated = await read_only(downsampled_columns)(
+                queryset, aod_key, max_points, resolution
             )
-            queryset = queryset.filter(coordinates__within=polygon).distinct()
-
-        if start_date_str and end_date_str:
-            start_date = parse_date(start_date_str)
-            end_date = parse_date(end_date_str)
-            queryset = queryset.filter(date_DD_MM_YYYY__range=(start_date, end_date))
-        elif start_date_str:
-            start_date = parse_date(start_date_str)
-            queryset = queryset.filter(date_DD_MM_YYYY__gte=start_date)
-        elif end_date_str:
-            end_date = parse_date(end_date_str)
-            queryset = queryset.filter(date_DD_MM_YYYY__lte=end_date)
-
-    except Exception as e:
-        print(e)
-    measurements = list(
-        queryset.values(
+        else:
+            columns = await read_only(measurement_columns)(queryset, aod_key)
+        record_rows(len(columns["value"]))
+        if response_format == ARROW_FORMAT:
+            response = arrow_response(columns, truncated)
+        elif response_format == COLUMNAR_FORMAT:
+            response = columnar_json_response(columns, truncated)
+        else:
+            response = JsonResponse(binned_rows(columns), safe=False)
+        if downsample:
+            # max_points could only be met by sampling the bins of every cruise
+            response["X-Truncated"] = "true" if truncated else "false"
+        return response
+
+    measurements = [
+        measurement
+        async for measurement in queryset.values(
             "cruise",
             "date_DD_MM_YYYY",
             "time_HH_MM_SS",
@@ -508,7 +336,7 @@ def site_measurements(request):
             "aeronet_number",
             aod_key,
         )
-    )
+    ]
 
     for measurement in measurements:
         coordinates = measurement.get("coordinates")
@@ -521,4 +349,138 @@ def site_measurements(request):
         measurement["date"] = measurement.pop("date_DD_MM_YYYY")
         measurement["time"] = measurement.pop("time_HH_MM_SS")
         measurement["site"] = measurement.pop("cruise")
+    record_rows(len(measurements))
     return JsonResponse(measurements, safe=False)
+
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+
+from .tiles import (MVT_CONTENT_TYPE, TILE_MODELS, cached_tile,
+                    tile_cache_key, tile_etag, tile_model, tile_params,
+                    valid_tile)
+
+# `freq` query value -> frequency label of the metrics
+TILE_FREQUENCIES = {"daily": "Daily", "series": "Series", "all_points": "Point"}
+
+
+@require_GET
+def measurement_tile(request, reading, z, x, y):
+    freq = request.GET.get("freq", "daily")
+    if freq not in TILE_MODELS:
+        return JsonResponse({"error": "Invalid freq"}, status=400)
+    model = tile_model(reading, freq)
+    if model is None:
+        return JsonResponse({"error": "Invalid reading"}, status=400)
+    if not valid_tile(z, x, y):
+        return JsonResponse({"error": "Invalid tile"}, status=400)
+    try:
+        params = tile_params(request.GET)
+    except ValueError:
+        return JsonResponse({"error": "Invalid level or date"}, status=400)
+    set_shape(
+        "AOD" if model is TILE_MODELS[freq][0] else "SDA",
+        TILE_FREQUENCIES[freq],
+        params["level"],
+    )
+
+    key = tile_cache_key(DataVersion.cached(), reading, freq, z, x, y, params)
+    etag = tile_etag(key)
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    tile = cached_tile(key, model, reading, z, x, y, params)
+    response = HttpResponse(tile, content_type=MVT_CONTENT_TYPE)
+    response["ETag"] = etag
+    response["Cache-Control"] = (
+        f"public, max-age={getattr(settings, 'TILE_CACHE_MAX_AGE', 3600)}"
+    )
+    return response
+
+
+from .export_jobs import job_status, submit_job
+from .models import ExportJob
+
+
+@csrf_protect
+@require_POST
+def submit_export(request):
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON data"}, status=400)
+
+    params = parse_download_request(data)
+    set_download_shape(params)
+    if params["format"] not in FORMAT_EXTENSIONS:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+    archive_name = str(int(tme.time())) + "_MAN_DATA.zip"
+    job = submit_job(params, archive_name)
+    return JsonResponse(job_status(job), status=202)
+
+
+@require_GET
+def export_status(request, job_id):
+    job = ExportJob.objects.filter(job_id=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Unknown export"}, status=404)
+    return JsonResponse(job_status(job))
+
+
+@require_GET
+def export_file(request, job_id):
+    job = ExportJob.objects.filter(job_id=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Unknown export"}, status=404)
+    if job.status == ExportJob.EXPIRED or (
+        job.status == ExportJob.DONE and not os.path.isfile(job.path)
+    ):
+        return JsonResponse({"error": "Export expired"}, status=410)
+    if job.status != ExportJob.DONE:
+        return JsonResponse(job_status(job), status=409)
+    try:
+        response = serve_cached(
+            request,
+            job.path,
+            job.archive_name,
+            getattr(settings, "EXPORT_JOB_SENDFILE_PREFIX", ""),
+        )
+        return relay_file(request, response)
+    except FileNotFoundError:
+        # Expired between the check above and opening the file
+        return JsonResponse({"error": "Export expired"}, status=410)
+
+
+from .metrics import can_read_metrics, render_metrics
+
+
+@require_GET
+def metrics(request):
+    if not can_read_metrics(request):
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
+from .stats import cached_statistics, parse_stats_request
+
+
+@csrf_protect
+@require_POST
+def site_stats(request):
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    try:
+        params = parse_stats_request(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    set_shape(params["retrieval"], params["frequency"], params["level"])
+
+    payload = cached_statistics(DataVersion.cached(), params)
+    record_rows(len(payload["stats"]))
+    return JsonResponse(payload)
@@ -3,13 +3,18 @@
 echo "resetting db"
 
 echo "yes" | pipenv run python manage.py flush
+# Drop the app's tables with the migrations that created them, then create
+# every table and index of the current models for real
+pipenv run python manage.py migrate maritimeapp zero
 rm ./maritimeapp/migrations/*
 pipenv run python manage.py makemigrations maritimeapp
-pipenv run python manage.py migrate maritimeapp --fake
+pipenv run python manage.py migrate maritimeapp
+pipenv run python manage.py create_partitions --convert
 rm -fr ./src/
 rm -fr ./src_csvs/
 echo "starting scripts"
 pipenv run python manage.py import_dd 
-pipenv run python manage.py psql_add
+pipenv run python manage.py psql_add --no-shards
 pipenv run python manage.py update_dates
+pipenv run python manage.py build_shards
 echo "done"